@@ -0,0 +1,126 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+# Same bundled chr21 references as the tests (see pytest.ini), unless set in the environment
+DEFAULT_ENV = {
+    'GRCH38_FASTA': os.path.join(ROOT, 'hg_ref', 'chr21_grch38.fa.gz'),
+    'GRCH37_FASTA': os.path.join(ROOT, 'hg_ref', 'chr21_grch37.fa.gz'),
+    'ENSEMBL_TIMEOUT': '120'
+}
+
+def default_reference(path: str) -> str:
+    """The packed genome next to a bundled FASTA if it has been built, as random reads from gzip are slow."""
+    packed = path[:-len('.gz')] + '.packed' if path.endswith('.gz') else path + '.packed'
+    return packed if os.path.exists(packed) else path
+
+def setup_env():
+    """Fill in the environment the API needs; must run before spliceai_api is imported."""
+    for key, value in DEFAULT_ENV.items():
+        os.environ.setdefault(key, default_reference(value) if key.endswith('_FASTA') else value)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+def summarise(samples: list) -> dict:
+    """Summary statistics (milliseconds) of a list of durations in seconds."""
+    ms = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        'n': len(ms),
+        'mean_ms': float(ms.mean()),
+        'min_ms': float(ms.min()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max())
+    }
+
+def bench(fn, repeat: int = 10, warmup: int = 1, number: int = 1) -> dict:
+    """Time `fn()` `repeat` times (after `warmup` untimed calls), reporting the time per call."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return summarise(samples)
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+    return {'commit': git('rev-parse', '--short', 'HEAD'), 'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+def package_version(name: str) -> str:
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return None
+
+def environment() -> dict:
+    """Where and on what a benchmark ran, stored with its results so runs can be compared."""
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        **git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        # Packed genomes read far faster than gzipped FASTAs: runs are only comparable on the same references
+        'references': {key: os.getenv(key) for key in ('GRCH38_FASTA', 'GRCH37_FASTA')},
+        'packages': {name: package_version(name) for name in ('numpy', 'tensorflow', 'keras', 'spliceai', 'fastapi')}
+    }
+
+def write_results(name: str, config: dict, results: dict, out: str = None) -> str:
+    """
+    Write benchmark results as JSON, by default to benchmarks/results/<name>-<commit>.json.
+
+    Returns:
+        str: Path of the results file.
+    """
+    env = environment()
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        suffix = f"{env['commit'] or 'unknown'}{'-dirty' if env['dirty'] else ''}"
+        out = os.path.join(RESULTS_DIR, f"{name}-{suffix}.json")
+
+    with open(out, 'w') as f:
+        json.dump({'benchmark': name, 'environment': env, 'config': config, 'results': results}, f, indent=2)
+    return out
+
+def sample_variants(ann, n: int, seed: int = 0, chrom: str = '21') -> list:
+    """
+    `n` random SNVs inside annotated transcripts of a chromosome, with their reference base read from the
+    annotator's FASTA. The same seed gives the same variants.
+    """
+    from spliceai_api.utils import Record, normalise_chrom
+
+    rng = np.random.default_rng(seed)
+    idxs = np.nonzero(ann.chroms == normalise_chrom(chrom, ann.chrom_prefix))[0]
+    fasta_chrom = normalise_chrom(chrom, list(ann.ref_fasta.keys())[0])
+    length = len(ann.ref_fasta[fasta_chrom])
+
+    records = []
+    while len(records) < n:
+        idx = rng.choice(idxs)
+        pos = int(rng.integers(ann.tx_starts[idx], ann.tx_ends[idx] + 1))
+        if pos < 6000 or pos > length - 16000:
+            continue
+        ref = ann.ref_fasta[fasta_chrom][pos-1:pos].seq.upper()
+        if ref not in 'ACGT':
+            continue
+        alt = str(rng.choice([x for x in 'ACGT' if x != ref]))
+        records.append(Record(chrom=chrom, pos=pos, ref=ref, alts=[alt]))
+    return records
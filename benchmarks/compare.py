@@ -0,0 +1,59 @@
+"""
+Compare two benchmark results files (e.g. from two commits):
+
+    python -m benchmarks.compare benchmarks/results/micro-abc1234.json benchmarks/results/micro-def5678.json
+"""
+import argparse
+import json
+
+# Metrics where a larger value is better; for everything else (times) smaller is better
+HIGHER_IS_BETTER = ('requests_per_s', 'variants_per_s')
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'ms_per_window') + HIGHER_IS_BETTER
+
+def flatten(results, prefix: str = '') -> dict:
+    """Numeric metrics of a results tree, keyed by their path (list entries by their concurrency, if any)."""
+    metrics = {}
+    if isinstance(results, dict):
+        items = results.items()
+    elif isinstance(results, list):
+        items = ((f"concurrency_{x['concurrency']}" if isinstance(x, dict) and 'concurrency' in x else str(k), x)
+                 for k, x in enumerate(results))
+    else:
+        return metrics
+
+    for key, value in items:
+        path = f"{prefix}.{key}" if prefix else key
+        if key in METRICS and isinstance(value, (int, float)):
+            metrics[path] = value
+        else:
+            metrics.update(flatten(value, path))
+    return metrics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two benchmark results files')
+    parser.add_argument('base', help='Baseline results')
+    parser.add_argument('new', help='New results')
+    parser.add_argument('--metric', action='append', default=None,
+                        help=f"Metrics to show (default: {', '.join(METRICS)})")
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"base: {base['environment']['commit']} ({base['environment']['timestamp']})  "
+          f"new: {new['environment']['commit']} ({new['environment']['timestamp']})")
+    # Results written before the references were recorded have none to compare
+    references = base['environment'].get('references'), new['environment'].get('references')
+    if references[0] != references[1]:
+        print(f"warning: the runs read different reference genomes: {references[0]} and {references[1]}")
+
+    base_metrics = flatten(base['results'])
+    new_metrics = flatten(new['results'])
+    for path in base_metrics:
+        metric = path.rsplit('.', 1)[-1]
+        if path not in new_metrics or (args.metric and metric not in args.metric):
+            continue
+        before, after = base_metrics[path], new_metrics[path]
+        speedup = (after / before if metric in HIGHER_IS_BETTER else before / after) if before and after else float('nan')
+        print(f"{path:70s} {before:12.3f} {after:12.3f} {speedup:7.2f}x")
@@ -0,0 +1,134 @@
+"""
+Load generator for the scoring endpoints. Runs against the app in-process (on the bundled chr21 test data) or
+against a running server:
+
+    python -m benchmarks.load --endpoint single --concurrency 1,4,16 --requests 64
+    python -m benchmarks.load --url http://127.0.0.1:5001 --endpoint bulk --bulk-size 16
+
+Reports throughput and latency percentiles per concurrency level. Variants are sampled at random inside chr21
+transcripts, each request with different variants, so unless `--unique` is set results do not come from the
+score cache.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+
+from benchmarks.common import setup_env, summarise, sample_variants, write_results
+
+setup_env()
+
+import httpx
+import numpy as np
+
+ENDPOINTS = ('single', 'bulk', 'custom')
+
+def build_payloads(args, n: int) -> list:
+    """(path, params, body) of `n` requests, in the order they are sent."""
+    from spliceai_api.registry import resolve_annotation_file
+    from spliceai_api.utils import Annotator
+
+    if args.endpoint == 'custom':
+        rng = np.random.default_rng(args.seed)
+        seqs = [''.join(rng.choice(list('ACGT'), args.seq_length)) for _ in range(args.unique or n)]
+        return [('/score_custom_seq/', {}, {'seq': seqs[k % len(seqs)]}) for k in range(n)]
+
+    fasta = 'GRCH37_FASTA' if args.annotation.startswith('grch37') else 'GRCH38_FASTA'
+    ann = Annotator(os.environ[fasta], resolve_annotation_file(args.annotation))
+    per_request = args.bulk_size if args.endpoint == 'bulk' else 1
+    records = sample_variants(ann, (args.unique or n) * per_request, seed=args.seed)
+    variants = [{'chrom': r.chrom, 'pos': r.pos, 'ref': r.ref, 'alt': r.alts[0]} for r in records]
+    options = {'annotation': args.annotation, 'distance': args.distance, 'mask': 0, 'mode': args.mode}
+
+    payloads = []
+    for k in range(n):
+        k = k % (len(variants) // per_request)
+        if args.endpoint == 'single':
+            payloads.append(('/get_delta_scores/', {}, {**variants[k], **options}))
+        else:
+            payloads.append(('/get_bulk_delta_scores/', {}, {**options,
+                                                            'variants': variants[k*per_request:(k+1)*per_request]}))
+    return payloads
+
+async def run_level(client: httpx.AsyncClient, payloads: list, concurrency: int, variants_per_request: int) -> dict:
+    """Send all payloads with `concurrency` requests in flight, returning throughput and latency."""
+    queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+    latencies = []
+    statuses = Counter()
+
+    async def worker():
+        while not queue.empty():
+            path, params, body = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                resp = await client.post(path, params=params, json=body)
+                await resp.aread()
+                statuses[str(resp.status_code)] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'concurrency': concurrency,
+        'requests': len(payloads),
+        'elapsed_s': elapsed,
+        'requests_per_s': len(payloads) / elapsed,
+        'variants_per_s': len(payloads) * variants_per_request / elapsed,
+        'latency': summarise(latencies),
+        'status': dict(statuses)
+    }
+
+async def main(args) -> list:
+    if args.url:
+        transport = None
+        base_url = args.url.rstrip('/')
+    else:
+        from spliceai_api.app import app
+        transport = httpx.ASGITransport(app=app)
+        base_url = 'http://spliceai'
+
+    # Each level gets its own requests, so later levels are not served by caches warmed by earlier ones
+    payloads = build_payloads(args, args.warmup + args.requests * len(args.concurrency))
+    variants_per_request = args.bulk_size if args.endpoint == 'bulk' else 1
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+        if args.warmup:
+            await run_level(client, payloads[:args.warmup], 1, variants_per_request)
+        for k, concurrency in enumerate(args.concurrency):
+            start = args.warmup + k * args.requests
+            result = await run_level(client, payloads[start:start + args.requests], concurrency, variants_per_request)
+            print(json.dumps(result, indent=2), flush=True)
+            results.append(result)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SpliceAI API load generator')
+    parser.add_argument('--url', default=None, help='Base URL of a running server (default: the app in-process)')
+    parser.add_argument('--endpoint', choices=ENDPOINTS, default='single', help='Endpoint to load')
+    parser.add_argument('--concurrency', type=lambda x: [int(k) for k in x.split(',')], default=[1, 4, 16],
+                        help='Comma separated numbers of requests in flight')
+    parser.add_argument('--requests', type=int, default=64, help='Requests sent at each concurrency level')
+    parser.add_argument('--unique', type=int, default=0,
+                        help='Distinct payloads, cycled through (default: every request is different)')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed requests sent first')
+    parser.add_argument('--annotation', default='grch38_custom', help='Annotation of the scored variants')
+    parser.add_argument('--distance', type=int, default=50, help='Distance of the scored variants')
+    parser.add_argument('--mode', choices=('full', 'summary'), default='full', help='Score mode')
+    parser.add_argument('--bulk-size', type=int, default=16, help='Variants per bulk request')
+    parser.add_argument('--seq-length', type=int, default=5000, help='Length of custom sequences')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sampled variants/sequences')
+    parser.add_argument('--timeout', type=float, default=600, help='Request timeout (seconds)')
+    parser.add_argument('--out', default=None, help='Results file (default: benchmarks/results/load-<commit>.json)')
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    path = write_results(f"load-{args.endpoint}", vars(args), results, args.out)
+    print(f"Results written to {path}")
@@ -0,0 +1,190 @@
+"""
+Micro-benchmarks of the stages of scoring a variant, on the bundled chr21 test data:
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --only inference --batch-sizes 1,8,32 --repeat 5
+    python -m benchmarks.micro --only responses --custom-length 100000
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from benchmarks.common import setup_env, bench, sample_variants, write_results
+
+setup_env()
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from spliceai_api import MODELS
+from spliceai_api.annotation_index import compile_annotation
+from spliceai_api.encoding import encode_batch
+from spliceai_api.inference import predict_windows, REF_CACHE
+from spliceai_api.registry import resolve_annotation_file
+from spliceai_api.responses import COMPRESSORS, dumps
+from spliceai_api.utils import Record, Annotator, normalise_chrom, prepare_delta_scores, get_delta_scores, get_bulk_delta_scores, \
+    scan_region, score_custom_sequence
+
+BENCHMARKS = ('annotator', 'lookup', 'encoding', 'inference', 'serialization', 'responses', 'bulk', 'scan')
+
+def bench_annotator(ann, args) -> dict:
+    fasta = ann.ref_fasta.filename
+    annotation_file = resolve_annotation_file(args.annotation)
+    return {'construct': bench(lambda: Annotator(fasta, annotation_file), repeat=max(args.repeat // 2, 1)),
+            'compile': bench(lambda: compile_annotation(annotation_file), repeat=max(args.repeat // 2, 1))}
+
+def bench_lookup(ann, args) -> dict:
+    records = sample_variants(ann, args.variants, seed=args.seed)
+    positions = [record.pos for record in records]
+    # (transcript, position) pairs of every transcript overlapping each position
+    overlaps = ann.get_names_and_strands('21', positions)
+    idxs = np.concatenate([x[2] for x in overlaps]).astype(int)
+    transcript_positions = np.repeat(positions, [len(x[2]) for x in overlaps])
+    return {
+        'get_name_and_strand': bench(lambda: [ann.get_name_and_strand('21', pos) for pos in positions],
+                                     repeat=args.repeat),
+        'get_names_and_strands': bench(lambda: ann.get_names_and_strands('21', positions), repeat=args.repeat),
+        'get_pos_data': bench(lambda: [ann.get_pos_data(i, pos) for i, pos in zip(idxs, transcript_positions)],
+                              repeat=args.repeat),
+        'get_pos_data_batch': bench(lambda: ann.get_pos_data_batch(idxs, transcript_positions), repeat=args.repeat),
+        'positions': len(positions)
+    }
+
+def bench_encoding(ann, args) -> dict:
+    records = sample_variants(ann, args.variants, seed=args.seed)
+    results = {}
+    for distance in (50, 10000):
+        tasks = [task for record in records for task in prepare_delta_scores(record, ann, distance)]
+        windows = [task.x_alt for task in tasks if task.x_alt is not None]
+        results[f"distance_{distance}"] = {
+            'prepare_delta_scores': bench(lambda: [prepare_delta_scores(record, ann, distance) for record in records],
+                                          repeat=args.repeat),
+            'encode_batch': bench(lambda: encode_batch(windows), repeat=args.repeat),
+            'windows': len(windows)
+        }
+    return results
+
+def bench_inference(ann, args) -> dict:
+    records = sample_variants(ann, max(args.batch_sizes), seed=args.seed)
+    windows = [task.x_ref for record in records for task in prepare_delta_scores(record, ann, 50)
+               if task.x_ref is not None]
+    results = {}
+    for batch_size in args.batch_sizes:
+        batch = (windows * batch_size)[:batch_size]
+        timing = bench(lambda: predict_windows(batch, MODELS, batch_size), repeat=args.repeat)
+        results[f"batch_{batch_size}"] = {**timing, 'ms_per_window': timing['p50_ms'] / batch_size}
+    return results
+
+def bench_serialization(ann, args) -> dict:
+    from spliceai_api.app import DeltaScore
+    adapter = TypeAdapter(list[DeltaScore])
+    record = sample_variants(ann, 1, seed=args.seed)[0]
+
+    results = {}
+    for distance in (50, 10000):
+        scores = get_delta_scores(record, ann, distance, 0, MODELS)
+        # What FastAPI does with a response model: validate, encode and dump
+        results[f"distance_{distance}"] = {
+            'response_model': bench(lambda: json.dumps(jsonable_encoder(adapter.validate_python(scores))),
+                                    repeat=args.repeat),
+            'json_dumps': bench(lambda: json.dumps(scores), repeat=args.repeat),
+            'bytes': len(json.dumps(scores))
+        }
+    return results
+
+def bench_responses(ann, args) -> dict:
+    from spliceai_api.app import DeltaScore
+    sequence = ''.join(np.random.default_rng(args.seed).choice(list('ACGT'), args.custom_length))
+    custom = score_custom_sequence(sequence, models=MODELS)
+    record = sample_variants(ann, 1, seed=args.seed)[0]
+    delta = jsonable_encoder(TypeAdapter(list[DeltaScore]).validate_python(get_delta_scores(record, ann, 10000, 0, MODELS)))
+
+    # Each payload with how it was rendered before: converted to lists and dumped by the json module
+    payloads = {
+        f"custom_sequence_{args.custom_length}": (custom, lambda: json.dumps(jsonable_encoder(
+            {name: values.tolist() for name, values in custom.items()}))),
+        'distance_10000': (delta, lambda: json.dumps(delta))
+    }
+
+    results = {}
+    for name, (content, baseline) in payloads.items():
+        body = dumps(content, -1)
+        result = {
+            'json': bench(baseline, repeat=args.repeat),
+            'orjson': bench(lambda: dumps(content, -1), repeat=args.repeat),
+            'orjson_4_decimals': bench(lambda: dumps(content, 4), repeat=args.repeat),
+            'bytes': len(body),
+            'bytes_4_decimals': len(dumps(content, 4))
+        }
+        for encoding, compress in COMPRESSORS.items():
+            if compress is not None:
+                result[encoding] = {**bench(lambda: compress(body), repeat=args.repeat), 'bytes': len(compress(body))}
+        results[name] = result
+    return results
+
+def bench_bulk(ann, args) -> dict:
+    records = sample_variants(ann, args.variants, seed=args.seed)
+    def run():
+        # Start from an empty reference prediction cache, so every repeat does the same work
+        REF_CACHE.clear()
+        get_bulk_delta_scores(records, ann, 50, 0, MODELS)
+
+    timing = bench(run, repeat=max(args.repeat // 2, 1))
+    return {**timing, 'variants': len(records), 'variants_per_s': len(records) / timing['p50_ms'] * 1000}
+
+def bench_scan(ann, args) -> dict:
+    """A region scan against scoring each of its SNVs with its own request, and all of them in one bulk request."""
+    start = sample_variants(ann, 1, seed=args.seed)[0].pos
+    end = start + args.scan_length - 1
+    chrom = '21'
+    # Trace the models for the window lengths used below before timing
+    scan_region(ann, chrom, start, start, 50, 0, MODELS)
+    bases = ann.ref_fasta[normalise_chrom(chrom, list(ann.ref_fasta.keys())[0])][start-1:end].seq.upper()
+    records = [Record(chrom=chrom, pos=start + k, ref=x, alts=[alt]) for k, x in enumerate(bases) for alt in 'ACGT'
+               if alt != x and x in 'ACGT']
+
+    def cold(fn):
+        # Start from an empty reference prediction cache, as a fresh region would
+        def run():
+            REF_CACHE.clear()
+            fn()
+        return run
+
+    repeat = max(args.repeat // 5, 1)
+    return {
+        'scan_region': bench(cold(lambda: scan_region(ann, chrom, start, end, 50, 0, MODELS)), repeat=repeat,
+                             warmup=0),
+        'single_calls': bench(cold(lambda: [get_delta_scores(record, ann, 50, 0, MODELS) for record in records]),
+                              repeat=repeat, warmup=0),
+        'bulk': bench(cold(lambda: get_bulk_delta_scores(records, ann, 50, 0, MODELS)), repeat=repeat, warmup=0),
+        'positions': args.scan_length,
+        'variants': len(records)
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SpliceAI API micro-benchmarks')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help=f"Comma separated subset of {', '.join(BENCHMARKS)}")
+    parser.add_argument('--annotation', default='grch38_custom', help='Annotation to benchmark with')
+    parser.add_argument('--repeat', type=int, default=10, help='Timed repeats of each benchmark')
+    parser.add_argument('--variants', type=int, default=32, help='Variants per lookup/encoding/bulk benchmark')
+    parser.add_argument('--batch-sizes', type=lambda x: [int(k) for k in x.split(',')], default=[1, 8, 32],
+                        help='Comma separated inference batch sizes')
+    parser.add_argument('--custom-length', type=int, default=100000, help='Bases of the scored custom sequence')
+    parser.add_argument('--scan-length', type=int, default=10, help='Positions of the scanned region')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sampled variants')
+    parser.add_argument('--out', default=None, help='Results file (default: benchmarks/results/micro-<commit>.json)')
+    args = parser.parse_args()
+
+    fasta = 'GRCH37_FASTA' if args.annotation.startswith('grch37') else 'GRCH38_FASTA'
+    ann = Annotator(os.environ[fasta], resolve_annotation_file(args.annotation))
+
+    results = {}
+    for name in args.only.split(','):
+        print(f"Running {name}...", flush=True)
+        results[name] = globals()[f"bench_{name}"](ann, args)
+        print(json.dumps(results[name], indent=2), flush=True)
+
+    path = write_results('micro', vars(args), results, args.out)
+    print(f"Results written to {path}")
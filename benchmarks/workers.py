@@ -0,0 +1,129 @@
+"""
+Memory and throughput of the server with several worker processes, with the models loaded by every worker or by
+one shared inference process:
+
+    python -m benchmarks.workers --workers 1,2,4,8 --modes shared,per-worker --requests 32
+
+Each configuration starts `python -m spliceai_api.serve` on the bundled chr21 test data, waits until it is ready,
+records the memory of the whole process tree (PSS, which counts pages shared between processes once), then sends
+single-variant requests with two requests in flight per worker.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.common import ROOT, setup_env, write_results
+
+setup_env()
+
+import httpx
+
+from benchmarks.load import build_payloads, run_level
+
+MODES = ('shared', 'per-worker')
+
+def process_tree(pid: int) -> list:
+    """`pid` and all of its descendants."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+    return pids
+
+def memory_mb(pid: int) -> dict:
+    """Summed RSS and PSS (MiB) of a process tree."""
+    rss = pss = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith('Rss:'):
+                        rss += int(line.split()[1])
+                    elif line.startswith('Pss:'):
+                        pss += int(line.split()[1])
+        except OSError:
+            continue
+    return {'processes': len(process_tree(pid)), 'rss_mb': rss / 1024, 'pss_mb': pss / 1024}
+
+async def wait_ready(url: str, workers: int, timeout: float):
+    """Wait until /health/ready succeeds as many times in a row as there are workers (each answers separately)."""
+    deadline = time.perf_counter() + timeout
+    in_a_row = 0
+    async with httpx.AsyncClient(base_url=url, timeout=10) as client:
+        while in_a_row < workers * 2:
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Server not ready after {timeout}s")
+            try:
+                in_a_row = in_a_row + 1 if (await client.get('/health/ready')).status_code == 200 else 0
+            except httpx.HTTPError:
+                in_a_row = 0
+            await asyncio.sleep(0.5)
+
+async def run_config(args, workers: int, mode: str, payloads: list) -> dict:
+    url = f"http://127.0.0.1:{args.port}"
+    command = [sys.executable, '-m', 'spliceai_api.serve', '--workers', str(workers), '--port', str(args.port)]
+    if mode == 'shared':
+        command.append('--shared-models')
+    server = subprocess.Popen(command, cwd=ROOT, env={**os.environ, 'MICRO_BATCH_WAIT_MS': str(args.micro_batch_wait_ms)},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        start = time.perf_counter()
+        await wait_ready(url, workers, args.timeout)
+        startup = time.perf_counter() - start
+        idle = memory_mb(server.pid)
+
+        async with httpx.AsyncClient(base_url=url, timeout=args.timeout) as client:
+            result = await run_level(client, payloads, workers * 2, 1)
+        loaded = memory_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {'workers': workers, 'mode': mode, 'startup_s': startup, 'memory_idle': idle,
+            'memory_after_load': loaded, **result}
+
+async def main(args) -> list:
+    results = []
+    for mode in args.modes:
+        for k, workers in enumerate(args.workers):
+            # Different variants for every configuration, so none is served from the caches of another
+            payloads = build_payloads(argparse.Namespace(**{**vars(args), 'seed': args.seed + 100 * k + len(results)}),
+                                      args.requests)
+            result = await run_config(args, workers, mode, payloads)
+            print(json.dumps(result, indent=2), flush=True)
+            results.append(result)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SpliceAI API worker scaling benchmark')
+    parser.add_argument('--workers', type=lambda x: [int(k) for k in x.split(',')], default=[1, 2, 4, 8],
+                        help='Comma separated worker counts')
+    parser.add_argument('--modes', type=lambda x: x.split(','), default=list(MODES),
+                        help=f"Comma separated subset of {', '.join(MODES)}")
+    parser.add_argument('--requests', type=int, default=32, help='Requests sent to each configuration')
+    parser.add_argument('--port', type=int, default=5099, help='Port of the benchmarked server')
+    parser.add_argument('--micro-batch-wait-ms', type=float, default=5, help='MICRO_BATCH_WAIT_MS of the server')
+    parser.add_argument('--timeout', type=float, default=900, help='Start up and request timeout (seconds)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sampled variants')
+    parser.add_argument('--out', default=None, help='Results file (default: benchmarks/results/workers-<commit>.json)')
+    args = parser.parse_args()
+    # Settings build_payloads expects from the load generator
+    args.endpoint, args.annotation, args.distance, args.mode, args.unique = 'single', 'grch38_custom', 50, 'full', 0
+
+    results = asyncio.run(main(args))
+    path = write_results('workers', vars(args), results, args.out)
+    print(f"Results written to {path}")
@@ -1,14 +1,118 @@
-import logging
 import os
 
-from keras.models import load_model
-from pkg_resources import resource_filename
-
 # Check for ENSEMBL_TIMEOUT environment variable
 ENSEMBL_TIMEOUT = os.getenv("ENSEMBL_TIMEOUT")
 if ENSEMBL_TIMEOUT is None:
     raise EnvironmentError("Environment variable 'ENSEMBL_TIMEOUT' is not declared. Please set this variable before running the application.")
 
-logging.info("Loading SpliceAI models during start up")
-paths = ('models/spliceai{}.h5'.format(x) for x in range(1, 6))
-MODELS = [load_model(resource_filename('spliceai', x)) for x in paths]
\ No newline at end of file
+# Ensembl REST servers, connection pool size, cache of HGVS translations (entries and time to live in seconds) and
+# most variants translated in one variant_recoder request
+ENSEMBL_SERVER = os.getenv("ENSEMBL_SERVER", "https://rest.ensembl.org")
+ENSEMBL_GRCH37_SERVER = os.getenv("ENSEMBL_GRCH37_SERVER", "https://grch37.rest.ensembl.org")
+ENSEMBL_MAX_CONNECTIONS = int(os.getenv("ENSEMBL_MAX_CONNECTIONS", "10"))
+ENSEMBL_CACHE_SIZE = int(os.getenv("ENSEMBL_CACHE_SIZE", "10000"))
+ENSEMBL_CACHE_TTL = float(os.getenv("ENSEMBL_CACHE_TTL", "86400"))
+ENSEMBL_BATCH_SIZE = int(os.getenv("ENSEMBL_BATCH_SIZE", "200"))
+
+# Number of windows stacked into a single model call
+PREDICT_BATCH_SIZE = int(os.getenv("PREDICT_BATCH_SIZE", "32"))
+
+# Memory cap of the reference prediction cache (MiB) and widest reference region predicted in one window (bases)
+REF_CACHE_MB = float(os.getenv("REF_CACHE_MB", "64"))
+REF_REGION_WIDTH = int(os.getenv("REF_REGION_WIDTH", "30000"))
+
+# Custom sequences are scored in tiles of this many bases (plus flanking context), this many tiles per model call
+CUSTOM_SEQ_TILE_SIZE = int(os.getenv("CUSTOM_SEQ_TILE_SIZE", "5000"))
+CUSTOM_SEQ_TILE_BATCH = int(os.getenv("CUSTOM_SEQ_TILE_BATCH", "8"))
+
+# Scoring executor: "thread" or "process" pool, its size, how many jobs may wait for a worker, per-request deadline
+# (seconds) and the Retry-After hint (seconds) returned when the queue is full
+SCORING_EXECUTOR = os.getenv("SCORING_EXECUTOR", "thread")
+SCORING_WORKERS = int(os.getenv("SCORING_WORKERS", "2"))
+SCORING_QUEUE_SIZE = int(os.getenv("SCORING_QUEUE_SIZE", "16"))
+SCORING_TIMEOUT = float(os.getenv("SCORING_TIMEOUT", "300"))
+SCORING_RETRY_AFTER = int(os.getenv("SCORING_RETRY_AFTER", "5"))
+
+# Number of variants per chunk when streaming bulk results
+BULK_STREAM_CHUNK_SIZE = int(os.getenv("BULK_STREAM_CHUNK_SIZE", "16"))
+
+# Largest VCF accepted by /score_vcf/ (MiB, as uploaded, i.e. compressed if it is bgzipped)
+VCF_MAX_UPLOAD_MB = float(os.getenv("VCF_MAX_UPLOAD_MB", "1024"))
+
+# Micro-batching of concurrent single-variant requests (thread executor only): longest wait for a batch to fill
+# (milliseconds, 0 disables), most windows per batch and most requests being scored through the batcher. Those
+# requests are admitted against this queue rather than the scoring pool, so batches can fill under load
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", "5"))
+MICRO_BATCH_MAX_SIZE = int(os.getenv("MICRO_BATCH_MAX_SIZE", str(PREDICT_BATCH_SIZE)))
+MICRO_BATCH_QUEUE_SIZE = int(os.getenv("MICRO_BATCH_QUEUE_SIZE", "256"))
+
+# Persistent score cache: SQLite database path (unset disables the cache), size cap (MiB) and comma separated
+# databases to import entries from at start up
+SCORE_CACHE_PATH = os.getenv("SCORE_CACHE_PATH", "")
+SCORE_CACHE_MB = float(os.getenv("SCORE_CACHE_MB", "1024"))
+SCORE_CACHE_IMPORT = os.getenv("SCORE_CACHE_IMPORT", "")
+
+# Positions of a bulk request at most this many bases apart are read from precomputed score files in one query
+PRECOMPUTED_MERGE_GAP = int(os.getenv("PRECOMPUTED_MERGE_GAP", "100"))
+
+# Cache annotation TSVs compiled to flat arrays (.npz), next to each TSV or in ANNOTATION_CACHE_DIR if set, so that
+# later starts skip parsing them
+ANNOTATION_CACHE = os.getenv("ANNOTATION_CACHE", "true") == "true"
+ANNOTATION_CACHE_DIR = os.getenv("ANNOTATION_CACHE_DIR", "")
+
+# File through which the processes serving the API (uvicorn workers, a scoring process pool) pass on annotation
+# reloads to each other; unset, each server creates a temporary one, and `serve` one for all of its workers
+ANNOTATION_GENERATION_FILE = os.getenv("ANNOTATION_GENERATION_FILE", "")
+
+# Bearer token required by /reload_annotations, which is disabled while it is unset
+RELOAD_ANNOTATIONS_TOKEN = os.getenv("RELOAD_ANNOTATIONS_TOKEN", "")
+
+# Region scans (in-silico saturation mutagenesis): longest region (bases) and deadline of a scan (seconds). A scan
+# predicts three windows per position for each group of overlapping genes, about 2.5s per position on one core, so
+# the default region fits the deadline with a few overlapping genes
+SCAN_REGION_MAX_LENGTH = int(os.getenv("SCAN_REGION_MAX_LENGTH", "100"))
+SCAN_REGION_TIMEOUT = float(os.getenv("SCAN_REGION_TIMEOUT", "900"))
+
+# Bulk scoring jobs: SQLite database of the job queue and results (unset disables the job API), variants scored
+# per checkpointed chunk and how long (seconds) a worker's claim on a running job lasts unless it renews it
+JOBS_PATH = os.getenv("JOBS_PATH", "")
+JOB_CHUNK_SIZE = int(os.getenv("JOB_CHUNK_SIZE", "64"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+# Prometheus metrics at /metrics, and per-stage timings returned in a Server-Timing header to requests sending
+# X-Debug-Timing: true
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false") == "true"
+DEBUG_TIMING_HEADER = os.getenv("DEBUG_TIMING_HEADER", "false") == "true"
+
+# JSON score responses: decimal places floats are rounded to (negative keeps full precision), encodings offered for
+# compression (preferred first; zstd and br need the zstandard and brotli packages) and smallest body compressed (bytes)
+RESPONSE_FLOAT_DECIMALS = int(os.getenv("RESPONSE_FLOAT_DECIMALS", "-1"))
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "zstd,br,gzip")
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.getenv("RESPONSE_COMPRESSION_MIN_SIZE", "1024"))
+
+# Number of model files loaded at once
+MODEL_LOAD_WORKERS = int(os.getenv("MODEL_LOAD_WORKERS", "5"))
+
+# Run the five models as one compiled graph returning their average, and the precision they compute in ("float32",
+# "bfloat16" or "float16"; weights and outputs stay float32)
+FUSED_ENSEMBLE = os.getenv("FUSED_ENSEMBLE", "true") == "true"
+PREDICT_PRECISION = os.getenv("PREDICT_PRECISION", "float32")
+
+# Pad windows with N up to a multiple of this many bases, so that windows of similar lengths are predicted in one
+# batch (0 disables)
+PREDICT_LENGTH_BUCKET = int(os.getenv("PREDICT_LENGTH_BUCKET", "0"))
+
+# TensorFlow threads of each process: intra-op threads (0 divides the available cores between the server's
+# WEB_CONCURRENCY worker processes) and inter-op threads (0 lets TensorFlow decide)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+TF_INTRA_OP_THREADS = int(os.getenv("TF_INTRA_OP_THREADS", "0"))
+TF_INTER_OP_THREADS = int(os.getenv("TF_INTER_OP_THREADS", "0"))
+
+# Unix socket of a shared inference process (python -m spliceai_api.inference_server) running the models for every
+# worker process, instead of each loading its own copy, and how long to wait for it at start up (seconds)
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET", "")
+INFERENCE_CONNECT_TIMEOUT = float(os.getenv("INFERENCE_CONNECT_TIMEOUT", "300"))
+
+# The SpliceAI models. Loaded on first use, or in the background when the server starts up (see app.py)
+from spliceai_api.models import ModelSet, RemoteModels
+MODELS = RemoteModels(INFERENCE_SOCKET) if INFERENCE_SOCKET else ModelSet()
\ No newline at end of file
@@ -0,0 +1,159 @@
+import argparse
+import logging
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from spliceai_api import ANNOTATION_CACHE, ANNOTATION_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+COMPILED_SUFFIX = '.npz'
+# Bumped whenever the arrays written by `compile_annotation` change
+COMPILED_FORMAT = 1
+
+# Boundaries of transcript i are keyed as i * BOUNDARY_KEY_STRIDE + position, so that the boundaries of every
+# transcript form one sorted array searched for a whole batch of queries at once
+BOUNDARY_KEY_STRIDE = 2**32
+
+def compiled_path(annotation_file: str, cache_dir: str = ANNOTATION_CACHE_DIR) -> str:
+    """Where the compiled form of an annotation TSV is cached: next to it, or in `cache_dir` if set."""
+    if cache_dir:
+        return os.path.join(cache_dir, os.path.basename(annotation_file) + COMPILED_SUFFIX)
+    return annotation_file + COMPILED_SUFFIX
+
+def source_signature(annotation_file: str) -> np.ndarray:
+    """Format version, mtime and size of an annotation TSV, stored in its compiled form to detect when it is stale."""
+    stat = os.stat(annotation_file)
+    return np.array([COMPILED_FORMAT, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+def split_coordinates(column: pd.Series) -> tuple:
+    """
+    Comma separated coordinate lists (with or without a trailing comma) as one flat int64 array and the number of
+    coordinates in each list.
+    """
+    lists = column.fillna('').str.strip(',')
+    counts = np.where(lists == '', 0, lists.str.count(',') + 1)
+    joined = ','.join(lists[counts > 0])
+    values = np.array(joined.split(','), dtype=np.int64) if joined else np.empty(0, dtype=np.int64)
+    return values, counts
+
+def compile_annotation(annotation_file: str) -> dict:
+    """
+    Parse an annotation TSV into flat arrays: the transcript tables, exons in CSR form (the exons of transcript i
+    are `exon_starts[exon_offsets[i]:exon_offsets[i + 1]]`, 1-based, and the matching `exon_ends`), and the sorted,
+    de-duplicated exon boundaries of every transcript in the same form (`boundaries`, `boundary_offsets`), also keyed
+    by transcript for batched searches (`boundary_keys`).
+    """
+    df = pd.read_csv(annotation_file, sep='\t', dtype={'CHROM': object})
+    exon_starts, start_counts = split_coordinates(df['EXON_START'])
+    exon_ends, end_counts = split_coordinates(df['EXON_END'])
+    if not np.array_equal(start_counts, end_counts):
+        raise ValueError('EXON_START and EXON_END list different numbers of exons')
+    exon_starts += 1
+
+    n = len(df)
+    exon_offsets = np.concatenate([[0], np.cumsum(start_counts)]).astype(np.int64)
+    # Sort each transcript's starts and ends together (by transcript, then position), then drop repeats
+    transcript = np.repeat(np.arange(n, dtype=np.int64), start_counts)
+    keys = np.sort(np.concatenate([transcript, transcript]) * BOUNDARY_KEY_STRIDE +
+                   np.concatenate([exon_starts, exon_ends]))
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])] if len(keys) else keys
+    boundary_offsets = np.searchsorted(keys, np.arange(n + 1, dtype=np.int64) * BOUNDARY_KEY_STRIDE).astype(np.int64)
+
+    return {
+        'genes': df['#NAME'].to_numpy().astype(str),
+        'chroms': df['CHROM'].to_numpy().astype(str),
+        'strands': df['STRAND'].to_numpy().astype(str),
+        'tx_starts': df['TX_START'].to_numpy().astype(np.int64) + 1,
+        'tx_ends': df['TX_END'].to_numpy().astype(np.int64),
+        'exon_offsets': exon_offsets,
+        'exon_starts': exon_starts,
+        'exon_ends': exon_ends,
+        'boundary_offsets': boundary_offsets,
+        'boundaries': keys - np.repeat(np.arange(n, dtype=np.int64), np.diff(boundary_offsets)) * BOUNDARY_KEY_STRIDE,
+        'boundary_keys': keys,
+    }
+
+def write_compiled(tables: dict, path: str, signature: np.ndarray):
+    """Write compiled tables atomically, so that processes starting together never read a partial file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=COMPILED_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, signature=signature, **tables)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def read_compiled(path: str, signature: np.ndarray) -> dict:
+    """Tables of a compiled annotation, or None if it is missing, unreadable or compiled from another TSV."""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if not np.array_equal(data['signature'], signature):
+                return None
+            return {name: data[name] for name in data.files if name != 'signature'}
+    except (OSError, KeyError, ValueError) as e:
+        logger.debug(f"Cannot read compiled annotation {path}: {e}")
+        return None
+
+def load_annotation_tables(annotation_file: str, cache: bool = ANNOTATION_CACHE,
+                           cache_dir: str = ANNOTATION_CACHE_DIR) -> dict:
+    """
+    The compiled tables of an annotation TSV, from its cached compiled form when it is up to date. Otherwise the TSV
+    is compiled and, if the cache location is writable, cached for the next start.
+    """
+    if not cache:
+        return compile_annotation(annotation_file)
+
+    signature = source_signature(annotation_file)
+    path = compiled_path(annotation_file, cache_dir)
+    tables = read_compiled(path, signature)
+    if tables is not None:
+        return tables
+
+    tables = compile_annotation(annotation_file)
+    try:
+        write_compiled(tables, path, signature)
+        logger.info(f"Compiled annotation {annotation_file} to {path}")
+    except OSError as e:
+        logger.warning(f"Cannot cache compiled annotation at {path}: {e}")
+    return tables
+
+def nearest_boundaries(boundaries: np.ndarray, boundary_keys: np.ndarray, boundary_offsets: np.ndarray, idxs,
+                       positions) -> np.ndarray:
+    """
+    Distance from each position to the nearest exon boundary of its transcript (boundary - position), for arrays of
+    transcript indices and positions. Of two equally near boundaries the upstream one (negative distance) is
+    returned, as `min(np.union1d(exon_starts, exon_ends) - pos, key=abs)` does, and like it a transcript without
+    exons raises a ValueError.
+    """
+    idxs = np.asarray(idxs, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    lo, hi = boundary_offsets[idxs], boundary_offsets[idxs + 1] - 1
+    # Clipping an empty range would pick a boundary of a neighbouring transcript
+    empty = lo > hi
+    if empty.any():
+        raise ValueError(f"Transcripts without exons have no exon boundaries: {np.unique(idxs[empty]).tolist()}")
+
+    right = np.searchsorted(boundary_keys, idxs * BOUNDARY_KEY_STRIDE + positions)
+    left = np.clip(right - 1, lo, hi)
+    right = np.clip(right, lo, hi)
+
+    before, after = boundaries[left] - positions, boundaries[right] - positions
+    return np.where(np.abs(after) < np.abs(before), after, before)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile annotation TSVs ahead of time (e.g. in an image build)')
+    parser.add_argument('annotations', nargs='+', help='Annotation TSV files')
+    parser.add_argument('--cache-dir', default=ANNOTATION_CACHE_DIR,
+                        help='Directory of the compiled files (default: ANNOTATION_CACHE_DIR, or next to each TSV)')
+    args = parser.parse_args()
+    for annotation_file in args.annotations:
+        write_compiled(compile_annotation(annotation_file), compiled_path(annotation_file, args.cache_dir),
+                       source_signature(annotation_file))
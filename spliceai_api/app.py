@@ -1,21 +1,41 @@
+import asyncio
+import hmac
+import json
 import traceback
 import os
+import tempfile
 import re
-from importlib.resources import files
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from typing import Literal
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Query, Header
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, Response
 from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from requests import HTTPError
 from pydantic import BaseModel, Field
 
-from spliceai_api.exceptions import SpliceAIAPIException
-from spliceai_api.utils import score_custom_sequence, ensembl_get_genomic_coord, get_delta_scores, Record, validate_fasta, load_annotations, Annotator
-from spliceai_api import MODELS
+from spliceai_api.exceptions import SpliceAIAPIException, ScoringUnavailableException
+from spliceai_api.utils import Record, validate_fasta, load_annotations
+from spliceai_api.ensembl import EnsemblClient, EnsemblError
+from spliceai_api.registry import get_registry
+from spliceai_api.inference import REF_CACHE
+from spliceai_api.score_cache import get_score_cache
+from spliceai_api.precomputed import get_precomputed_scores
+from spliceai_api.responses import ScoreResponse
+from spliceai_api.formats import ScoreFormat, DEFAULT_SCORE_FORMAT, validate_score_format
+from spliceai_api.executor import ScoringExecutor, score_custom_sequence_job, bulk_delta_scores_job, score_variant, \
+    bulk_response, stream_bulk_delta_scores, scan_region_job
+from spliceai_api.batching import MicroBatcher
+from spliceai_api.vcf import open_vcf, read_vcf_header, stream_annotated_vcf
+from spliceai_api.jobs import JobRunner, get_job_store, FINAL_STATUSES
+from spliceai_api.metrics import InstrumentedRoute, render_metrics, render_samples
+from spliceai_api import MODELS, MICRO_BATCH_WAIT_MS, INFERENCE_SOCKET, BULK_STREAM_CHUNK_SIZE, METRICS_ENABLED, \
+    DEBUG_TIMING_HEADER, SCAN_REGION_MAX_LENGTH, SCAN_REGION_TIMEOUT, VCF_MAX_UPLOAD_MB, RELOAD_ANNOTATIONS_TOKEN
 
 # Determine the logging level based on an environment variable
 logging_level = logging.DEBUG if os.getenv("DEBUG") == "true" else logging.INFO
@@ -23,8 +43,57 @@ logging_level = logging.DEBUG if os.getenv("DEBUG") == "true" else logging.INFO
 # Configure logging
 logging.basicConfig(level=logging_level, format="%(asctime)s %(name)-12s %(funcName)-12s %(levelname)-8s %(message)s")
 
+# Set once the models and annotations are loaded and the models warmed up, see `warm_up`
+ready = threading.Event()
+warm_up_error = None
+
+def warm_up():
+    """
+    Load the models (in parallel with the annotations) and run a first prediction, so that the server is ready to
+    score at full speed. `/health/ready` reports not ready until this has finished.
+
+    With a process pool the workers score with models of their own, so the server process does not load any and
+    waits for every worker to have loaded its models instead.
+    """
+    global warm_up_error
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='warm-up') as pool:
+            annotations_loaded = pool.submit(annotators.warm)
+            if scoring.kind == 'process':
+                scoring.warm_up()
+            else:
+                MODELS.load()
+            annotations_loaded.result()
+        if scoring.kind != 'process':
+            MODELS.warm_up()
+    except Exception as e:
+        warm_up_error = str(e)
+        logging.exception("Start up failed")
+        return
+    ready.set()
+    logging.info(f"Ready to score in {time.perf_counter() - start:.2f}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background, so that the server answers /health/alive (and /health/ready with 503) meanwhile
+    warming = asyncio.ensure_future(asyncio.to_thread(warm_up))
+    if job_runner is not None:
+        job_runner.start()
+    yield
+    if job_runner is not None:
+        await job_runner.stop()
+    # Model loading cannot be interrupted, let it finish before shutting down
+    await warming
+    if batcher is not None:
+        batcher.shutdown()
+    scoring.shutdown()
+    await ensembl.aclose()
+
 version = os.getenv("VERSION","UNKNOWN")
-app = FastAPI(title="SpliceAI API",version=version)
+app = FastAPI(title="SpliceAI API",version=version,lifespan=lifespan,default_response_class=ScoreResponse)
+if METRICS_ENABLED or DEBUG_TIMING_HEADER:
+    app.router.route_class = InstrumentedRoute
 
 if os.getenv("ALLOW_ALL_ORIGIN"):
     app.add_middleware(
@@ -42,8 +111,21 @@ else:
 annotations = load_annotations()
 validate_fasta(assemblies=set([annotations[annotation]['fasta'] for annotation in annotations.keys()]))
 
+annotators = get_registry()
+score_cache = get_score_cache()
+ensembl = EnsemblClient()
+
+scoring = ScoringExecutor()
+# With a shared inference process, windows are batched there across all workers
+batcher = MicroBatcher(MODELS) if scoring.kind == 'thread' and MICRO_BATCH_WAIT_MS > 0 and not INFERENCE_SOCKET else None
+job_store = get_job_store()
+job_runner = JobRunner(job_store, scoring) if job_store is not None else None
+
 dna_pattern = re.compile("^[ATCGN]+$")
 
+# Uploads are spooled to disk in writes of about this many bytes
+UPLOAD_WRITE_SIZE = 1024 * 1024
+
 class DefaultException(Exception):
     def __init__(self, status_code: int, detail: str):
         self.status_code = status_code
@@ -60,7 +142,27 @@ async def unicorn_exception_handler(request: Request, exc: DefaultException):
         },
     )
 
-class SingleVariant(BaseModel):
+@app.exception_handler(ScoringUnavailableException)
+async def scoring_unavailable_exception_handler(request: Request, exc: ScoringUnavailableException):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={
+            "error": exc.summary,
+            "details": exc.details
+        },
+        headers={"Retry-After": str(exc.retry_after)} if exc.retry_after else None
+    )
+
+class ScoreOptions(BaseModel):
+    stats_format: Literal["records","columnar","base64","arrow"] = Field(description="Per-position stats as a list of records (default), or as a struct of arrays: JSON arrays (columnar), base64 little-endian floats (base64) or a base64 Arrow IPC stream (arrow).", default="records")
+    precision: Literal["float64","float32"] = Field(description="Float precision of columnar stats (default: float64).", default="float64")
+    mode: Literal["full","summary"] = Field(description="Return the per-position stats (full, default) or only the summary delta scores and positions (summary).", default="full")
+    top_k: int = Field(description="Also return the top_k positions of each delta score channel (default: 0, none).", default=0, ge=0)
+
+    def score_format(self) -> ScoreFormat:
+        return ScoreFormat(stats_format=self.stats_format, precision=self.precision, mode=self.mode, top_k=self.top_k)
+
+class SingleVariant(ScoreOptions):
     chrom: str
     pos: int
     ref: str
@@ -75,7 +177,7 @@ class BulkVariant(BaseModel):
     ref: str
     alt: str
 
-class BulkVariantList(BaseModel):
+class BulkVariantList(ScoreOptions):
     annotation: Literal["grch38","grch37","grch38_custom","grch37_custom"]
     distance: int = Field(description="Maximum distance between the variant and gained/lost splice site (default: 50).", default=50, gt=49, lt=10001)
     mask: int = Field(description="Mask scores representing annotated acceptor/donor gain and unannotated acceptor/donor loss (default: 0).", default=0)
@@ -90,6 +192,32 @@ class Stats(BaseModel):
     acceptor_alt: float = Field(description="OfAltered probability that this position is an acceptor")
     acceptor: float = Field(description="Difference between Altered and Reference")
 
+class ColumnarStats(BaseModel):
+    dist_from_variant: dict[str, int] = Field(description="First ('start') and last ('stop') offset from variant, one entry per offset in each stat")
+    dtype: Literal["float64","float32"] = Field(description="Float precision of the stats")
+    encoding: Literal["json","base64","arrow"] = Field(description="Encoding of the stats")
+    donor_ref: list[float] | str | None = None
+    donor_alt: list[float] | str | None = None
+    donor: list[float] | str | None = None
+    acceptor_ref: list[float] | str | None = None
+    acceptor_alt: list[float] | str | None = None
+    acceptor: list[float] | str | None = None
+    arrow: str | None = Field(description="Arrow IPC stream of all stats (arrow encoding)", default=None)
+
+class Summary(BaseModel):
+    DS_AG: float = Field(description="Delta score (acceptor gain)")
+    DS_AL: float = Field(description="Delta score (acceptor loss)")
+    DS_DG: float = Field(description="Delta score (donor gain)")
+    DS_DL: float = Field(description="Delta score (donor loss)")
+    DP_AG: int = Field(description="Delta position (acceptor gain), offset from variant")
+    DP_AL: int = Field(description="Delta position (acceptor loss), offset from variant")
+    DP_DG: int = Field(description="Delta position (donor gain), offset from variant")
+    DP_DL: int = Field(description="Delta position (donor loss), offset from variant")
+
+class TopPositions(BaseModel):
+    dist_from_variant: list[int] = Field(description="Offsets from variant, largest delta first")
+    delta: list[float] = Field(description="Delta score at each offset")
+
 class DeltaScore(BaseModel):
     gene: str
     strand: Literal["+","-"]
@@ -97,13 +225,58 @@ class DeltaScore(BaseModel):
     pos: int
     ref: str
     alt: str
-    stats: list[Stats]
+    source: Literal["model","cache","precomputed"] = Field(description="Whether the scores were predicted by the model, read from the score cache or from precomputed scores", default="model")
+    stats: list[Stats] | ColumnarStats | None = Field(description="Per-position stats (full mode)", default=None)
+    summary: Summary | None = Field(description="Summary delta scores (summary mode)", default=None)
+    top: dict[Literal["AG","AL","DG","DL"], TopPositions] | None = Field(description="Top positions of each delta score channel (top_k > 0)", default=None)
 
 class BulkVarianstResponse(BaseModel):
     input: str = Field(description="Input variant formatted as chr-pos-ref-alt")
     scores: list[DeltaScore] | None = Field(description="Delta scores for a variant. Null if there is any error")
     error: str | None = Field(description="Error message if an error is encountered, otherwise Null")
 
+class VariantList(BaseModel):
+    assembly: str = Field(description="Annotation whose assembly the variants are translated to")
+    variants: list[str] = Field(description="Variants (HGVSc, HGVSg)", max_length=1000)
+
+class GenomicCoord(BaseModel):
+    chr: str
+    pos: str
+    ref: str
+    alt: str
+
+class GenomicCoordResponse(BaseModel):
+    input: str = Field(description="Input variant")
+    coord: GenomicCoord | None = Field(description="Genomic coordinates. Null if there is any error")
+    error: str | None = Field(description="Error message if the variant could not be translated, otherwise Null")
+
+class RegionScan(BaseModel):
+    annotation: Literal["grch38","grch37","grch38_custom","grch37_custom"]
+    chrom: str
+    start: int = Field(description="First position of the region (1-based)", gt=0)
+    end: int = Field(description="Last position of the region (1-based, inclusive)", gt=0)
+    distance: int = Field(description="Maximum distance between the variant and gained/lost splice site (default: 50).", default=50, gt=49, lt=10001)
+    mask: int = Field(description="Mask scores representing annotated acceptor/donor gain and unannotated acceptor/donor loss (default: 0).", default=0)
+
+class GeneScan(BaseModel):
+    gene: str
+    strand: Literal["+","-"]
+    start: int = Field(description="First position of the region inside the gene")
+    end: int = Field(description="Last position of the region inside the gene")
+    DS_AG: list[list[float | None]] = Field(description="Delta score (acceptor gain) of each position (rows) and alternate base (columns, see alts). Null for the reference base")
+    DS_AL: list[list[float | None]] = Field(description="Delta score (acceptor loss), as DS_AG")
+    DS_DG: list[list[float | None]] = Field(description="Delta score (donor gain), as DS_AG")
+    DS_DL: list[list[float | None]] = Field(description="Delta score (donor loss), as DS_AG")
+
+class RegionScanResponse(BaseModel):
+    chrom: str
+    start: int
+    end: int
+    distance: int
+    ref: str = Field(description="Reference bases of the region")
+    alts: list[str] = Field(description="Alternate base of each column of the delta score matrices")
+    scores: list[GeneScan] = Field(description="Delta scores of every SNV of the region, for each overlapping gene")
+
 class CustomSequence(BaseModel):
     # Length constraints based on protein coding gene sizes obtained from Ensembl
     # 30 is less than the smallest gene ENSG00000289325 (length = 39)
@@ -137,12 +310,18 @@ def get_alive():
 @app.get("/health/ready")
 def get_ready():
     """
-    Endpoint to check if the API is ready for handling requests.
+    Endpoint to check if the API is ready for handling requests, i.e. its models and annotations are loaded and the
+    models warmed up.
 
     Returns:
-        dict: A dictionary with the status 'ready' to indicate the API is ready to handle requests.
+        dict: A dictionary with the status 'ready' to indicate the API is ready to handle requests, and the load
+        and warm-up times of the models. While starting up (or if start up failed) the status is 'starting' (or
+        'failed', with the error) and the response code 503.
     """
-    return {"status": "ready"}
+    if ready.is_set():
+        return {"status": "ready", "models": MODELS.stats()}
+    status = {"status": "failed", "error": warm_up_error} if warm_up_error else {"status": "starting"}
+    return JSONResponse(status_code=503, content={**status, "models": MODELS.stats()})
 
 @app.get("/get_annotations")
 async def api_get_annotations():
@@ -154,6 +333,133 @@ async def api_get_annotations():
     """
     return annotations
 
+@app.get("/get_annotator_stats")
+async def api_get_annotator_stats():
+    """
+    API endpoint to report the annotations loaded in memory.
+
+    Returns:
+        dict: Load time and memory footprint for each loaded annotation.
+    """
+    return annotators.stats()
+
+@app.get("/get_scoring_stats")
+async def api_get_scoring_stats():
+    """
+    API endpoint to report the load on the scoring executor and micro-batcher.
+
+    Returns:
+        dict: Pool size, capacity, jobs in flight and rejected or timed-out job counts, plus queue depth, batch size
+        and wait time histograms of the micro-batcher.
+    """
+    return {**scoring.stats(), 'micro_batching': batcher.stats() if batcher is not None else None}
+
+@app.get("/get_cache_stats")
+async def api_get_cache_stats():
+    """
+    API endpoint to report cache usage.
+
+    Returns:
+        dict: Size, hit and miss counts of the reference prediction cache, of the score cache (null if disabled) and
+        of the precomputed scores of each annotation that has them. With a process scoring executor, score cache
+        and precomputed score hits and misses are counted by the worker processes and are not included. Also
+        reports the cache of Ensembl HGVS translations.
+    """
+    precomputed = {name: get_precomputed_scores(name) for name in annotations.keys()}
+    return {'ref_predictions': REF_CACHE.stats(),
+            'scores': score_cache.stats() if score_cache is not None else None,
+            'precomputed': {name: scores.stats() for name, scores in precomputed.items() if scores is not None},
+            'ensembl': ensembl.stats()}
+
+def component_metrics() -> list:
+    """Exposition lines for the counters and gauges that the caches, executor and micro-batcher keep themselves."""
+    lines = []
+    ref = REF_CACHE.stats()
+    lines += render_samples('spliceai_ref_cache_lookups_total', 'counter', 'Reference prediction cache lookups',
+                            [({'result': 'hit'}, ref['hits']), ({'result': 'miss'}, ref['misses'])])
+    lines += render_samples('spliceai_ref_cache_bytes', 'gauge', 'Memory held by the reference prediction cache',
+                            [({}, ref['bytes'])])
+    if score_cache is not None:
+        scores = score_cache.stats()
+        lines += render_samples('spliceai_score_cache_lookups_total', 'counter', 'Score cache lookups',
+                                [({'result': 'hit'}, scores['hits']), ({'result': 'miss'}, scores['misses'])])
+        lines += render_samples('spliceai_score_cache_bytes', 'gauge', 'Size of the score cache',
+                                [({}, scores['bytes'])])
+        lines += render_samples('spliceai_score_cache_evictions_total', 'counter', 'Score cache entries evicted',
+                                [({}, scores['evictions'])])
+    precomputed = {name: get_precomputed_scores(name) for name in annotations.keys()}
+    lines += render_samples('spliceai_precomputed_lookups_total', 'counter', 'Precomputed score lookups',
+                            [({'annotation': name, 'result': result}, stats[result + 's'])
+                             for name, stats in ((name, x.stats()) for name, x in precomputed.items() if x is not None)
+                             for result in ('hit', 'miss')])
+    hgvs = ensembl.stats()
+    lines += render_samples('spliceai_ensembl_lookups_total', 'counter', 'HGVS translations looked up',
+                            [({'result': 'hit'}, hgvs['hits']), ({'result': 'miss'}, hgvs['misses']),
+                             ({'result': 'coalesced'}, hgvs['coalesced'])])
+    executor = scoring.stats()
+    lines += render_samples('spliceai_scoring_in_flight', 'gauge', 'Scoring jobs running or queued',
+                            [({}, executor['in_flight'])])
+    lines += render_samples('spliceai_scoring_rejected_total', 'counter', 'Scoring jobs rejected with 503',
+                            [({}, executor['rejected'])])
+    lines += render_samples('spliceai_scoring_timed_out_total', 'counter', 'Scoring jobs that timed out with 504',
+                            [({}, executor['timed_out'])])
+    if batcher is not None:
+        batching = batcher.stats()
+        lines += render_samples('spliceai_micro_batch_queue_depth', 'gauge', 'Requests waiting for a micro-batch',
+                                [({}, batching['queue_depth'])])
+        lines += render_samples('spliceai_micro_batch_rejected_total', 'counter',
+                                'Single-variant requests rejected with 503 by the micro-batcher',
+                                [({}, batching['rejected'])])
+        lines += batcher.batch_sizes.render()
+        lines += batcher.wait_times.render()
+    return lines
+
+def api_get_metrics():
+    """
+    Prometheus metrics: time spent in each scoring stage and per request, variants scored and skipped (by reason),
+    ensemble batch sizes, cache hit counts and the load on the scoring executor. Only served with
+    METRICS_ENABLED=true. With a process scoring executor, stage timings and counts of the worker processes are
+    not included.
+    """
+    return PlainTextResponse(render_metrics(component_metrics()), media_type="text/plain; version=0.0.4")
+
+if METRICS_ENABLED:
+    app.add_api_route("/metrics", api_get_metrics, methods=["GET"])
+
+@app.post("/reload_annotations")
+def api_reload_annotations(annotation: str = None, force: bool = False, authorization: str = Header(None)):
+    """
+    API endpoint to reload annotations whose annotation or FASTA file changed on disk.
+
+    Reloads reach every worker and scoring process sharing the annotation generation file. The endpoint is
+    disabled unless RELOAD_ANNOTATIONS_TOKEN is set, and then requires it as a bearer token.
+
+    Parameters:
+    - annotation (str): Annotation to reload. All loaded annotations if omitted.
+    - force (bool): Reload even if the files are unchanged.
+
+    Returns:
+    - dict: The annotations that were reloaded and the current annotation stats.
+    """
+    if not RELOAD_ANNOTATIONS_TOKEN:
+        raise DefaultException(status_code=403, detail=jsonable_encoder(
+            {'summary':'Reloading annotations is disabled',
+             'details':'Set RELOAD_ANNOTATIONS_TOKEN to enable /reload_annotations'}))
+    if not hmac.compare_digest((authorization or '').encode(), f"Bearer {RELOAD_ANNOTATIONS_TOKEN}".encode()):
+        raise DefaultException(status_code=401, detail=jsonable_encoder(
+            {'summary':'Invalid token',
+             'details':'/reload_annotations requires the header Authorization: Bearer <RELOAD_ANNOTATIONS_TOKEN>'}))
+    try:
+        reloaded = annotators.reload(annotation, force=force)
+    except SpliceAIAPIException as e:
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':e.summary,
+             'details':e.details}))
+    if score_cache is not None:
+        for name in reloaded:
+            score_cache.clear(name)
+    return {'reloaded': reloaded, 'annotations': annotators.stats()}
+
 @app.post("/score_custom_seq/")
 async def api_score_custom_seq(custom_sequence: CustomSequence):
     """
@@ -172,7 +478,8 @@ async def api_score_custom_seq(custom_sequence: CustomSequence):
         raise DefaultException(status_code=400, detail=jsonable_encoder(
             {'summary':'DNA string must contain ATCG',
              'details':f"Entered sequence must contain ATCG and not be blank"}))
-    return score_custom_sequence(custom_sequence.seq, models=MODELS)
+    # Numpy arrays: rendered by ScoreResponse rather than converted element by element
+    return ScoreResponse(content=await scoring.run(score_custom_sequence_job, custom_sequence.seq))
 
 
 @app.get("/get_genomic_coord/{assembly}/{variant}")
@@ -192,18 +499,47 @@ async def api_get_genomic_coord(variant: str, assembly: str = 'grch38') -> dict:
              'details':f"{assembly} is not a valid assembly"}))
 
     try:
-        gcoord = ensembl_get_genomic_coord(variant=variant, assembly=annotations[assembly]['assembly'])
+        gcoord = await ensembl.get_genomic_coord(variant=variant, assembly=annotations[assembly]['assembly'])
         return(gcoord)
-    except HTTPError as e:
-        raise HTTPException(status_code=e.response.status_code, detail=jsonable_encoder(
+    except EnsemblError as e:
+        raise HTTPException(status_code=e.status_code, detail=jsonable_encoder(
             {'summary':'Encountered error while translating variant',
-             'details': e.response.json()['error']}))
+             'details': e.details}))
     except Exception as e:
         raise DefaultException(status_code=500, detail=jsonable_encoder(
             {'summary':'Encountered error while translating variant',
              'details':e.__doc__}))
         
-@app.post("/get_delta_scores/")
+@app.post("/get_genomic_coords/")
+async def api_get_genomic_coords(variants: VariantList) -> list[GenomicCoordResponse]:
+    """
+    API endpoint to obtain genomic coordinates for a list of variants.
+
+    Variants are translated by Ensembl's variant_recoder in batches, so a list of variants costs a single request per batch rather than one per variant. Translations are cached.
+
+    Parameters:
+    - variants (VariantList): Assembly and list of variants (HGVSc, HGVSg).
+
+    Returns:
+    - A list with, for each variant, its genomic coordinates or the error encountered while translating it.
+    """
+    if variants.assembly not in annotations.keys():
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':'Invalid assembly',
+             'details':f"{variants.assembly} is not a valid assembly"}))
+
+    try:
+        results = await ensembl.translate(variants.variants, assembly=annotations[variants.assembly]['assembly'])
+    except Exception as e:
+        raise DefaultException(status_code=500, detail=jsonable_encoder(
+            {'summary':'Encountered error while translating variants',
+             'details':e.__doc__}))
+
+    return [{'input': variant, 'coord': None, 'error': result.details} if isinstance(result, EnsemblError)
+            else {'input': variant, 'coord': result, 'error': None}
+            for variant, result in zip(variants.variants, results)]
+
+@app.post("/get_delta_scores/", response_model_exclude_unset=True)
 async def api_get_delta_scores(variant: SingleVariant) -> list[DeltaScore]:
     """
     Calculate SpliceAI delta scores for a specified single nucleotide variant.
@@ -221,16 +557,14 @@ async def api_get_delta_scores(variant: SingleVariant) -> list[DeltaScore]:
     """
     record = Record(chrom=variant.chrom, pos=variant.pos, ref=variant.ref, alts=[variant.alt])
 
-    annotation_file = None
-
-    if variant.annotation in ['grch37','grch38']:
-        annotation_file = variant.annotation
-    else:
-        annotation_file = files("spliceai_api.annotations").joinpath(f"{variant.annotation}.txt")
-
     try:
-        ann = Annotator(os.getenv(annotations[variant.annotation]['fasta']), annotation_file)
-        return get_delta_scores(record, ann, variant.distance, variant.mask, models=MODELS)
+        validate_score_format(variant.score_format())
+        scores = await score_variant(scoring, batcher, variant.annotation, record, variant.distance, variant.mask,
+                                     variant.score_format())
+        # Other formats are already serialisable; skip re-validating them element by element
+        return scores if variant.score_format() == DEFAULT_SCORE_FORMAT else ScoreResponse(content=scores)
+    except ScoringUnavailableException:
+        raise
     except SpliceAIAPIException as e:
         raise DefaultException(status_code=400, detail=jsonable_encoder(
             {'summary':e.summary,
@@ -241,43 +575,269 @@ async def api_get_delta_scores(variant: SingleVariant) -> list[DeltaScore]:
             {'summary':'Encountered error while calculating SpliceAI scores',
              'details':e.__doc__}))
     
-@app.post("/get_bulk_delta_scores/")
-async def api_get_bulk_delta_scores(variants: BulkVariantList) -> list[BulkVarianstResponse]:
+@app.post("/get_bulk_delta_scores/", response_model=list[BulkVarianstResponse], response_model_exclude_unset=True)
+async def api_get_bulk_delta_scores(variants: BulkVariantList, request: Request, stream: bool = False,
+                                    order: Literal["input","completion"] = "input"):
     """
     API endpoint to calculate delta scores for a list of variants.
 
     Accepts a list of variants and their annotations to calculate SpliceAI delta scores in bulk. Each variant in the list is scored, and the response includes the input details and the calculated scores or an error message if applicable.
 
+    When streaming is requested (`stream=true` or an `Accept: application/x-ndjson` header), results are sent as newline-delimited JSON, one line per variant, as soon as each chunk of variants has been scored. Each line also carries the `index` of the variant in the request. With `order=completion` chunks are sent in the order they finish rather than in input order.
+
     Parameters:
     - variants (BulkVariantList): A list of variants along with annotation details.
+    - stream (bool): Stream results as NDJSON.
+    - order (str): 'input' or 'completion' order of streamed results.
 
     Returns:
     - A list of dictionaries, each containing the input variant details, calculated scores, and any error encountered during processing.
     """
-    annotation_file = None
+    records = [Record(chrom=variant.chrom, pos=variant.pos, ref=variant.ref, alts=[variant.alt]) for variant in variants.variants]
+    inputs = [f"{variant.chrom}-{variant.pos}-{variant.ref}-{variant.alt}" for variant in variants.variants]
 
-    if variants.annotation in ['grch37','grch38']:
-        annotation_file = variants.annotation
-    else:
-        annotation_file = files("spliceai_api.annotations").joinpath(f"{variants.annotation}.txt")
+    try:
+        validate_score_format(variants.score_format())
+    except SpliceAIAPIException as e:
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':e.summary,
+             'details':e.details}))
 
-    responses = []
+    if stream or "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_bulk_delta_scores(scoring, variants.annotation, records, inputs, variants.distance, variants.mask, order,
+                                     variants.score_format()),
+            media_type="application/x-ndjson")
 
-    for variant in variants.variants:
-        try:
-            record = Record(chrom=variant.chrom, pos=variant.pos, ref=variant.ref, alts=[variant.alt])
-            ann = Annotator(os.getenv(annotations[variants.annotation]['fasta']), annotation_file)
+    try:
+        results = await scoring.run(bulk_delta_scores_job, variants.annotation, records, variants.distance, variants.mask,
+                                    variants.score_format())
+    except ScoringUnavailableException:
+        raise
+    except Exception as e:
+        results = [e] * len(variants.variants)
 
-            input = f"{variant.chrom}-{variant.pos}-{variant.ref}-{variant.alt}"   
-            scores = get_delta_scores(record, ann, variants.distance, variants.mask, models=MODELS)
-            error = None
-        
-        except Exception as e:
-            input = f"{variant.chrom}-{variant.pos}-{variant.ref}-{variant.alt}"   
-            scores = None
-            error = f"Error encountered: {str(e)}"
-            
-        response = {'input': input, 'scores': scores, 'error': error}
-        responses.append(response)
-
-    return responses
\ No newline at end of file
+    responses = [bulk_response(input, result) for input, result in zip(inputs, results)]
+    # Other formats are already serialisable; skip re-validating them element by element
+    return responses if variants.score_format() == DEFAULT_SCORE_FORMAT else ScoreResponse(content=responses)
+
+@app.post("/scan_region/", response_model=RegionScanResponse)
+async def api_scan_region(region: RegionScan):
+    """
+    Score every possible SNV of a genomic region (in-silico saturation mutagenesis).
+
+    The reference is read and predicted once per gene for the whole region, rather than once per variant as
+    separate `/get_delta_scores/` requests would. For each gene overlapping the region, the delta scores are
+    returned as matrices with one row per position and one column per alternate base.
+
+    Parameters:
+        region (RegionScan): The annotation, chromosome, first and last (1-based, inclusive) positions of the region,
+            at most SCAN_REGION_MAX_LENGTH bases, and the distance and mask options of `/get_delta_scores/`.
+
+    Returns:
+        RegionScanResponse: The region's reference bases and the DS_AG, DS_AL, DS_DG and DS_DL matrices of each gene.
+    """
+    length = region.end - region.start + 1
+    if length < 1 or length > SCAN_REGION_MAX_LENGTH:
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':'Invalid region',
+             'details':f"The region must span 1 to {SCAN_REGION_MAX_LENGTH} bases, not {length}"}))
+
+    try:
+        # The scan stops at its deadline too, rather than holding a scoring worker after the request timed out
+        result = await scoring.run(scan_region_job, region.annotation, region.chrom, region.start, region.end,
+                                   region.distance, region.mask, time.time() + SCAN_REGION_TIMEOUT,
+                                   timeout=SCAN_REGION_TIMEOUT)
+        # Skip re-validating the matrices element by element
+        return ScoreResponse(content=result)
+    except ScoringUnavailableException:
+        raise
+    except SpliceAIAPIException as e:
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':e.summary,
+             'details':e.details}))
+    except Exception as e:
+        traceback.print_exc()
+        raise DefaultException(status_code=500, detail=jsonable_encoder(
+            {'summary':'Encountered error while calculating SpliceAI scores',
+             'details':e.__doc__}))
+
+@app.post("/score_vcf/")
+async def api_score_vcf(request: Request, annotation: Literal["grch38","grch37","grch38_custom","grch37_custom"],
+                        distance: int = Query(description="Maximum distance between the variant and gained/lost splice site (default: 50).", default=50, gt=49, lt=10001),
+                        mask: int = Query(description="Mask scores representing annotated acceptor/donor gain and unannotated acceptor/donor loss (default: 0).", default=0)):
+    """
+    Annotate a VCF with SpliceAI delta scores.
+
+    The request body is a VCF file, plain or gzip/bgzip compressed. The file is read and scored in chunks of variants, and streamed back as an (uncompressed) VCF with a `SpliceAI` INFO field in the format of the SpliceAI command line tool: ALLELE|SYMBOL|DS_AG|DS_AL|DS_DG|DS_DL|DP_AG|DP_AL|DP_DG|DP_DL. Multi-allelic records are scored for every alternate allele. Records that cannot be scored are returned unchanged.
+
+    Parameters:
+    - annotation (str): Gene annotation to score against.
+    - distance (int): Maximum distance between the variant and gained/lost splice site.
+    - mask (int): Mask scores representing annotated acceptor/donor gain and unannotated acceptor/donor loss.
+
+    Returns:
+    - The annotated VCF (text/x-vcf).
+    """
+    if annotation not in annotators.annotations:
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':'Annotation not available',
+             'details':f"{annotation} is not a configured annotation"}))
+
+    max_bytes = int(VCF_MAX_UPLOAD_MB * 1024 * 1024)
+    too_large = DefaultException(status_code=413, detail=jsonable_encoder(
+        {'summary':'VCF too large',
+         'details':f"Uploads are limited to {VCF_MAX_UPLOAD_MB:g} MiB"}))
+    if int(request.headers.get('content-length') or 0) > max_bytes:
+        raise too_large
+
+    # Spool the upload to disk so that memory use does not depend on the size of the file. Disk writes, and reading
+    # (and decompressing) the header, run on threads so that the event loop keeps serving other requests
+    upload = tempfile.TemporaryFile()
+    try:
+        size = buffered = 0
+        blocks = []
+        async for block in request.stream():
+            size += len(block)
+            if size > max_bytes:
+                upload.close()
+                raise too_large
+            blocks.append(block)
+            buffered += len(block)
+            if buffered >= UPLOAD_WRITE_SIZE:
+                await asyncio.to_thread(upload.write, b''.join(blocks))
+                blocks, buffered = [], 0
+        await asyncio.to_thread(upload.write, b''.join(blocks))
+        upload.seek(0)
+        lines = await asyncio.to_thread(open_vcf, upload)
+        header = await asyncio.to_thread(read_vcf_header, lines)
+    except SpliceAIAPIException as e:
+        upload.close()
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':e.summary,
+             'details':e.details}))
+    except (OSError, EOFError, UnicodeDecodeError) as e:
+        upload.close()
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':'Invalid VCF',
+             'details':str(e)}))
+
+    return StreamingResponse(
+        stream_annotated_vcf(scoring, annotation, header, lines, distance, mask, BULK_STREAM_CHUNK_SIZE),
+        media_type="text/x-vcf")
+
+def require_jobs():
+    if job_store is None:
+        raise DefaultException(status_code=404, detail=jsonable_encoder(
+            {'summary':'Jobs not available',
+             'details':'The job API is disabled, set JOBS_PATH to enable it'}))
+
+def get_job_status(job_id: str) -> dict:
+    """The status of a job, raising a 404 if the job API is disabled or there is no such job."""
+    require_jobs()
+    status = job_store.status(job_id)
+    if status is None:
+        raise DefaultException(status_code=404, detail=jsonable_encoder(
+            {'summary':'Job not found',
+             'details':f"There is no job {job_id}"}))
+    return status
+
+@app.post("/jobs/", status_code=202)
+async def api_submit_job(variants: BulkVariantList):
+    """
+    Submit a bulk scoring job.
+
+    Takes the same request as `/get_bulk_delta_scores/`, but returns straight away with the status of the queued job instead of waiting for its scores. Jobs are kept in a SQLite database (`JOBS_PATH`) and scored a chunk of variants at a time in the background; a server restart resumes them from their last completed chunk. Poll `/jobs/{job_id}` for progress and page through `/jobs/{job_id}/results` for scores, which are available as soon as each chunk has been scored.
+
+    Parameters:
+    - variants (BulkVariantList): A list of variants along with annotation details.
+
+    Returns:
+    - The status of the job, see `/jobs/{job_id}`.
+    """
+    require_jobs()
+    if variants.annotation not in annotators.annotations:
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':'Annotation not available',
+             'details':f"{variants.annotation} is not a configured annotation"}))
+    try:
+        validate_score_format(variants.score_format())
+    except SpliceAIAPIException as e:
+        raise DefaultException(status_code=400, detail=jsonable_encoder(
+            {'summary':e.summary,
+             'details':e.details}))
+
+    status = await asyncio.to_thread(job_store.submit, variants.annotation,
+                                     [(v.chrom, v.pos, v.ref, v.alt) for v in variants.variants],
+                                     variants.distance, variants.mask, variants.score_format())
+    job_runner.notify()
+    return status
+
+@app.get("/jobs/")
+async def api_list_jobs(status: Literal["queued","running","done","failed","cancelled"] = None,
+                        limit: int = Query(default=100, gt=0, le=1000)):
+    """
+    List the most recently submitted jobs, optionally only those with a given status.
+
+    Returns:
+    - A list of job statuses, see `/jobs/{job_id}`.
+    """
+    require_jobs()
+    return await asyncio.to_thread(job_store.list, status, limit)
+
+@app.get("/jobs/{job_id}")
+async def api_get_job(job_id: str):
+    """
+    Status and progress of a job.
+
+    Returns:
+    - The job's status (queued, running, done, failed or cancelled), its number of variants (`total`), how many have been scored (`done`) and how many of those failed (`errors`), the fraction done (`progress`), the scoring throughput (`variants_per_s`) and estimated time to completion in seconds (`eta_s`), and its submission, start and end times.
+    """
+    return await asyncio.to_thread(get_job_status, job_id)
+
+@app.get("/jobs/{job_id}/results")
+async def api_get_job_results(job_id: str, offset: int = Query(default=0, ge=0),
+                              limit: int = Query(default=1000, gt=0, le=10000)):
+    """
+    Page through the scores of a job, including a job that is still running.
+
+    Parameters:
+    - offset (int): Index of the first variant to return.
+    - limit (int): Most variants to return.
+
+    Returns:
+    - The job's status, the `results` of the variants from `offset` on that have been scored, each as in `/get_bulk_delta_scores/` plus the `index` of the variant in the job, and the `next_offset` to request (null once all variants have been returned).
+    """
+    status = await asyncio.to_thread(get_job_status, job_id)
+    rows = await asyncio.to_thread(job_store.results, job_id, offset, limit)
+    # A cancelled or failed job stops short of its total: its results end at the variants done
+    end = status['done'] if status['status'] in FINAL_STATUSES else status['total']
+    next_offset = offset + len(rows) if offset + len(rows) < end else None
+    # Results are stored as JSON, send them as they are rather than parsing and re-serialising them
+    body = json.dumps({'status': status, 'offset': offset, 'next_offset': next_offset})[:-1] + \
+        ', "results": [' + ','.join(result for _, result in rows) + ']}'
+    return Response(content=body, media_type="application/json")
+
+@app.post("/jobs/{job_id}/cancel")
+async def api_cancel_job(job_id: str):
+    """
+    Cancel a queued or running job. The results scored so far are kept.
+
+    Returns:
+    - The status of the job.
+    """
+    await asyncio.to_thread(get_job_status, job_id)
+    await asyncio.to_thread(job_store.cancel, job_id)
+    return await asyncio.to_thread(get_job_status, job_id)
+
+@app.delete("/jobs/{job_id}")
+async def api_delete_job(job_id: str):
+    """
+    Delete a job and its results, cancelling it if it is still queued or running.
+
+    Returns:
+    - dict: The id of the deleted job.
+    """
+    await asyncio.to_thread(get_job_status, job_id)
+    await asyncio.to_thread(job_store.delete, job_id)
+    return {"deleted": job_id}
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+
+from spliceai_api import MICRO_BATCH_WAIT_MS, MICRO_BATCH_MAX_SIZE, MICRO_BATCH_QUEUE_SIZE, SCORING_RETRY_AFTER
+from spliceai_api.exceptions import ScoringUnavailableException
+from spliceai_api.inference import predict_windows
+from spliceai_api.metrics import Histogram, BATCH_SIZE_BUCKETS, WAIT_TIME_BUCKETS_MS
+
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """
+    Collects windows from concurrent requests and predicts them together.
+
+    Requests submit the windows they need predicted and get a future back. A background thread takes the first
+    pending submission, keeps collecting for up to `max_wait` seconds (or until `max_batch` windows are pending),
+    runs one batched prediction per ensemble member over everything collected and resolves each future with its
+    own slice of the predictions.
+
+    Requests scored through the batcher are admitted by `admit`, which bounds them by `max_queue` rather than by
+    the capacity of the scoring pool, so that enough of them are in flight to fill batches.
+    """
+
+    def __init__(self, models: list, max_wait: float = MICRO_BATCH_WAIT_MS / 1000,
+                 max_batch: int = MICRO_BATCH_MAX_SIZE, max_queue: int = MICRO_BATCH_QUEUE_SIZE):
+        self.models = models
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.pending = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.batch_sizes = Histogram('spliceai_micro_batch_size', 'Windows per micro-batch', (), BATCH_SIZE_BUCKETS)
+        self.wait_times = Histogram('spliceai_micro_batch_wait_ms', 'Time requests waited for a micro-batch (ms)', (),
+                                    WAIT_TIME_BUCKETS_MS)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, windows: list) -> Future:
+        """Queue windows for prediction. The future resolves to their predictions, as from `predict_windows`."""
+        future = Future()
+        if not windows:
+            future.set_result([])
+            return future
+
+        with self._lock:
+            if self.pending >= self.max_queue:
+                raise ScoringUnavailableException(503, 'Server busy',
+                                                  f"{self.pending} requests are waiting for prediction, retry later",
+                                                  retry_after=SCORING_RETRY_AFTER)
+            self.pending += 1
+
+        self._queue.put((time.perf_counter(), windows, future))
+        return future
+
+    @asynccontextmanager
+    async def admit(self):
+        """
+        Admit a request for the whole of its scoring.
+
+        Raises:
+            ScoringUnavailableException: 503 if `max_queue` requests are already being scored through the batcher.
+        """
+        with self._lock:
+            if self.admitted >= self.max_queue:
+                self.rejected += 1
+                raise ScoringUnavailableException(503, 'Server busy',
+                                                  f"{self.admitted} requests are waiting for prediction, retry later",
+                                                  retry_after=SCORING_RETRY_AFTER)
+            self.admitted += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.admitted -= 1
+
+    async def predict(self, windows: list) -> list:
+        return await asyncio.wrap_future(self.submit(windows))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            size = len(item[1])
+            deadline = item[0] + self.max_wait
+
+            while size < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+                size += len(item[1])
+
+            self._flush(batch)
+
+    def _flush(self, batch: list):
+        start = time.perf_counter()
+        with self._lock:
+            self.pending -= len(batch)
+        # Requests that gave up (e.g. timed out) while waiting cancel their future: skip their windows
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        self.batch_sizes.observe(sum(len(windows) for _, windows, _ in batch))
+        for submitted, _, _ in batch:
+            self.wait_times.observe((start - submitted) * 1000)
+
+        try:
+            predictions = predict_windows([x for _, windows, _ in batch for x in windows], self.models, self.max_batch)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        offset = 0
+        for _, windows, future in batch:
+            future.set_result(predictions[offset:offset + len(windows)])
+            offset += len(windows)
+
+    def stats(self) -> dict:
+        return {
+            'max_wait_ms': self.max_wait * 1000,
+            'max_batch': self.max_batch,
+            'queue_depth': self.pending,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'batch_size': self.batch_sizes.to_dict(),
+            'wait_time_ms': self.wait_times.to_dict()
+        }
+
+    def shutdown(self):
+        self._queue.put(None)
@@ -0,0 +1,105 @@
+import numpy as np
+
+N_CODE = ord('N')
+
+def build_one_hot_table() -> np.ndarray:
+    """
+    One-hot rows for every byte value, matching `spliceai.utils.one_hot_encode`: A, C, G and T (either case) are
+    one-hot, N is all zeros and any other character gets the row `one_hot_encode` gives it (its code modulo 5).
+    """
+    rows = np.array([[0, 0, 0, 0], [1, 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]], dtype=np.float32)
+    codes = {'A': 1, 'C': 2, 'G': 3, 'T': 4, 'N': 0}
+    table = np.empty((256, 4), dtype=np.float32)
+    for b in range(256):
+        # one_hot_encode upper cases ASCII and reads the bytes as int8, so bytes beyond ASCII wrap around
+        c = chr(b).upper() if b < 128 else None
+        table[b] = rows[codes[c] if c in codes else (ord(c) if c else b - 256) % 5]
+    return table
+
+ONE_HOT = build_one_hot_table()
+# Reverse strand lookups read the bases backwards through the complemented table (A<->T, C<->G)
+ONE_HOT_COMPLEMENT = np.ascontiguousarray(ONE_HOT[:, ::-1])
+
+def sequence_codes(seq) -> np.ndarray:
+    """
+    The bases of a sequence as a uint8 array: the zero-copy view of a packed genome slice, or the bytes of a
+    pyfaidx sequence or string.
+    """
+    view = getattr(seq, 'view', None)
+    if isinstance(view, np.ndarray):
+        return view
+    if not isinstance(seq, (str, bytes)):
+        seq = seq.seq
+    if isinstance(seq, str):
+        seq = seq.encode('latin-1', errors='replace')
+    return np.frombuffer(seq, dtype=np.uint8)
+
+class Window:
+    """
+    A model input window kept as uint8 bases in forward genomic orientation, one-hot encoded only when it is
+    written into a batch. Reverse strand windows are encoded reverse complemented.
+    """
+    __slots__ = ('codes', 'reverse')
+
+    def __init__(self, codes: np.ndarray, reverse: bool = False):
+        self.codes = codes
+        self.reverse = reverse
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self.codes), 4)
+
+    def encode(self, out: np.ndarray = None) -> np.ndarray:
+        """One-hot encode the window into `out` (float32, shape (length, 4)), or a new array."""
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+        if self.reverse:
+            np.take(ONE_HOT_COMPLEMENT, self.codes[::-1], axis=0, out=out)
+        else:
+            np.take(ONE_HOT, self.codes, axis=0, out=out)
+        return out
+
+def padded_window(codes: np.ndarray, pad_left: int, pad_right: int, reverse: bool = False) -> Window:
+    """A copy of `codes` with `pad_left` and `pad_right` bases at either end replaced by N."""
+    window = codes.copy()
+    window[:pad_left] = N_CODE
+    window[len(window)-pad_right:] = N_CODE
+    return Window(window, reverse)
+
+def substituted_window(window: Window, pos: int, ref_len: int, alt: str) -> Window:
+    """`window` with the `ref_len` bases at `pos` replaced by `alt`."""
+    codes = window.codes
+    alt_codes = sequence_codes(alt)
+    if len(alt_codes) == ref_len:
+        codes = codes.copy()
+        codes[pos:pos+ref_len] = alt_codes
+    else:
+        codes = np.concatenate([codes[:pos], alt_codes, codes[pos+ref_len:]])
+    return Window(codes, window.reverse)
+
+def encode_batch(windows: list, out: np.ndarray = None, length: int = None) -> np.ndarray:
+    """
+    One-hot encode windows into a float32 batch of shape (len(windows), length, 4). Windows may be `Window`s or
+    already one-hot encoded arrays, of equal length or, if `length` is given, at most `length` bases: shorter
+    windows are centred in the batch and padded with N (see `centring_offset`).
+    """
+    if length is None:
+        length = windows[0].shape[0]
+    if out is None:
+        out = np.empty((len(windows), length, 4), dtype=np.float32)
+    for k, window in enumerate(windows):
+        row = out[k]
+        if window.shape[0] != length:
+            offset = centring_offset(window.shape[0], length)
+            row[:offset] = 0
+            row[offset + window.shape[0]:] = 0
+            row = row[offset:offset + window.shape[0]]
+        if isinstance(window, Window):
+            window.encode(row)
+        else:
+            row[:] = window
+    return out
+
+def centring_offset(window_length: int, length: int) -> int:
+    """Offset of a window of `window_length` bases centred in `length` bases."""
+    return (length - window_length) // 2
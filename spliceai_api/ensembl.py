@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+
+from spliceai_api import ENSEMBL_TIMEOUT, ENSEMBL_SERVER, ENSEMBL_GRCH37_SERVER, ENSEMBL_MAX_CONNECTIONS, \
+    ENSEMBL_CACHE_SIZE, ENSEMBL_CACHE_TTL, ENSEMBL_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+class EnsemblError(Exception):
+    """A variant that Ensembl could not translate, with the HTTP status and error message of its response."""
+
+    def __init__(self, status_code: int, details: str):
+        super().__init__(details)
+        self.status_code = status_code
+        self.details = details
+
+def parse_vcf_string(vcf_string: str) -> dict:
+    chrom, pos, ref, alt = vcf_string.split('-')
+    return {'chr': chrom, 'pos': pos, 'ref': ref, 'alt': alt}
+
+def response_error(resp: httpx.Response) -> EnsemblError:
+    try:
+        details = resp.json()['error']
+    except Exception:
+        details = resp.text or resp.reason_phrase
+    return EnsemblError(resp.status_code, details)
+
+class EnsemblClient:
+    """
+    Translates HGVS notations to genomic coordinates with Ensembl's variant_recoder.
+
+    Requests share a pooled async HTTP client. Successful translations are cached for `cache_ttl` seconds (at
+    most `cache_size` of them, least recently used first out), and concurrent lookups of the same variant share
+    one request to Ensembl. Batches of variants are translated with the POST endpoint, `batch_size` per request.
+    """
+
+    def __init__(self, servers: dict = None, timeout: float = float(ENSEMBL_TIMEOUT),
+                 max_connections: int = ENSEMBL_MAX_CONNECTIONS, cache_size: int = ENSEMBL_CACHE_SIZE,
+                 cache_ttl: float = ENSEMBL_CACHE_TTL, batch_size: int = ENSEMBL_BATCH_SIZE, transport=None):
+        self.servers = servers or {'grch37': ENSEMBL_GRCH37_SERVER, 'grch38': ENSEMBL_SERVER}
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.batch_size = batch_size
+        self.client = httpx.AsyncClient(timeout=timeout, transport=transport,
+                                        headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+                                        limits=httpx.Limits(max_connections=max_connections))
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.requests = 0
+        self._cache = OrderedDict()
+        self._in_flight = {}
+
+    def _cached(self, key: tuple) -> dict:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires, coord = entry
+        if expires < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return coord
+
+    def _store(self, key: tuple, coord: dict):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, coord)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _fetch_one(self, server: str, variant: str) -> dict:
+        self.requests += 1
+        resp = await self.client.get(f"{server}/variant_recoder/human/{variant}",
+                                     params={'fields': 'None', 'vcf_string': 1})
+        if not resp.is_success:
+            raise response_error(resp)
+        resp_json = resp.json()
+        return parse_vcf_string(resp_json[0][list(resp_json[0].keys())[0]]['vcf_string'][0])
+
+    async def _fetch_batch(self, server: str, variants: list) -> dict:
+        self.requests += 1
+        resp = await self.client.post(f"{server}/variant_recoder/human", params={'fields': 'None', 'vcf_string': 1},
+                                      json={'ids': variants})
+        if not resp.is_success:
+            error = response_error(resp)
+            return {variant: error for variant in variants}
+
+        results = {}
+        for item in resp.json():
+            for allele in item.values():
+                if not isinstance(allele, dict) or allele.get('input') in results:
+                    continue
+                if allele.get('vcf_string'):
+                    results[allele['input']] = parse_vcf_string(allele['vcf_string'][0])
+        return {variant: results.get(variant, EnsemblError(400, f"No genomic coordinates found for {variant}"))
+                for variant in variants}
+
+    async def _fetch(self, assembly: str, variants: list) -> dict:
+        """Translations (or EnsemblErrors) of variants that are neither cached nor in flight."""
+        server = self.servers.get(assembly, self.servers['grch38'])
+        if len(variants) == 1:
+            try:
+                return {variants[0]: await self._fetch_one(server, variants[0])}
+            except EnsemblError as e:
+                return {variants[0]: e}
+
+        chunks = [variants[k:k + self.batch_size] for k in range(0, len(variants), self.batch_size)]
+        results = {}
+        for chunk_results in await asyncio.gather(*(self._fetch_batch(server, chunk) for chunk in chunks)):
+            results.update(chunk_results)
+        return results
+
+    def _resolve(self, assembly: str, fetched: dict):
+        for variant, result in fetched.items():
+            key = (assembly, variant)
+            if isinstance(result, dict):
+                self._store(key, result)
+            self._in_flight.pop(key).set_result(result)
+
+    async def translate(self, variants: list, assembly: str = 'grch38') -> list:
+        """
+        Genomic coordinates ('chr', 'pos', 'ref', 'alt') of each variant, or the EnsemblError it failed with.
+
+        Raises:
+            httpx.HTTPError: If Ensembl could not be reached.
+        """
+        results = {}
+        waiting = {}
+        owned = []
+
+        for variant in dict.fromkeys(variants):
+            key = (assembly, variant)
+            coord = self._cached(key)
+            if coord is not None:
+                self.hits += 1
+                results[variant] = coord
+            elif key in self._in_flight:
+                self.coalesced += 1
+                waiting[variant] = self._in_flight[key]
+            else:
+                self.misses += 1
+                future = asyncio.get_running_loop().create_future()
+                self._in_flight[key] = future
+                waiting[variant] = future
+                owned.append(variant)
+
+        if owned:
+            try:
+                fetched = await self._fetch(assembly, owned)
+            except asyncio.CancelledError:
+                # Release requests waiting on this lookup rather than leaving them hanging
+                self._resolve(assembly, {variant: RuntimeError('Ensembl lookup was cancelled') for variant in owned})
+                raise
+            except Exception as e:
+                fetched = {variant: e for variant in owned}
+            self._resolve(assembly, fetched)
+
+        for variant, future in waiting.items():
+            results[variant] = await asyncio.shield(future)
+
+        # Errors other than Ensembl's responses (e.g. timeouts) are raised rather than returned
+        for result in results.values():
+            if isinstance(result, Exception) and not isinstance(result, EnsemblError):
+                raise result
+        return [results[variant] for variant in variants]
+
+    async def get_genomic_coord(self, variant: str, assembly: str = 'grch38') -> dict:
+        """
+        Genomic coordinates ('chr', 'pos', 'ref', 'alt') of a variant.
+
+        Raises:
+            EnsemblError: If Ensembl could not translate the variant.
+        """
+        result = (await self.translate([variant], assembly))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'entries': len(self._cache),
+            'max_entries': self.cache_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'requests': self.requests,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -7,4 +7,16 @@ class SpliceAIAPIException(Exception):
  
     # __str__ is to print() the value
     def __str__(self):
-        return(f"{repr(self.summary)} ({repr(self.details)})")
\ No newline at end of file
+        return(f"{repr(self.summary)} ({repr(self.details)})")
+
+class ScoringUnavailableException(Exception):
+    """Raised when a scoring job cannot be admitted or does not finish before its deadline."""
+
+    def __init__(self, status_code: int, summary: str, details: str = None, retry_after: int = None):
+        self.status_code = status_code
+        self.summary = summary
+        self.details = details
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return(f"{repr(self.summary)} ({repr(self.details)})")
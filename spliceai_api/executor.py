@@ -0,0 +1,398 @@
+import asyncio
+import contextvars
+import json
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+from spliceai_api import SCORING_EXECUTOR, SCORING_WORKERS, SCORING_QUEUE_SIZE, SCORING_TIMEOUT, SCORING_RETRY_AFTER, \
+    BULK_STREAM_CHUNK_SIZE
+from spliceai_api.exceptions import ScoringUnavailableException
+from spliceai_api.formats import ScoreFormat, DEFAULT_SCORE_FORMAT
+from spliceai_api.metrics import span, count_scored
+
+logger = logging.getLogger(__name__)
+
+# Scoring jobs. These are module-level functions taking plain arguments so they can be sent to a process pool, where
+# each worker process holds its own copy of the models and annotations.
+
+def score_custom_sequence_job(sequence: str) -> dict:
+    from spliceai_api import MODELS
+    from spliceai_api.utils import score_custom_sequence
+    return score_custom_sequence(sequence, models=MODELS)
+
+def delta_scores_job(annotation: str, record, distance: int, mask: int,
+                     score_format: ScoreFormat = DEFAULT_SCORE_FORMAT) -> list:
+    from spliceai_api import MODELS
+    from spliceai_api.registry import get_registry
+    from spliceai_api.precomputed import get_precomputed_scores
+    from spliceai_api.score_cache import scoped_score_cache
+    from spliceai_api.utils import get_delta_scores
+    return get_delta_scores(record, get_registry().get(annotation), distance, mask, models=MODELS,
+                            score_format=score_format, score_cache=scoped_score_cache(annotation),
+                            precomputed=get_precomputed_scores(annotation))
+
+def bulk_delta_scores_job(annotation: str, records: list, distance: int, mask: int,
+                          score_format: ScoreFormat = DEFAULT_SCORE_FORMAT) -> list:
+    from spliceai_api import MODELS
+    from spliceai_api.registry import get_registry
+    from spliceai_api.precomputed import get_precomputed_scores
+    from spliceai_api.score_cache import scoped_score_cache
+    from spliceai_api.utils import get_bulk_delta_scores
+    return get_bulk_delta_scores(records, get_registry().get(annotation), distance, mask, models=MODELS,
+                                 score_format=score_format, score_cache=scoped_score_cache(annotation),
+                                 precomputed=get_precomputed_scores(annotation))
+
+def scan_region_job(annotation: str, chrom: str, start: int, end: int, distance: int, mask: int,
+                    deadline: float = None) -> dict:
+    from spliceai_api import MODELS
+    from spliceai_api.registry import get_registry
+    from spliceai_api.utils import scan_region
+    return scan_region(get_registry().get(annotation), chrom, start, end, distance, mask, models=MODELS,
+                       deadline=deadline)
+
+def bulk_response(input: str, result) -> dict:
+    """A `BulkVarianstResponse` for a variant's scores, or for the exception raised while scoring it."""
+    if isinstance(result, Exception):
+        return {'input': input, 'scores': None, 'error': f"Error encountered: {str(result)}"}
+    return {'input': input, 'scores': result, 'error': None}
+
+def bulk_delta_scores_ndjson_job(annotation: str, records: list, inputs: list, offset: int, distance: int,
+                                 mask: int, score_format: ScoreFormat = DEFAULT_SCORE_FORMAT) -> str:
+    """Score a chunk of a bulk request and serialise it as one NDJSON line per variant."""
+    try:
+        results = bulk_delta_scores_job(annotation, records, distance, mask, score_format)
+    except Exception as e:
+        results = [e] * len(records)
+    return ''.join(json.dumps({'index': offset + k, **bulk_response(input, result)}) + '\n'
+                   for k, (input, result) in enumerate(zip(inputs, results)))
+
+def plan_delta_scores_job(annotation: str, record, distance: int, mask: int,
+                          score_format: ScoreFormat = DEFAULT_SCORE_FORMAT) -> tuple:
+    """
+    The tasks of a record and the windows to predict for them. The plan is None if the record is served by
+    precomputed scores or the score cache.
+    """
+    from spliceai_api.precomputed import get_precomputed_scores
+    from spliceai_api.registry import get_registry
+    from spliceai_api.score_cache import scoped_score_cache
+    from spliceai_api.utils import prepare_delta_scores, plan_delta_scores, lookup_delta_scores
+    ann = get_registry().get(annotation)
+    tasks = lookup_delta_scores(record, ann, distance, mask, score_format, scoped_score_cache(annotation),
+                                get_precomputed_scores(annotation))
+    if tasks is not None:
+        return tasks, None
+
+    tasks = prepare_delta_scores(record, ann, distance)
+    return tasks, plan_delta_scores(tasks, ann)
+
+def format_delta_scores_job(annotation: str, record, tasks: list, plan, predictions: list, distance: int, mask: int,
+                            score_format: ScoreFormat = DEFAULT_SCORE_FORMAT) -> list:
+    from spliceai_api.score_cache import scoped_score_cache
+    from spliceai_api.utils import apply_predictions, format_delta_score
+    if plan is not None:
+        apply_predictions(plan, predictions)
+        score_cache = scoped_score_cache(annotation)
+        if score_cache is not None:
+            score_cache.put(record, distance, tasks)
+    with span('postprocess'):
+        scores = [format_delta_score(task, distance, mask, score_format) for task in tasks]
+    count_scored(tasks)
+    return [x for x in scores if x is not None]
+
+def init_worker_process(ready=None):
+    """
+    Load the models and annotations of a process pool worker before it accepts jobs, then put None on `ready` (a
+    queue), or the error if loading failed.
+    """
+    from spliceai_api import MODELS
+    from spliceai_api.registry import get_registry
+    try:
+        MODELS.load()
+        get_registry().warm()
+        MODELS.warm_up()
+    except BaseException as e:
+        if ready is not None:
+            ready.put(f"{type(e).__name__}: {e}")
+        raise
+    if ready is not None:
+        ready.put(None)
+
+class ScoringExecutor:
+    """
+    Runs CPU-bound scoring jobs off the event loop with admission control.
+
+    Jobs run on a thread pool (sharing the models and annotations of the server process) or on a process pool of
+    workers that each load their own copy. At most `workers + queue_size` jobs are admitted at once; further jobs
+    are rejected with a 503 and a Retry-After hint rather than queued without bound. A job that does not finish
+    within `timeout` seconds fails with a 504 (a job that already started still runs to completion and keeps its
+    slot until it does).
+    """
+
+    def __init__(self, kind: str = SCORING_EXECUTOR, workers: int = SCORING_WORKERS,
+                 queue_size: int = SCORING_QUEUE_SIZE, timeout: float = SCORING_TIMEOUT,
+                 retry_after: int = SCORING_RETRY_AFTER):
+        if kind == 'process':
+            context = multiprocessing.get_context('spawn')
+            self._ready = context.Queue()
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker_process,
+                                            initargs=(self._ready,))
+        elif kind == 'thread':
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scoring')
+        else:
+            raise ValueError(f"Unknown scoring executor: {kind}")
+
+        self.kind = kind
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._lock = threading.Lock()
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    @asynccontextmanager
+    async def admit(self, timeout: float = None, hold_slot: bool = True):
+        """
+        Admit a request that runs one or more steps (see `Admission`) under one slot and one deadline.
+
+        With `hold_slot` false the request has been admitted elsewhere (e.g. by the micro-batcher) and takes a slot
+        only while each of its jobs runs, beyond the capacity if need be, so that other requests see the load.
+
+        Raises:
+            ScoringUnavailableException: 503 if the pool and its queue are full.
+        """
+        if hold_slot:
+            with self._lock:
+                if self.in_flight >= self.capacity:
+                    self.rejected += 1
+                    raise ScoringUnavailableException(503, 'Server busy',
+                                                      f"All {self.capacity} scoring slots are in use, retry later",
+                                                      retry_after=self.retry_after)
+                self.in_flight += 1
+
+        admission = Admission(self, timeout or self.timeout, hold_slot)
+        try:
+            yield admission
+        finally:
+            admission.close()
+
+    async def run(self, fn, *args, timeout: float = None):
+        """
+        Run `fn(*args)` on the pool and wait for its result.
+
+        Raises:
+            ScoringUnavailableException: 503 if the pool and its queue are full, 504 if the deadline passes.
+        """
+        async with self.admit(timeout) as admission:
+            return await admission.run(fn, *args)
+
+    def warm_up(self):
+        """
+        Start the workers of a process pool and wait until each has loaded its models and annotations. A thread
+        pool shares those of the server, so there is nothing to wait for.
+
+        Raises:
+            RuntimeError: If a worker failed to load them.
+        """
+        if self.kind != 'process':
+            return
+        # Workers are started as jobs are submitted: one no-op each starts them all
+        started = [self.pool.submit(int) for _ in range(self.workers)]
+        ready = 0
+        while ready < self.workers:
+            try:
+                error = self._ready.get(timeout=1)
+            except queue.Empty:
+                # A worker that died while loading breaks the pool, failing the no-ops
+                for future in started:
+                    if future.done() and future.exception() is not None:
+                        raise RuntimeError(f"Scoring worker failed to start: {future.exception()}")
+                continue
+            if error is not None:
+                raise RuntimeError(f"Scoring worker failed to start: {error}")
+            ready += 1
+
+    def stats(self) -> dict:
+        return {
+            'executor': self.kind,
+            'workers': self.workers,
+            'capacity': self.capacity,
+            'in_flight': self.in_flight,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out
+        }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class Admission:
+    """
+    The slot and deadline of a request admitted by `ScoringExecutor.admit`. Every step the request runs on the pool
+    or waits for counts against the same deadline, and the slot is released once the request is done and none of
+    its jobs is still running. Without `hold_slot` each job takes a slot while it runs instead.
+    """
+
+    def __init__(self, executor: ScoringExecutor, timeout: float, hold_slot: bool = True):
+        self.executor = executor
+        self.timeout = timeout
+        self.hold_slot = hold_slot
+        self.deadline = asyncio.get_running_loop().time() + timeout
+        self._running = 0
+        self._closed = False
+
+    def _job_done(self, _):
+        with self.executor._lock:
+            self._running -= 1
+            release = not self.hold_slot or (self._closed and self._running == 0)
+        if release:
+            self.executor._release()
+
+    def close(self):
+        with self.executor._lock:
+            self._closed = True
+            release = self.hold_slot and self._running == 0
+        if release:
+            self.executor._release()
+
+    async def run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result, within the request's deadline."""
+        executor = self.executor
+        if executor.kind == 'thread':
+            # Run in the request's context, so the job's stage timings are recorded against the request
+            future = executor.pool.submit(contextvars.copy_context().run, fn, *args)
+        else:
+            future = executor.pool.submit(fn, *args)
+        with executor._lock:
+            self._running += 1
+            if not self.hold_slot:
+                executor.in_flight += 1
+        future.add_done_callback(self._job_done)
+        return await self.wait(asyncio.wrap_future(future))
+
+    async def wait(self, awaitable):
+        """
+        Wait for `awaitable` within the request's deadline, cancelling it if the deadline passes (a job that already
+        started still runs to completion).
+
+        Raises:
+            ScoringUnavailableException: 504 if the deadline passes.
+        """
+        try:
+            return await asyncio.wait_for(awaitable, max(self.deadline - asyncio.get_running_loop().time(), 0))
+        except asyncio.TimeoutError:
+            with self.executor._lock:
+                self.executor.timed_out += 1
+            raise ScoringUnavailableException(504, 'Scoring timed out',
+                                              f"Scoring did not finish within {self.timeout} seconds")
+
+async def score_variant(scoring: ScoringExecutor, batcher, annotation: str, record, distance: int, mask: int,
+                        score_format: ScoreFormat = DEFAULT_SCORE_FORMAT) -> list:
+    """
+    Delta scores for a single record.
+
+    With a micro-batcher (thread pool only), window preparation and formatting run on the pool while prediction
+    is shared with concurrent requests. The request is admitted against the micro-batcher's queue rather than the
+    pool's capacity, holding a pool slot only while preparation and formatting run, and its three steps share one
+    deadline.
+    """
+    if batcher is None:
+        return await scoring.run(delta_scores_job, annotation, record, distance, mask, score_format)
+
+    async with batcher.admit(), scoring.admit(hold_slot=False) as admission:
+        tasks, plan = await admission.run(plan_delta_scores_job, annotation, record, distance, mask, score_format)
+        with span('predict'):
+            predictions = await admission.wait(batcher.predict(plan.windows)) if plan is not None else []
+        return await admission.run(format_delta_scores_job, annotation, record, tasks, plan, predictions, distance,
+                                   mask, score_format)
+
+async def run_when_free(scoring: ScoringExecutor, fn, *args):
+    """
+    `scoring.run(fn, *args)`, retried after the Retry-After interval while the pool is full, for up to the
+    executor's timeout (SCORING_TIMEOUT) from the first attempt.
+
+    Raises:
+        ScoringUnavailableException: 503 if the pool is still full at the deadline, 504 if the job times out.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + scoring.timeout
+    while True:
+        try:
+            return await scoring.run(fn, *args)
+        except ScoringUnavailableException as e:
+            delay = e.retry_after or 1
+            if e.status_code != 503 or loop.time() + delay > deadline:
+                raise
+            await asyncio.sleep(delay)
+
+async def stream_chunks(scoring: ScoringExecutor, chunks, run_chunk, order: str = 'input'):
+    """
+    Await `run_chunk(*chunk)` for each chunk of an iterable (or async iterable, e.g. one reading from disk off the
+    event loop), yielding the results as they become available.
+
+    Up to one chunk per pool worker is in flight at a time and `chunks` is consumed lazily, so the server never
+    holds more than a few chunks regardless of the size of the request. With `order='input'` results are yielded
+    in the order of `chunks`; with `order='completion'` each result is yielded as soon as its chunk finishes.
+    """
+    if hasattr(chunks, '__aiter__'):
+        chunks = aiter(chunks)
+        next_chunk = lambda: anext(chunks, None)
+    else:
+        chunks = iter(chunks)
+        next_chunk = lambda: asyncio.sleep(0, next(chunks, None))
+    in_flight = []
+
+    try:
+        while True:
+            while len(in_flight) < scoring.workers:
+                chunk = await next_chunk()
+                if chunk is None:
+                    break
+                in_flight.append(asyncio.ensure_future(run_chunk(*chunk)))
+
+            if not in_flight:
+                return
+
+            if order == 'completion':
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    in_flight.remove(task)
+                    yield task.result()
+            else:
+                yield await in_flight.pop(0)
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+async def stream_bulk_delta_scores(scoring: ScoringExecutor, annotation: str, records: list, inputs: list,
+                                   distance: int, mask: int, order: str = 'input',
+                                   score_format: ScoreFormat = DEFAULT_SCORE_FORMAT):
+    """
+    Score a bulk request chunk by chunk, yielding NDJSON lines as results become available.
+
+    Every line carries the `index` of its variant in the request, so that results streamed in completion order
+    can be matched up with their input. Chunks rejected because the scoring queue is full are retried after the
+    executor's Retry-After interval (see `run_when_free`); chunks that time out or stay rejected are returned as
+    per-variant errors.
+    """
+    chunks = ((offset, records[offset:offset + BULK_STREAM_CHUNK_SIZE], inputs[offset:offset + BULK_STREAM_CHUNK_SIZE])
+              for offset in range(0, len(records), BULK_STREAM_CHUNK_SIZE))
+
+    async def run_chunk(offset, chunk_records, chunk_inputs):
+        try:
+            return await run_when_free(scoring, bulk_delta_scores_ndjson_job, annotation, chunk_records, chunk_inputs,
+                                       offset, distance, mask, score_format)
+        except ScoringUnavailableException as e:
+            return ''.join(json.dumps({'index': offset + k, **bulk_response(input, e)}) + '\n'
+                           for k, input in enumerate(chunk_inputs))
+
+    async for lines in stream_chunks(scoring, chunks, run_chunk, order):
+        yield lines
@@ -0,0 +1,117 @@
+import base64
+import io
+from dataclasses import dataclass
+
+import numpy as np
+
+from spliceai_api.exceptions import SpliceAIAPIException
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# (name, column of the prediction arrays, sign of alt - ref) of each delta score channel
+DELTA_CHANNELS = (('AG', 1, 1), ('AL', 1, -1), ('DG', 2, 1), ('DL', 2, -1))
+STATS_COLUMNS = ('donor_ref', 'donor_alt', 'donor', 'acceptor_ref', 'acceptor_alt', 'acceptor')
+
+@dataclass(frozen=True)
+class ScoreFormat:
+    """
+    How the per-position stats of a delta score are returned.
+
+    stats_format:
+        records: a list with one `Stats` dict per position (default)
+        columnar: a struct of arrays, one JSON array per stat
+        base64: a struct of arrays, each a base64 string of little-endian floats
+        arrow: a base64 string of an Arrow IPC stream holding one column per stat
+    precision: 'float64' (default) or 'float32' values for columnar formats
+    mode: 'full' (default) returns the per-position stats, 'summary' only the masked DS/DP summary scores
+    top_k: also return the top_k positions of each delta score channel (0 for none)
+    """
+    stats_format: str = 'records'
+    precision: str = 'float64'
+    mode: str = 'full'
+    top_k: int = 0
+
+DEFAULT_SCORE_FORMAT = ScoreFormat()
+
+def validate_score_format(score_format: ScoreFormat):
+    if score_format.stats_format == 'arrow' and pyarrow is None:
+        raise SpliceAIAPIException('Stats format not available', 'Arrow encoding requires pyarrow to be installed')
+
+def format_summary(y_ref: np.ndarray, y_alt: np.ndarray, dist_var: int, masks: tuple = (False,)*4) -> dict:
+    """
+    The classic SpliceAI summary: delta scores DS_* and their positions DP_* for acceptor/donor gain/loss.
+
+    `masks` zeroes the delta score of the (acceptor gain, acceptor loss, donor gain, donor loss) channels.
+    """
+    summary = {}
+    for (name, column, sign), masked in zip(DELTA_CHANNELS, masks):
+        delta = sign * (y_alt[:, column] - y_ref[:, column])
+        idx = delta.argmax()
+        summary[f"DS_{name}"] = 0.0 if masked else float(delta[idx])
+        summary[f"DP_{name}"] = int(idx) - dist_var
+    return summary
+
+def format_top_k(y_ref: np.ndarray, y_alt: np.ndarray, dist_var: int, k: int) -> dict:
+    """
+    The k positions with the largest delta score of each channel, largest first, as
+    {channel: {'dist_from_variant': [...], 'delta': [...]}}.
+    """
+    k = min(k, len(y_ref))
+    top = {}
+    for name, column, sign in DELTA_CHANNELS:
+        delta = sign * (y_alt[:, column] - y_ref[:, column])
+        idxs = np.argpartition(-delta, k - 1)[:k]
+        idxs = idxs[np.lexsort((idxs, -delta[idxs]))]
+        top[name] = {'dist_from_variant': (idxs - dist_var).tolist(), 'delta': delta[idxs].tolist()}
+    return top
+
+def format_stats(y_ref: np.ndarray, y_alt: np.ndarray, dist_var: int, score_format: ScoreFormat = DEFAULT_SCORE_FORMAT):
+    """
+    Per-position stats from reference and alternate predictions of shape (2*dist_var+1, 3).
+
+    Columnar formats serialise straight from the numpy arrays, without building a Python object per position.
+    """
+    columns = {
+        'donor_ref': y_ref[:, 2],
+        'donor_alt': y_alt[:, 2],
+        'donor': y_alt[:, 2] - y_ref[:, 2],
+        'acceptor_ref': y_ref[:, 1],
+        'acceptor_alt': y_alt[:, 1],
+        'acceptor': y_alt[:, 1] - y_ref[:, 1]
+    }
+
+    if score_format.stats_format == 'records':
+        dist_from_variant = np.arange(-1 * dist_var, 0).tolist()
+        dist_from_variant.extend(np.arange(0, dist_var + 1).tolist())
+        keys = ('dist_from_variant', *STATS_COLUMNS)
+        values = zip(dist_from_variant, *(columns[name].tolist() for name in STATS_COLUMNS))
+
+        return [dict(zip(keys, stat_record)) for stat_record in values]
+
+    dtype = np.dtype('<f4') if score_format.precision == 'float32' else np.dtype('<f8')
+    columns = {name: column.astype(dtype) for name, column in columns.items()}
+    stats = {
+        'dist_from_variant': {'start': -dist_var, 'stop': dist_var},
+        'dtype': score_format.precision,
+        'encoding': {'columnar': 'json'}.get(score_format.stats_format, score_format.stats_format)
+    }
+
+    if score_format.stats_format == 'columnar':
+        stats.update({name: column.tolist() for name, column in columns.items()})
+    elif score_format.stats_format == 'base64':
+        stats.update({name: base64.b64encode(column.tobytes()).decode('ascii') for name, column in columns.items()})
+    elif score_format.stats_format == 'arrow':
+        validate_score_format(score_format)
+        table = pyarrow.table(columns)
+        sink = io.BytesIO()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        stats['arrow'] = base64.b64encode(sink.getvalue()).decode('ascii')
+    else:
+        raise SpliceAIAPIException('Unknown stats format', score_format.stats_format)
+
+    return stats
@@ -0,0 +1,165 @@
+import argparse
+import json
+import mmap
+import os
+
+import numpy as np
+from pyfaidx import Fasta, FetchError
+
+PACKED_SUFFIX = '.packed'
+PACK_CHUNK_SIZE = 2**24
+
+def index_path(path: str) -> str:
+    return path + '.json'
+
+def pack_fasta(fasta_path: str, out_path: str):
+    """
+    Write a FASTA as a packed genome: every sequence's bases (one byte each, case preserved) back to back in
+    `out_path`, with an index of each sequence's offset and length in `out_path + '.json'`.
+    """
+    fasta = Fasta(fasta_path, rebuild=False)
+    index = {}
+    offset = 0
+
+    with open(out_path, 'wb') as out:
+        for name in fasta.keys():
+            length = len(fasta[name])
+            for start in range(0, length, PACK_CHUNK_SIZE):
+                out.write(fasta[name][start:min(start + PACK_CHUNK_SIZE, length)].seq.encode('ascii'))
+            index[name] = {'offset': offset, 'length': length}
+            offset += length
+
+    with open(index_path(out_path), 'w') as f:
+        json.dump({'source': os.path.abspath(fasta_path), 'sequences': index}, f, indent=2)
+
+class PackedSequence:
+    """A slice of a packed genome: a zero-copy uint8 view of its bases, decoded to a string on demand."""
+
+    def __init__(self, view: np.ndarray):
+        self.view = view
+
+    @property
+    def seq(self) -> str:
+        return self.view.tobytes().decode('ascii')
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+class PackedRecord:
+    """One sequence of a packed genome, sliced with the same 0-based, end-exclusive semantics as pyfaidx."""
+
+    def __init__(self, name: str, data: np.ndarray):
+        self.name = name
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def bounds(self, start: int, stop: int) -> tuple:
+        """
+        The (start, stop) actually returned by pyfaidx for a slice of an uncompressed FASTA: negative coordinates
+        count from the end, ranges past the end are truncated and empty or reversed ranges return no bases.
+
+        Raises:
+            FetchError: If the start lies before the beginning of the sequence.
+        """
+        length = len(self.data)
+        start = 0 if start is None else start
+        stop = length if stop is None else stop
+        if stop < 0:
+            stop = length + stop
+        if start < 0:
+            start = length + start
+        if start < 0:
+            raise FetchError("Requested start coordinate must be greater than 1.")
+        stop = min(stop, length)
+        return (start, stop) if start < stop else (start, start)
+
+    def __getitem__(self, n) -> PackedSequence:
+        if not isinstance(n, slice):
+            raise TypeError('Packed genome sequences only support slicing')
+        start, stop = self.bounds(n.start, n.stop)
+        return PackedSequence(self.data[start:stop])
+
+class PackedGenome:
+    """
+    A packed genome (see `pack_fasta`) memory-mapped read-only, as a drop-in replacement for `pyfaidx.Fasta`.
+
+    Slicing a sequence returns a zero-copy view of the mapped bases, so fetching a window costs no seeks or
+    newline stripping; the pages of a large genome are only read from disk when first used and are shared by all
+    processes mapping the same file.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(index_path(filename)) as f:
+            self.index = json.load(f)['sequences']
+
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) else None
+        data = np.frombuffer(self._mmap, dtype=np.uint8) if self._mmap is not None else np.zeros(0, dtype=np.uint8)
+        self.records = {name: PackedRecord(name, data[entry['offset']:entry['offset'] + entry['length']])
+                        for name, entry in self.index.items()}
+
+    def keys(self):
+        return self.records.keys()
+
+    def __getitem__(self, name: str) -> PackedRecord:
+        return self.records[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.records
+
+    def prefetch(self, name: str, starts, stops):
+        """
+        Read ahead the bases of a batch of windows of a sequence, in one sequential pass over the sorted windows
+        (overlapping windows are merged into one read). Windows that cannot be fetched are ignored.
+        """
+        if self._mmap is None or not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+
+        record = self.records[name]
+        spans = []
+        for start, stop in zip(starts, stops):
+            try:
+                span = record.bounds(start, stop)
+            except FetchError:
+                continue
+            if span[0] < span[1]:
+                spans.append(span)
+
+        offset = self.index[name]['offset']
+        merged = []
+        for start, stop in sorted(spans):
+            if merged and start <= merged[-1][1] + mmap.PAGESIZE:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        for start, stop in merged:
+            lo = offset + start
+            lo -= lo % mmap.PAGESIZE
+            self._mmap.madvise(mmap.MADV_WILLNEED, lo, offset + stop - lo)
+
+    def fetch_windows(self, name: str, starts, stops) -> list:
+        """
+        Zero-copy views of many windows of a sequence, with the same slicing semantics as `PackedRecord`.
+
+        The span covered by the windows is read ahead in one pass, so a sorted batch of nearby windows costs one
+        sequential read rather than one random read each.
+        """
+        self.prefetch(name, starts, stops)
+        record = self.records[name]
+        return [record[start:stop] for start, stop in zip(starts, stops)]
+
+def open_reference(filename: str):
+    """A packed genome if the file has the packed suffix, otherwise the FASTA through pyfaidx."""
+    if filename.endswith(PACKED_SUFFIX):
+        return PackedGenome(filename)
+    return Fasta(filename, rebuild=False)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack a FASTA (plain or bgzipped) into a memory-mappable genome')
+    parser.add_argument('fasta', help='FASTA file, with its .fai index')
+    parser.add_argument('out', help=f"Packed genome, conventionally ending in {PACKED_SUFFIX}")
+    args = parser.parse_args()
+    pack_fasta(args.fasta, args.out)
@@ -0,0 +1,200 @@
+import bisect
+import logging
+import math
+import threading
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from spliceai_api import PREDICT_BATCH_SIZE, PREDICT_LENGTH_BUCKET, REF_CACHE_MB
+from spliceai_api.encoding import encode_batch, centring_offset
+from spliceai_api.metrics import span, observe_batch_size
+from spliceai_api.models import predict_ensemble, RemoteModels
+
+logger = logging.getLogger(__name__)
+
+def bucket_length(length: int, bucket: int = PREDICT_LENGTH_BUCKET) -> int:
+    """`length` rounded up to a multiple of `bucket` (unchanged if `bucket` is 0)."""
+    return -(-length // bucket) * bucket if bucket > 0 else length
+
+def predict_windows(windows: list, models: list, batch_size: int = PREDICT_BATCH_SIZE,
+                    bucket: int = PREDICT_LENGTH_BUCKET) -> list:
+    """
+    Ensemble-averaged SpliceAI predictions for a list of windows.
+
+    Windows of equal length are encoded straight into float32 batches of at most `batch_size` and the ensemble is
+    run once per batch, instead of once per window. Models are called directly rather than through `Model.predict`,
+    whose output depends on the batch it runs in; a direct call gives bit-for-bit the same prediction for a window
+    whether it is scored alone or as part of a batch.
+
+    With a `bucket` size, windows are padded with N to a multiple of `bucket` bases so that windows of similar
+    lengths share batches. Bases beyond the models' context do not affect a prediction, but padding changes
+    predictions in the last few bits, so a window is always padded the same way whatever it is batched with.
+
+    Args:
+        windows (list): `Window`s or one-hot encoded windows, each of shape (length, 4).
+        models (list): The five SpliceAI models (a `ModelSet` runs them as one fused graph, `RemoteModels` in the
+            shared inference process).
+        batch_size (int): Maximum number of windows per predict call.
+        bucket (int): Length bucket size, 0 for no padding.
+
+    Returns:
+        list: Predictions of shape (1, length - 10000, 3), in the same order as `windows`.
+    """
+    if isinstance(models, RemoteModels):
+        with span('predict'):
+            return models.predict_windows(windows)
+
+    results = [None] * len(windows)
+
+    groups = defaultdict(list)
+    for i, x in enumerate(windows):
+        groups[bucket_length(x.shape[0], bucket)].append(i)
+
+    for length, idxs in groups.items():
+        for start in range(0, len(idxs), batch_size):
+            chunk = idxs[start:start + batch_size]
+            with span('encoding'):
+                x = encode_batch([windows[i] for i in chunk], length=length)
+            logger.debug(f"Predicting batch of {len(chunk)} windows of length {length}")
+            observe_batch_size(len(chunk))
+            with span('predict'):
+                y = predict_ensemble(models, x)
+            for k, i in enumerate(chunk):
+                offset = centring_offset(windows[i].shape[0], length)
+                results[i] = y[k:k + 1, offset:offset + windows[i].shape[0] - 10000]
+
+    return results
+
+class RefPredictionCache:
+    """
+    LRU cache of reference-allele predictions with a memory cap.
+
+    Entries are keyed by a bucket (assembly, chrom, strand) and a window (win_start, win_end, real_lo, real_hi):
+    the 1-based span of the model input and the part of it that is reference sequence rather than N padding
+    (the gene-boundary padding of `get_delta_scores`). Predictions are stored in forward genomic orientation, one
+    row per output position `win_start+5000 .. win_end-5000`.
+
+    A lookup is served by any entry whose window contains the requested one and whose padding agrees with it
+    inside the requested span, so predictions for a wide region can be sliced to answer the windows of every
+    variant that falls inside it.
+    """
+
+    def __init__(self, max_bytes: float):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._windows = defaultdict(list)
+        self._max_width = 0
+        self._lock = threading.Lock()
+
+    def get(self, bucket: tuple, window: tuple) -> np.ndarray:
+        """Forward-oriented predictions for a window, or None if no cached entry covers it."""
+        win_start, win_end, real_lo, real_hi = window
+
+        with self._lock:
+            windows = self._windows.get(bucket, [])
+            i = bisect.bisect_right(windows, (win_start, math.inf))
+
+            while i > 0:
+                i -= 1
+                entry_start, entry_end, entry_lo, entry_hi = windows[i]
+                if entry_start < win_start - self._max_width:
+                    break
+                if entry_end < win_end or max(win_start, entry_lo) != real_lo or min(win_end, entry_hi) != real_hi:
+                    continue
+
+                key = (bucket, windows[i])
+                self._entries.move_to_end(key)
+                self.hits += 1
+                offset = win_start - entry_start
+                return self._entries[key][offset:offset + win_end - win_start + 1 - 10000]
+
+            self.misses += 1
+            return None
+
+    def put(self, bucket: tuple, window: tuple, y: np.ndarray):
+        """Store forward-oriented predictions for a window, evicting least recently used entries past the cap."""
+        y = np.array(y, dtype=np.float32)
+        y.flags.writeable = False
+        if y.nbytes > self.max_bytes:
+            return
+
+        key = (bucket, tuple(window))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+
+            self._entries[key] = y
+            bisect.insort(self._windows[bucket], key[1])
+            self._max_width = max(self._max_width, window[1] - window[0] + 1)
+            self.nbytes += y.nbytes
+
+            while self.nbytes > self.max_bytes:
+                (old_bucket, old_window), old_y = self._entries.popitem(last=False)
+                windows = self._windows[old_bucket]
+                del windows[bisect.bisect_left(windows, old_window)]
+                if not windows:
+                    del self._windows[old_bucket]
+                self.nbytes -= old_y.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._windows.clear()
+            self._max_width = 0
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+REF_CACHE = RefPredictionCache(REF_CACHE_MB * 2**20)
+
+def plan_ref_regions(windows: list, max_width: int) -> list:
+    """
+    Merge overlapping reference windows into wider regions that are predicted once and sliced.
+
+    Windows are only merged when they share a bucket and gene boundaries, so the N padding of the merged region
+    matches that of every window inside it.
+
+    Args:
+        windows (list): (bucket, (tx_start, tx_end), window) for each reference window.
+        max_width (int): Widest region, in bases, that windows are merged into.
+
+    Returns:
+        list: (bucket, region window, indices of the member windows) for each region.
+    """
+    groups = defaultdict(list)
+    for i, (bucket, tx_bounds, window) in enumerate(windows):
+        groups[(bucket, tx_bounds)].append(i)
+
+    regions = []
+
+    for (bucket, (tx_start, tx_end)), idxs in groups.items():
+        idxs.sort(key=lambda i: windows[i][2][0])
+        members = []
+
+        for i in idxs:
+            win_start, win_end = windows[i][2][:2]
+            if members and win_start <= end + 1 and max(end, win_end) - start + 1 <= max_width:
+                end = max(end, win_end)
+                members.append(i)
+                continue
+            if members:
+                regions.append((bucket, (start, end, max(tx_start, start), min(tx_end, end)), members))
+            start, end, members = win_start, win_end, [i]
+
+        regions.append((bucket, (start, end, max(tx_start, start), min(tx_end, end)), members))
+
+    return regions
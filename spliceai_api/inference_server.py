@@ -0,0 +1,102 @@
+"""
+Shared inference process: loads the SpliceAI models once and predicts windows for every worker process of the
+server, which connect to it over a Unix socket (INFERENCE_SOCKET, see `models.RemoteModels`):
+
+    python -m spliceai_api.inference_server --socket /tmp/spliceai-inference.sock
+
+Windows sent by different workers are predicted together in micro-batches. The socket is only created once the
+models are loaded and warmed up, so workers waiting to connect become ready when inference is.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+
+from spliceai_api import INFERENCE_SOCKET
+from spliceai_api.batching import MicroBatcher
+from spliceai_api.exceptions import ScoringUnavailableException
+from spliceai_api.models import ModelSet, MESSAGE_HEADER, decode_windows, encode_predictions
+
+logger = logging.getLogger(__name__)
+
+class InferenceServer:
+    """Serves predict requests of worker processes from one set of models, through a `MicroBatcher`."""
+
+    def __init__(self, path: str, batcher: MicroBatcher):
+        self.path = path
+        self.batcher = batcher
+        self.connections = 0
+        self.requests = 0
+        self._handlers = set()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    head = await reader.readexactly(MESSAGE_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    return
+                head_size, payload_size = MESSAGE_HEADER.unpack(head)
+                header = json.loads(await reader.readexactly(head_size))
+                payload = await reader.readexactly(payload_size)
+
+                try:
+                    predictions = await self.batcher.predict(decode_windows(header, payload))
+                    response, body = encode_predictions(predictions)
+                except ScoringUnavailableException as e:
+                    response, body = {'error': e.summary, 'details': e.details, 'status_code': e.status_code,
+                                      'retry_after': e.retry_after}, b''
+                except Exception as e:
+                    logger.exception("Prediction failed")
+                    response, body = {'error': str(e)}, b''
+                self.requests += 1
+
+                head = json.dumps(response).encode()
+                writer.write(MESSAGE_HEADER.pack(len(head), len(body)) + head + body)
+                await writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            self.connections -= 1
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        logger.info(f"Serving predictions at {self.path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # Workers keep their connections open: close them with the server
+            for handler in list(self._handlers):
+                handler.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shared SpliceAI inference process')
+    parser.add_argument('--socket', default=INFERENCE_SOCKET or '/tmp/spliceai-inference.sock',
+                        help='Unix socket to listen on (default: INFERENCE_SOCKET)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if os.getenv("DEBUG") == "true" else logging.INFO,
+                        format="%(asctime)s %(name)-12s %(funcName)-12s %(levelname)-8s %(message)s")
+
+    # The only process running the models: TensorFlow gets every core
+    models = ModelSet(processes=1)
+    models.load()
+    models.warm_up()
+    batcher = MicroBatcher(models)
+    try:
+        asyncio.run(InferenceServer(args.socket, batcher).serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        batcher.shutdown()
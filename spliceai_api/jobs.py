@@ -0,0 +1,371 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import asdict
+
+from spliceai_api import JOBS_PATH, JOB_CHUNK_SIZE, JOB_LEASE_SECONDS
+from spliceai_api.exceptions import ScoringUnavailableException
+from spliceai_api.executor import bulk_delta_scores_job, bulk_response
+from spliceai_api.formats import ScoreFormat
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    annotation TEXT NOT NULL,
+    distance INTEGER NOT NULL,
+    mask INTEGER NOT NULL,
+    score_format TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    run_seconds REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    owner TEXT,
+    lease_expires REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS job_variants (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    chrom TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    ref TEXT NOT NULL,
+    alt TEXT NOT NULL,
+    PRIMARY KEY (job_id, idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (job_id, idx)
+) WITHOUT ROWID;
+"""
+
+JOB_COLUMNS = ('id', 'annotation', 'distance', 'mask', 'score_format', 'status', 'total', 'done', 'errors',
+               'run_seconds', 'created', 'started', 'finished', 'error')
+
+# Jobs in these states are not worked on any more
+FINAL_STATUSES = ('done', 'failed', 'cancelled')
+
+# Columns added to the jobs table since it was first created, added to older databases when they are opened
+ADDED_COLUMNS = (('owner', 'TEXT'), ('lease_expires', 'REAL'))
+
+def job_status(row: tuple) -> dict:
+    """The status of a job as returned by the API, from its row in the jobs table."""
+    job = dict(zip(JOB_COLUMNS, row))
+    rate = job['done'] / job['run_seconds'] if job['run_seconds'] > 0 else None
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'annotation': job['annotation'],
+        'distance': job['distance'],
+        'mask': job['mask'],
+        'total': job['total'],
+        'done': job['done'],
+        'errors': job['errors'],
+        'progress': job['done'] / job['total'] if job['total'] else 1.0,
+        'variants_per_s': rate,
+        'eta_s': (job['total'] - job['done']) / rate if rate and job['status'] not in FINAL_STATUSES else None,
+        'created': job['created'],
+        'started': job['started'],
+        'finished': job['finished'],
+        'error': job['error']
+    }
+
+class JobStore:
+    """
+    Persistent queue of bulk scoring jobs and their results, in a SQLite database.
+
+    A job's variants are stored when it is submitted. Results are written a chunk at a time, together with the
+    job's progress, in one transaction: a chunk is either fully stored or not at all, so after a restart a job
+    resumes from the first variant without a result.
+
+    Several processes (e.g. the workers of `serve --workers N`) may share the database. A running job is leased to
+    the runner working on it, which renews the lease while it runs; a job is only taken over by another runner once
+    its lease has expired, i.e. its runner stopped without releasing it.
+
+    Each thread uses its own connection; the database is in WAL mode so readers do not block the writer.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = JOB_LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+
+        db = self._connect()
+        db.executescript(SCHEMA)
+        columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+        for name, kind in ADDED_COLUMNS:
+            if name not in columns:
+                db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def submit(self, annotation: str, variants: list, distance: int, mask: int, score_format: ScoreFormat) -> dict:
+        """
+        Queue a job scoring `variants`, a list of (chrom, pos, ref, alt) tuples.
+
+        Returns:
+            dict: The status of the new job.
+        """
+        job_id = uuid.uuid4().hex
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT INTO jobs (id, annotation, distance, mask, score_format, status, total, created) "
+                       "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+                       (job_id, annotation, distance, mask, json.dumps(asdict(score_format)), len(variants),
+                        time.time()))
+            db.executemany("INSERT INTO job_variants VALUES (?, ?, ?, ?, ?, ?)",
+                           ((job_id, k, *variant) for k, variant in enumerate(variants)))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return self.status(job_id)
+
+    def status(self, job_id: str) -> dict:
+        """The status of a job, or None if there is no such job."""
+        row = self._connect().execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id=?", (job_id,)).fetchone()
+        return job_status(row) if row is not None else None
+
+    def list(self, status: str = None, limit: int = 100) -> list:
+        """Statuses of the most recently submitted jobs, optionally only those in a given state."""
+        query = f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs"
+        args = ()
+        if status is not None:
+            query += " WHERE status=?"
+            args = (status,)
+        rows = self._connect().execute(query + " ORDER BY created DESC LIMIT ?", (*args, limit)).fetchall()
+        return [job_status(row) for row in rows]
+
+    def results(self, job_id: str, offset: int, limit: int) -> list:
+        """(index, result JSON) of the stored results of a job, from index `offset` on."""
+        return self._connect().execute("SELECT idx, result FROM job_results WHERE job_id=? AND idx>=? "
+                                       "ORDER BY idx LIMIT ?", (job_id, offset, limit)).fetchall()
+
+    def next_job(self, owner: str) -> dict:
+        """
+        The oldest queued job, or running job whose lease has expired (its row as a dict), marked as running and
+        leased to `owner`, or None if there is no such job.
+        """
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = db.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE status='queued' OR "
+                             "(status='running' AND COALESCE(lease_expires, 0) < ?) ORDER BY created LIMIT 1",
+                             (now,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE jobs SET status='running', started=COALESCE(started, ?), owner=?, lease_expires=? "
+                           "WHERE id=?", (now, owner, now + self.lease_seconds, row[0]))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return dict(zip(JOB_COLUMNS, row)) if row is not None else None
+
+    def variants(self, job_id: str, offset: int, limit: int) -> list:
+        """(chrom, pos, ref, alt) of the variants of a job from index `offset` on."""
+        return self._connect().execute("SELECT chrom, pos, ref, alt FROM job_variants WHERE job_id=? AND idx>=? "
+                                       "ORDER BY idx LIMIT ?", (job_id, offset, limit)).fetchall()
+
+    def renew(self, job_id: str, owner: str) -> bool:
+        """Extend `owner`'s lease of a running job. False if the job is no longer running under that lease."""
+        return bool(self._connect().execute("UPDATE jobs SET lease_expires=? WHERE id=? AND status='running' "
+                                            "AND owner=?", (time.time() + self.lease_seconds, job_id, owner)).rowcount)
+
+    def release(self, owner: str) -> int:
+        """Put the running jobs leased to `owner` back in the queue, e.g. when its runner stops."""
+        return self._connect().execute("UPDATE jobs SET status='queued', owner=NULL, lease_expires=NULL "
+                                       "WHERE status='running' AND owner=?", (owner,)).rowcount
+
+    def checkpoint(self, job_id: str, offset: int, results: list, errors: int, seconds: float, owner: str) -> bool:
+        """
+        Store the results (JSON strings) of the chunk of a job starting at `offset`, `errors` of which are errors,
+        advance its progress and renew `owner`'s lease.
+
+        Returns:
+            bool: False if the job was cancelled (or deleted) meanwhile or is no longer leased to `owner`, in which
+            case nothing is stored.
+        """
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            updated = db.execute("UPDATE jobs SET done=?, errors=errors+?, run_seconds=run_seconds+?, lease_expires=? "
+                                 "WHERE id=? AND status='running' AND done=? AND owner=?",
+                                 (offset + len(results), errors, seconds, time.time() + self.lease_seconds, job_id,
+                                  offset, owner)).rowcount
+            if updated:
+                db.executemany("INSERT OR REPLACE INTO job_results VALUES (?, ?, ?)",
+                               ((job_id, offset + k, result) for k, result in enumerate(results)))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return bool(updated)
+
+    def finish(self, job_id: str, owner: str, status: str = 'done', error: str = None):
+        self._connect().execute("UPDATE jobs SET status=?, finished=?, error=? WHERE id=? AND status='running' "
+                                "AND owner=?", (status, time.time(), error, job_id, owner))
+
+    def cancel(self, job_id: str) -> bool:
+        """Stop a queued or running job, keeping the results it has so far. False if it had already ended."""
+        return bool(self._connect().execute("UPDATE jobs SET status='cancelled', finished=? WHERE id=? "
+                                            "AND status IN ('queued', 'running')", (time.time(), job_id)).rowcount)
+
+    def delete(self, job_id: str) -> bool:
+        """Delete a job with its variants and results. False if there is no such job."""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            deleted = db.execute("DELETE FROM jobs WHERE id=?", (job_id,)).rowcount
+            db.execute("DELETE FROM job_variants WHERE job_id=?", (job_id,))
+            db.execute("DELETE FROM job_results WHERE job_id=?", (job_id,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return bool(deleted)
+
+class JobRunner:
+    """
+    Works through the queued jobs of a `JobStore`, one job at a time and one chunk of `chunk_size` variants at a
+    time, scoring each chunk on the scoring executor like a bulk request and checkpointing its results.
+
+    A chunk rejected because the executor is busy is retried after the executor's Retry-After delay, so jobs give
+    way to interactive requests rather than fail.
+
+    Every worker process runs its own runner on the shared store: each job is leased to the runner that took it
+    (`owner`), so runners never score the same job at once. A job interrupted by a crash is resumed from its last
+    checkpoint once its lease expires; one interrupted by a clean stop is released straight away.
+    """
+
+    def __init__(self, store: JobStore, scoring, chunk_size: int = JOB_CHUNK_SIZE, poll_interval: float = 1.0):
+        self.owner = uuid.uuid4().hex
+        self.store = store
+        self.scoring = scoring
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """Start working through the queue, in the running event loop."""
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            # Let another runner resume the current job from its last checkpoint without waiting for the lease
+            await asyncio.to_thread(self.store.release, self.owner)
+
+    def notify(self):
+        """Wake the runner up, e.g. after a job was submitted."""
+        self._wake.set()
+
+    async def run(self):
+        while True:
+            job = await asyncio.to_thread(self.store.next_job, self.owner)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self.run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Job {job['id']} failed")
+                await asyncio.to_thread(self.store.finish, job['id'], self.owner, 'failed', str(e))
+
+    async def run_job(self, job: dict):
+        """Score the remaining variants of a job chunk by chunk, from its last checkpoint."""
+        logger.info(f"Running job {job['id']} from variant {job['done']} of {job['total']}")
+        heartbeat = asyncio.ensure_future(self.heartbeat(job['id']))
+        try:
+            await self.run_chunks(job)
+        finally:
+            heartbeat.cancel()
+
+    async def heartbeat(self, job_id: str):
+        """Renew the lease of a job while it runs, so that no other runner takes it over."""
+        while True:
+            await asyncio.sleep(self.store.lease_seconds / 3)
+            if not await asyncio.to_thread(self.store.renew, job_id, self.owner):
+                return
+
+    async def run_chunks(self, job: dict):
+        from spliceai_api.utils import Record
+
+        score_format = ScoreFormat(**json.loads(job['score_format']))
+        offset = job['done']
+        while offset < job['total']:
+            variants = await asyncio.to_thread(self.store.variants, job['id'], offset, self.chunk_size)
+            records = [Record(chrom=chrom, pos=pos, ref=ref, alts=[alt]) for chrom, pos, ref, alt in variants]
+
+            start = time.perf_counter()
+            results = await self.score_chunk(job, records, score_format)
+            seconds = time.perf_counter() - start
+
+            lines = [json.dumps({'index': offset + k, **bulk_response(f"{chrom}-{pos}-{ref}-{alt}", result)})
+                     for k, ((chrom, pos, ref, alt), result) in enumerate(zip(variants, results))]
+            errors = sum(1 for result in results if isinstance(result, Exception))
+            if not await asyncio.to_thread(self.store.checkpoint, job['id'], offset, lines, errors, seconds,
+                                           self.owner):
+                logger.info(f"Job {job['id']} was cancelled or taken over")
+                return
+            offset += len(lines)
+
+        await asyncio.to_thread(self.store.finish, job['id'], self.owner)
+        logger.info(f"Job {job['id']} finished")
+
+    async def score_chunk(self, job: dict, records: list, score_format: ScoreFormat) -> list:
+        while True:
+            try:
+                return await self.scoring.run(bulk_delta_scores_job, job['annotation'], records, job['distance'],
+                                              job['mask'], score_format)
+            except ScoringUnavailableException as e:
+                if e.status_code != 503:
+                    return [e] * len(records)
+                await asyncio.sleep(e.retry_after or self.poll_interval)
+            except Exception as e:
+                return [e] * len(records)
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+def get_job_store() -> JobStore:
+    """The process-wide JobStore, or None if JOBS_PATH is not set."""
+    global _job_store
+    if _job_store is None and JOBS_PATH:
+        with _job_store_lock:
+            if _job_store is None:
+                _job_store = JobStore(JOBS_PATH)
+    return _job_store
@@ -0,0 +1,255 @@
+import bisect
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from contextlib import nullcontext
+
+from fastapi.routing import APIRoute
+
+from spliceai_api import METRICS_ENABLED, DEBUG_TIMING_HEADER
+
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+WAIT_TIME_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Request header asking for the per-stage timings of a request, returned in a Server-Timing response header
+DEBUG_TIMING_REQUEST_HEADER = 'x-debug-timing'
+
+def format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """A Prometheus counter, with one value per combination of label values."""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    """
+    A Prometheus histogram, with one set of buckets per combination of label values. A value is counted in the
+    first bucket whose upper bound is at least the value.
+    """
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, n in zip((*self.buckets, '+Inf'), counts):
+                    cumulative += n
+                    le = format_labels(self.labelnames, labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+    def to_dict(self, *labels) -> dict:
+        """Cumulative bucket counts, sum and count of the values observed with these label values."""
+        with self._lock:
+            counts, total, count = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0, 0))
+            cumulative = 0
+            buckets = {}
+            for bound, n in zip((*self.buckets, '+Inf'), counts):
+                cumulative += n
+                buckets[str(bound)] = cumulative
+        return {'buckets': buckets, 'sum': total, 'count': count}
+
+STAGE_SECONDS = Histogram('spliceai_stage_seconds', 'Time spent in each stage of scoring', ('stage',))
+REQUEST_SECONDS = Histogram('spliceai_request_seconds', 'Time to handle a request', ('route', 'status'))
+VARIANTS_SCORED = Counter('spliceai_variants_scored_total', 'Records scored, by where their scores came from',
+                          ('source',))
+RECORDS_SKIPPED = Counter('spliceai_records_skipped_total', 'Records that could not be scored, by reason',
+                          ('reason',))
+PREDICT_BATCH_SIZES = Histogram('spliceai_predict_batch_size', 'Windows per ensemble call', (), BATCH_SIZE_BUCKETS)
+
+METRICS = [STAGE_SECONDS, REQUEST_SECONDS, VARIANTS_SCORED, RECORDS_SKIPPED, PREDICT_BATCH_SIZES]
+
+class Timings:
+    """Time spent in each stage while handling one request, summed over repeated stages."""
+    __slots__ = ('stages',)
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        """The timings as a Server-Timing header value, in milliseconds."""
+        return ', '.join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in self.stages.items())
+
+_timings = contextvars.ContextVar('spliceai_timings', default=None)
+# perf_counter() when the endpoint of the current request was entered and when it returned
+_endpoint_marks = contextvars.ContextVar('spliceai_endpoint_marks', default=None)
+
+class Span:
+    __slots__ = ('stage', 'timings', 'start')
+
+    def __init__(self, stage: str, timings: Timings):
+        self.stage = stage
+        self.timings = timings
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.stage, time.perf_counter() - self.start, self.timings)
+
+NULL_SPAN = nullcontext()
+
+def span(stage: str):
+    """
+    Context manager timing a stage of scoring, into the stage histogram and the timings of the current request.
+
+    When metrics are disabled and the request did not ask for its timings this is a no-op.
+    """
+    timings = _timings.get()
+    if timings is None and not METRICS_ENABLED:
+        return NULL_SPAN
+    return Span(stage, timings)
+
+def record_stage(stage: str, seconds: float, timings: Timings = None):
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, stage)
+    if timings is not None:
+        timings.add(stage, seconds)
+
+def count_skipped(reason: str):
+    if METRICS_ENABLED:
+        RECORDS_SKIPPED.inc(reason)
+
+def count_scored(tasks: list):
+    if METRICS_ENABLED:
+        VARIANTS_SCORED.inc(tasks[0].source if tasks else 'model')
+
+def observe_batch_size(size: int):
+    if METRICS_ENABLED:
+        PREDICT_BATCH_SIZES.observe(size)
+
+def render_samples(name: str, kind: str, help: str, samples: list) -> list:
+    """
+    Exposition lines of a gauge or counter from (labels, value) samples, e.g. values read from a component's
+    stats() at scrape time.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return lines
+
+def render_metrics(extra: list = ()) -> str:
+    """All metrics in the Prometheus text exposition format, followed by `extra` lines."""
+    lines = [line for metric in METRICS for line in metric.render()]
+    lines.extend(extra)
+    return '\n'.join(lines) + '\n'
+
+def timed_endpoint(endpoint):
+    """
+    Wrap an endpoint to record when it starts and returns, so that request parsing and response serialization
+    (done by FastAPI around the endpoint) can be told apart from the endpoint itself.
+    """
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            marks = _endpoint_marks.get()
+            if marks is None:
+                return await endpoint(*args, **kwargs)
+            marks.append(time.perf_counter())
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                marks.append(time.perf_counter())
+    else:
+        @functools.wraps(endpoint)
+        def wrapper(*args, **kwargs):
+            marks = _endpoint_marks.get()
+            if marks is None:
+                return endpoint(*args, **kwargs)
+            marks.append(time.perf_counter())
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                marks.append(time.perf_counter())
+    return wrapper
+
+def instrument_handler(handler, route: str):
+    """
+    Wrap a FastAPI route handler to time the request, its parsing and its serialization, and to return the
+    per-stage timings in a Server-Timing header when the request sends X-Debug-Timing: true.
+    """
+    async def instrumented(request):
+        debug = DEBUG_TIMING_HEADER and request.headers.get(DEBUG_TIMING_REQUEST_HEADER, '').lower() in ('1', 'true')
+        if not debug and not METRICS_ENABLED:
+            return await handler(request)
+
+        timings = Timings() if debug else None
+        marks = []
+        timings_token = _timings.set(timings)
+        marks_token = _endpoint_marks.set(marks)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status_code
+        finally:
+            end = time.perf_counter()
+            _timings.reset(timings_token)
+            _endpoint_marks.reset(marks_token)
+            if len(marks) == 2:
+                record_stage('parse', marks[0] - start, timings)
+                record_stage('serialization', end - marks[1], timings)
+            if METRICS_ENABLED:
+                REQUEST_SECONDS.observe(end - start, route, status)
+
+        if timings is not None:
+            timings.add('total', end - start)
+            response.headers['Server-Timing'] = timings.server_timing()
+        return response
+
+    return instrumented
+
+class InstrumentedRoute(APIRoute):
+    """API route recording request metrics and per-stage timings (see `instrument_handler`)."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        return instrument_handler(super().get_route_handler(), self.path)
@@ -0,0 +1,356 @@
+import importlib.util
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from spliceai_api import MODEL_LOAD_WORKERS, FUSED_ENSEMBLE, PREDICT_PRECISION, SCORING_EXECUTOR, SCORING_WORKERS, \
+    WEB_CONCURRENCY, TF_INTRA_OP_THREADS, TF_INTER_OP_THREADS, INFERENCE_CONNECT_TIMEOUT
+from spliceai_api.exceptions import ScoringUnavailableException
+from spliceai_api.metrics import span
+
+logger = logging.getLogger(__name__)
+
+MODEL_FILES = tuple(f"models/spliceai{x}.h5" for x in range(1, 6))
+
+# Keras dtype policies of the precisions the models can compute in: weights stay float32 and each layer casts them
+PRECISION_POLICIES = {'float32': None, 'bfloat16': 'mixed_bfloat16', 'float16': 'mixed_float16'}
+
+# Length of the window predicted to warm the models up: a single variant scored at the default distance of 50
+WARM_UP_LENGTH = 10000 + 2 * 50 + 1
+
+def available_cores() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+def configure_threads(processes: int = None):
+    """
+    Size TensorFlow's thread pools before the models are loaded, so that the processes running the models together
+    use as many threads as there are cores rather than each using them all. `processes` defaults to the server's
+    worker processes (WEB_CONCURRENCY), times the scoring pool size when it is a process pool.
+    """
+    import tensorflow as tf
+    if processes is None:
+        processes = WEB_CONCURRENCY * (SCORING_WORKERS if SCORING_EXECUTOR == 'process' else 1)
+    intra = TF_INTRA_OP_THREADS or (max(available_cores() // processes, 1) if processes > 1 else 0)
+    try:
+        if intra:
+            tf.config.threading.set_intra_op_parallelism_threads(intra)
+        if TF_INTER_OP_THREADS:
+            tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
+    except RuntimeError as e:
+        logger.warning(f"TensorFlow threads could not be configured: {str(e)}")
+        return
+    if intra or TF_INTER_OP_THREADS:
+        logger.info(f"TensorFlow threads: {intra or 'default'} intra-op, {TF_INTER_OP_THREADS or 'default'} inter-op")
+
+def spliceai_package_dir() -> str:
+    """
+    Directory of the spliceai package, found without importing it: importing spliceai installs a SIGINT handler,
+    which fails outside the main thread (models are loaded in a background thread) and would replace the server's.
+    """
+    return importlib.util.find_spec('spliceai').submodule_search_locations[0]
+
+def load_model_file(path: str):
+    from keras.models import load_model
+    start = time.perf_counter()
+    model = load_model(path, compile=False)
+    logger.debug(f"Loaded {path} in {time.perf_counter() - start:.2f}s")
+    return model
+
+def with_precision(model, precision: str):
+    """
+    A copy of a model computing in a lower precision. The output layer (the softmax convolution) stays float32,
+    which roughly halves the error of the predictions against the float32 model.
+    """
+    policy = PRECISION_POLICIES[precision]
+    if policy is None:
+        return model
+
+    import keras
+    output_layer = model.layers[-1]
+    def clone_layer(layer):
+        return layer.__class__.from_config({**layer.get_config(),
+                                            'dtype': 'float32' if layer is output_layer else policy})
+    clone = keras.models.clone_model(model, clone_function=clone_layer)
+    clone.set_weights(model.get_weights())
+    return clone
+
+def fuse_ensemble(models: list):
+    """
+    The models as one compiled function returning their average prediction for a batch.
+
+    The batch size and window length are left unspecified in the input signature, so the function is traced once
+    for all of them rather than once for every distance and batch size.
+    """
+    import tensorflow as tf
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, None, 4), dtype=tf.float32)])
+    def ensemble(x):
+        return tf.reduce_mean(tf.stack([tf.cast(model(x, training=False), tf.float32) for model in models]), axis=0)
+
+    return ensemble
+
+def predict_ensemble(models, x: np.ndarray) -> np.ndarray:
+    """
+    Average prediction of the models for a one-hot encoded batch: through the fused graph of a `ModelSet`, or
+    one model at a time for a plain list of models.
+    """
+    ensemble = models.ensemble() if isinstance(models, ModelSet) else None
+    if ensemble is not None:
+        return ensemble(x).numpy()
+
+    outputs = []
+    for m, model in enumerate(models):
+        with span(f"predict_model{m+1}"):
+            outputs.append(np.asarray(model(x, training=False)))
+    return np.mean(outputs, axis=0)
+
+class ModelSet:
+    """
+    The five SpliceAI models, loaded on first use.
+
+    Behaves as a list of the models, so it can be passed wherever a list of models is expected; indexing or
+    iterating loads the models if they are not loaded yet. The server loads them at start up instead (see
+    `load` and `warm_up`), in the background, so that it answers health checks while they load.
+    """
+
+    def __init__(self, files: tuple = MODEL_FILES, workers: int = MODEL_LOAD_WORKERS, fused: bool = FUSED_ENSEMBLE,
+                 precision: str = PREDICT_PRECISION, processes: int = None):
+        if precision not in PRECISION_POLICIES:
+            raise ValueError(f"Unknown precision: {precision}")
+        self.files = files
+        self.workers = workers
+        self.fused = fused
+        self.precision = precision
+        self.processes = processes
+        self.load_time = None
+        self.warm_up_time = None
+        self._models = None
+        self._ensemble = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._models is not None
+
+    @property
+    def warm(self) -> bool:
+        return self.warm_up_time is not None
+
+    def load(self) -> list:
+        """Load the models, `workers` files at a time, unless already loaded."""
+        if self._models is None:
+            with self._lock:
+                if self._models is None:
+                    configure_threads(self.processes)
+                    paths = [os.path.join(spliceai_package_dir(), x) for x in self.files]
+                    start = time.perf_counter()
+                    if self.workers > 1:
+                        with ThreadPoolExecutor(max_workers=min(self.workers, len(paths)),
+                                                thread_name_prefix='model-load') as pool:
+                            models = list(pool.map(load_model_file, paths))
+                    else:
+                        models = [load_model_file(path) for path in paths]
+                    models = [with_precision(model, self.precision) for model in models]
+                    self._ensemble = fuse_ensemble(models) if self.fused else None
+                    self.load_time = time.perf_counter() - start
+                    self._models = models
+                    logger.info(f"Loaded {len(models)} SpliceAI models in {self.load_time:.2f}s")
+        return self._models
+
+    def ensemble(self):
+        """The fused ensemble function (see `fuse_ensemble`), or None if the models are run one at a time."""
+        self.load()
+        return self._ensemble
+
+    def warm_up(self):
+        """Run a first prediction, so that the first request does not pay for tracing the models' graphs."""
+        from spliceai_api.encoding import N_CODE, Window
+        from spliceai_api.inference import predict_windows
+        start = time.perf_counter()
+        predict_windows([Window(np.full(WARM_UP_LENGTH, N_CODE, dtype=np.uint8))], self)
+        self.warm_up_time = time.perf_counter() - start
+        logger.info(f"Warmed up the SpliceAI models in {self.warm_up_time:.2f}s")
+
+    def stats(self) -> dict:
+        return {
+            'loaded': self.loaded,
+            'fused': self.fused,
+            'precision': self.precision,
+            'warm': self.warm,
+            'load_time': round(self.load_time, 4) if self.load_time is not None else None,
+            'warm_up_time': round(self.warm_up_time, 4) if self.warm_up_time is not None else None
+        }
+
+    def __getitem__(self, index):
+        return self.load()[index]
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.load())
+
+# Messages between worker processes and the inference process: a header giving the sizes of a JSON part and a binary
+# part, followed by both
+MESSAGE_HEADER = struct.Struct('<II')
+
+def send_message(sock: socket.socket, header: dict, payload: bytes = b''):
+    head = json.dumps(header).encode()
+    sock.sendall(MESSAGE_HEADER.pack(len(head), len(payload)) + head + payload)
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("Inference process closed the connection")
+        received += n
+    return bytes(buffer)
+
+def recv_message(sock: socket.socket) -> tuple:
+    head_size, payload_size = MESSAGE_HEADER.unpack(recv_exactly(sock, MESSAGE_HEADER.size))
+    return json.loads(recv_exactly(sock, head_size)), recv_exactly(sock, payload_size)
+
+def encode_windows(windows: list) -> tuple:
+    """
+    A predict request for windows: `Window`s are sent as their uint8 bases (a 16th of their one-hot size), one-hot
+    arrays as float32.
+    """
+    from spliceai_api.encoding import Window
+    specs = []
+    parts = []
+    for window in windows:
+        if isinstance(window, Window):
+            specs.append([len(window.codes), 'codes', bool(window.reverse)])
+            parts.append(np.ascontiguousarray(window.codes, dtype=np.uint8).tobytes())
+        else:
+            specs.append([window.shape[0], 'one_hot', False])
+            parts.append(np.ascontiguousarray(window, dtype=np.float32).tobytes())
+    return {'windows': specs}, b''.join(parts)
+
+def decode_windows(header: dict, payload: bytes) -> list:
+    from spliceai_api.encoding import Window
+    windows = []
+    offset = 0
+    for length, kind, reverse in header['windows']:
+        if kind == 'codes':
+            windows.append(Window(np.frombuffer(payload, dtype=np.uint8, count=length, offset=offset), reverse))
+            offset += length
+        else:
+            windows.append(np.frombuffer(payload, dtype=np.float32, count=length * 4, offset=offset).reshape(length, 4))
+            offset += length * 16
+    return windows
+
+def encode_predictions(predictions: list) -> tuple:
+    return ({'shapes': [y.shape for y in predictions]},
+            b''.join(np.ascontiguousarray(y, dtype=np.float32).tobytes() for y in predictions))
+
+def decode_predictions(header: dict, payload: bytes) -> list:
+    buffer = np.frombuffer(payload, dtype=np.float32)
+    predictions = []
+    offset = 0
+    for shape in header['shapes']:
+        size = int(np.prod(shape))
+        predictions.append(buffer[offset:offset + size].reshape(shape))
+        offset += size
+    return predictions
+
+class RemoteModels:
+    """
+    The models of a shared inference process (see `spliceai_api.inference_server`), reached over a Unix socket.
+
+    Used in place of a `ModelSet` by worker processes, so that the weights are loaded once however many workers
+    serve requests. `predict_windows` sends the windows to the inference process, which batches them with those
+    of other workers. Each thread keeps its own connection.
+    """
+
+    def __init__(self, path: str, connect_timeout: float = INFERENCE_CONNECT_TIMEOUT):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.load_time = None
+        self.warm_up_time = None
+        self._local = threading.local()
+
+    @property
+    def loaded(self) -> bool:
+        return self.load_time is not None
+
+    @property
+    def warm(self) -> bool:
+        return self.warm_up_time is not None
+
+    def _connect(self) -> socket.socket:
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+        return sock
+
+    def load(self):
+        """Wait for the inference process to accept connections."""
+        if self.load_time is None:
+            start = time.perf_counter()
+            while True:
+                try:
+                    self._connect()
+                    break
+                except OSError as e:
+                    if time.perf_counter() - start > self.connect_timeout:
+                        raise ConnectionError(f"Inference process not reachable at {self.path}: {str(e)}")
+                    time.sleep(0.5)
+            self.load_time = time.perf_counter() - start
+            logger.info(f"Connected to the inference process at {self.path} in {self.load_time:.2f}s")
+        return self
+
+    def warm_up(self):
+        """Check that the inference process predicts (it warms its models up itself)."""
+        from spliceai_api.encoding import N_CODE, Window
+        start = time.perf_counter()
+        self.predict_windows([Window(np.full(WARM_UP_LENGTH, N_CODE, dtype=np.uint8))])
+        self.warm_up_time = time.perf_counter() - start
+
+    def predict_windows(self, windows: list) -> list:
+        """Predictions for windows, as from `inference.predict_windows`."""
+        if not windows:
+            return []
+        sock = self._connect()
+        try:
+            send_message(sock, *encode_windows(windows))
+            header, payload = recv_message(sock)
+        except OSError:
+            # The connection is broken: drop it, the next call reconnects
+            self._local.sock = None
+            sock.close()
+            raise
+        if 'error' in header:
+            if header.get('status_code'):
+                raise ScoringUnavailableException(header['status_code'], header['error'], header.get('details'),
+                                                  retry_after=header.get('retry_after'))
+            raise RuntimeError(f"Inference process error: {header['error']}")
+        return decode_predictions(header, payload)
+
+    def stats(self) -> dict:
+        return {
+            'inference_socket': self.path,
+            'loaded': self.loaded,
+            'warm': self.warm,
+            'load_time': round(self.load_time, 4) if self.load_time is not None else None,
+            'warm_up_time': round(self.warm_up_time, 4) if self.warm_up_time is not None else None
+        }
+
+    def __len__(self) -> int:
+        return len(MODEL_FILES)
@@ -0,0 +1,196 @@
+import logging
+import os
+import threading
+from dataclasses import dataclass
+
+import pysam
+
+from spliceai_api import PRECOMPUTED_MERGE_GAP
+from spliceai_api.formats import ScoreFormat, DEFAULT_SCORE_FORMAT
+from spliceai_api.utils import DeltaScoreTask, load_annotations
+
+logger = logging.getLogger(__name__)
+
+BASES = set('ACGT')
+SUMMARY_KEYS = ('DS_AG', 'DS_AL', 'DS_DG', 'DS_DL', 'DP_AG', 'DP_AL', 'DP_DG', 'DP_DL')
+
+@dataclass(frozen=True)
+class PrecomputedFile:
+    path: str
+    masked: bool
+    distance: int
+
+def is_snv(record) -> bool:
+    return isinstance(record.ref, str) and isinstance(record.alts, list) and record.ref in BASES and \
+        all(alt in BASES for alt in record.alts)
+
+def parse_spliceai_info(info: str) -> list:
+    """(alt, gene, summary) for each entry of the SpliceAI INFO field of a VCF line."""
+    entries = []
+    for field in info.split(';'):
+        if not field.startswith('SpliceAI='):
+            continue
+        for entry in field[len('SpliceAI='):].split(','):
+            values = entry.split('|')
+            try:
+                summary = dict(zip(SUMMARY_KEYS, [float(x) for x in values[2:6]] + [int(x) for x in values[6:10]]))
+            except ValueError:
+                continue
+            if len(summary) == len(SUMMARY_KEYS):
+                entries.append((values[0], values[1], summary))
+    return entries
+
+def merge_positions(positions: list, gap: int) -> list:
+    """Group sorted positions into (start, end) regions, merging positions at most `gap` bases apart."""
+    regions = []
+    for pos in positions:
+        if regions and pos - regions[-1][1] <= gap:
+            regions[-1][1] = pos
+        else:
+            regions.append([pos, pos])
+    return regions
+
+class PrecomputedScores:
+    """
+    Lookup of the published precomputed SpliceAI scores of SNVs, from bgzipped, tabix indexed VCFs.
+
+    The files only hold summary scores (DS/DP) for one distance, masked or not, so they can only serve summary
+    mode requests for that distance and mask. A record is served only if every (alt, overlapping gene) pair of
+    the annotation has a precomputed score; otherwise it falls back to the model.
+    """
+
+    def __init__(self, files: list, merge_gap: int = PRECOMPUTED_MERGE_GAP):
+        self.files = files
+        self.merge_gap = merge_gap
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _tabix(self, path: str) -> pysam.TabixFile:
+        # pysam file handles are not thread safe, so each thread opens its own
+        handles = self._local.__dict__.setdefault('handles', {})
+        if path not in handles:
+            handles[path] = pysam.TabixFile(path)
+        return handles[path]
+
+    def file_for(self, dist_var: int, mask: int, score_format: ScoreFormat) -> PrecomputedFile:
+        """The file that can serve a request, or None."""
+        if score_format.mode != 'summary' or score_format.top_k:
+            return None
+        for file in self.files:
+            if file.distance == dist_var and file.masked == bool(mask):
+                return file
+        return None
+
+    def fetch(self, file: PrecomputedFile, chrom: str, positions: list) -> dict:
+        """Precomputed entries at the given positions of a chromosome, keyed by (pos, ref, alt)."""
+        tbx = self._tabix(file.path)
+        contigs = set(tbx.contigs)
+        contig = next((x for x in (chrom, f"chr{chrom}", chrom[3:] if chrom.startswith('chr') else None)
+                       if x in contigs), None)
+        entries = {}
+        if contig is None:
+            return entries
+
+        for start, end in merge_positions(sorted(set(positions)), self.merge_gap):
+            for line in tbx.fetch(contig, start - 1, end):
+                fields = line.split('\t', 8)
+                if len(fields) < 8:
+                    continue
+                key = (int(fields[1]), fields[3])
+                for alt, gene, summary in parse_spliceai_info(fields[7]):
+                    entries.setdefault((*key, alt), {})[gene] = summary
+        return entries
+
+    def get_tasks(self, records: list, overlaps: list, dist_var: int, mask: int,
+                  score_format: ScoreFormat = DEFAULT_SCORE_FORMAT) -> list:
+        """
+        Precomputed DeltaScoreTasks for each record, or None for records that must be scored by the model.
+
+        `overlaps` holds each record's `Annotator.get_name_and_strand` result (or None if it was not looked up).
+        """
+        results = [None] * len(records)
+        file = self.file_for(dist_var, mask, score_format)
+        if file is None:
+            return results
+
+        by_chrom = {}
+        for k, (record, overlap) in enumerate(zip(records, overlaps)):
+            if overlap is not None and len(overlap[2]) > 0 and is_snv(record) and isinstance(record.chrom, str):
+                by_chrom.setdefault(record.chrom, []).append(k)
+
+        hits = 0
+        for chrom, ks in by_chrom.items():
+            try:
+                entries = self.fetch(file, chrom, [records[k].pos for k in ks])
+            except (OSError, ValueError) as e:
+                logger.warning(f"Precomputed score lookup failed: {str(e)}")
+                continue
+
+            for k in ks:
+                record = records[k]
+                genes, strands, _ = overlaps[k]
+                tasks = []
+                for alt in record.alts:
+                    scores = entries.get((record.pos, record.ref, alt), {})
+                    for gene, strand in zip(genes, strands):
+                        if gene not in scores:
+                            tasks = None
+                            break
+                        tasks.append(DeltaScoreTask(record=record, alt=alt, gene=gene, strand=strand,
+                                                    summary=scores[gene], source='precomputed'))
+                    if tasks is None:
+                        break
+                results[k] = tasks
+                hits += tasks is not None
+
+        with self._lock:
+            self.hits += hits
+            self.misses += len(records) - hits
+        return results
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'files': [file.path for file in self.files],
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+def load_precomputed_files(config: dict) -> list:
+    """
+    The precomputed score files listed under an annotation's `precomputed` key in annotations.yml.
+
+    Each entry names the environment variable holding the path of a score VCF (`scores`), whether its scores are
+    masked (`masked`, default false) and the distance they were computed for (`distance`, default 50). Entries
+    whose environment variable is not set are skipped.
+    """
+    files = []
+    for entry in config.get('precomputed') or []:
+        path = os.getenv(entry['scores'])
+        if not path:
+            continue
+        if not os.path.exists(path):
+            logger.warning(f"Precomputed scores {entry['scores']}: {path} not found")
+            continue
+        files.append(PrecomputedFile(path=path, masked=bool(entry.get('masked', False)),
+                                     distance=int(entry.get('distance', 50))))
+    return files
+
+_precomputed = None
+_precomputed_lock = threading.Lock()
+
+def get_precomputed_scores(annotation: str) -> PrecomputedScores:
+    """The process-wide PrecomputedScores of an annotation, or None if it has no precomputed score files."""
+    global _precomputed
+    if _precomputed is None:
+        with _precomputed_lock:
+            if _precomputed is None:
+                _precomputed = {}
+                for name, config in load_annotations().items():
+                    files = load_precomputed_files(config)
+                    if files:
+                        _precomputed[name] = PrecomputedScores(files)
+    return _precomputed.get(annotation)
@@ -0,0 +1,237 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, replace
+from importlib.resources import files
+
+from pkg_resources import resource_filename
+
+from spliceai_api import ANNOTATION_GENERATION_FILE
+from spliceai_api.exceptions import SpliceAIAPIException
+from spliceai_api.inference import REF_CACHE
+from spliceai_api.utils import Annotator, load_annotations
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class AnnotatorEntry:
+    annotator: Annotator
+    annotation_file: str
+    fasta_file: str
+    signature: tuple
+    load_time: float
+    nbytes: int
+    loaded_at: float
+    generation: int = 0
+
+def resolve_annotation_file(annotation: str) -> str:
+    """Return the gene annotation TSV used for a named annotation."""
+    if annotation in ['grch37', 'grch38']:
+        return resource_filename('spliceai_api.utils', f"annotations/{annotation}.txt")
+    return str(files("spliceai_api.annotations").joinpath(f"{annotation}.txt"))
+
+def file_signature(*paths) -> tuple:
+    """(mtime, size) of each path, used to detect when a file has changed on disk."""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except (OSError, TypeError):
+            signature.append(None)
+    return tuple(signature)
+
+def annotator_arrays(ann: Annotator) -> tuple:
+    """An Annotator's gene tables."""
+    return (ann.genes, ann.chroms, ann.strands, ann.tx_starts, ann.tx_ends, ann.exon_offsets, ann.exon_starts,
+            ann.exon_ends, ann.boundary_offsets, ann.boundaries, ann.boundary_keys)
+
+def annotator_nbytes(ann: Annotator) -> int:
+    """Approximate memory held by an Annotator's gene tables."""
+    nbytes = 0
+    for array in annotator_arrays(ann):
+        nbytes += array.nbytes
+        if array.dtype == object:
+            nbytes += sum(sys.getsizeof(x) for x in array)
+    nbytes += sum(x.nbytes for arrays in ann.intervals.values() for x in arrays)
+    return nbytes
+
+def freeze_annotator(ann: Annotator):
+    """Mark an Annotator's arrays read-only so it can be shared between threads."""
+    for array in annotator_arrays(ann):
+        array.flags.writeable = False
+
+def read_generations(path: str) -> dict:
+    """The reload generation of each annotation in a generation file, or None if it is missing or being written."""
+    try:
+        with open(path) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def bump_generation(path: str, annotation: str) -> int:
+    """Count a reload of an annotation in a generation file, returning its new generation."""
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            generations = json.loads(f.read())
+        except ValueError:
+            generations = {}
+        generations[annotation] = generations.get(annotation, 0) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(generations))
+    return generations[annotation]
+
+def shared_generation_file() -> str:
+    """
+    ANNOTATION_GENERATION_FILE, or else a new temporary generation file, exported in the environment so that the
+    processes started from this one (e.g. a scoring process pool) share it.
+    """
+    path = os.getenv("ANNOTATION_GENERATION_FILE", ANNOTATION_GENERATION_FILE)
+    if not path:
+        fd, path = tempfile.mkstemp(prefix='spliceai-annotations-', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            f.write('{}')
+        atexit.register(os.unlink, path)
+        os.environ["ANNOTATION_GENERATION_FILE"] = path
+    return path
+
+class AnnotatorRegistry:
+    """
+    Process-wide cache of Annotators keyed by annotation name.
+
+    Annotators are built once (parsing the annotation TSV and opening the FASTA) and shared by all requests.
+    Entries are never mutated after they are published; `reload` builds a replacement and swaps it in, so
+    requests already holding the previous Annotator finish undisturbed.
+
+    Processes serving the same API (uvicorn workers, a scoring process pool) share a generation file counting the
+    reloads of each annotation. `reload` counts the annotations it rebuilt there, and `get` rebuilds an annotation
+    whose generation is ahead of its own copy, so a reload requested from one process reaches all of them.
+    Replacing an annotation also clears the process's reference prediction cache.
+    """
+
+    def __init__(self, annotations: dict, generation_file: str = None):
+        self.annotations = annotations
+        self.generation_file = generation_file
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._generations = {}
+
+    def _shared_generations(self) -> dict:
+        """
+        The generations in the generation file. It is read on every call, about 15us per scoring job:
+        modification times are too coarse to tell two reloads in quick succession apart.
+        """
+        if self.generation_file:
+            generations = read_generations(self.generation_file)
+            # A file being written keeps the last generations read until the next call
+            if generations is not None:
+                self._generations = generations
+        return self._generations
+
+    def _load(self, annotation: str) -> AnnotatorEntry:
+        if annotation not in self.annotations:
+            raise SpliceAIAPIException("Annotation not available", f"{annotation} is not a configured annotation")
+
+        annotation_file = resolve_annotation_file(annotation)
+        fasta_file = os.getenv(self.annotations[annotation]['fasta'])
+        signature = file_signature(annotation_file, fasta_file)
+
+        start = time.perf_counter()
+        ann = Annotator(fasta_file, annotation_file)
+        freeze_annotator(ann)
+        load_time = time.perf_counter() - start
+
+        entry = AnnotatorEntry(annotator=ann, annotation_file=annotation_file, fasta_file=fasta_file,
+                               signature=signature, load_time=load_time, nbytes=annotator_nbytes(ann),
+                               loaded_at=time.time())
+        logger.info(f"Loaded annotation {annotation} in {load_time:.2f}s ({entry.nbytes / 2**20:.1f} MiB)")
+        return entry
+
+    def get(self, annotation: str) -> Annotator:
+        """
+        Return the shared Annotator for an annotation, loading it on first use, or again once another process
+        reloaded it.
+        """
+        generation = self._shared_generations().get(annotation, 0)
+        entry = self._entries.get(annotation)
+        if entry is None or entry.generation < generation:
+            with self._lock:
+                entry = self._entries.get(annotation)
+                if entry is None or entry.generation < generation:
+                    if entry is not None:
+                        logger.info(f"Annotation {annotation} was reloaded by another process")
+                        REF_CACHE.clear()
+                    entry = replace(self._load(annotation), generation=generation)
+                    self._entries[annotation] = entry
+        return entry.annotator
+
+    def warm(self):
+        """Load every annotation listed in annotations.yml."""
+        for annotation in self.annotations.keys():
+            self.get(annotation)
+
+    def reload(self, annotation: str = None, force: bool = False) -> list:
+        """
+        Rebuild Annotators whose annotation or FASTA file changed on disk.
+
+        Args:
+            annotation (str): Annotation to reload. All loaded annotations if None.
+            force (bool): Rebuild even if the files are unchanged.
+
+        Returns:
+            list: Names of the annotations that were rebuilt.
+        """
+        names = [annotation] if annotation is not None else list(self._entries.keys())
+        reloaded = []
+
+        for name in names:
+            entry = self._entries.get(name)
+            if not force and entry is not None and \
+                    entry.signature == file_signature(entry.annotation_file, entry.fasta_file):
+                continue
+
+            new_entry = self._load(name)
+            with self._lock:
+                if self.generation_file:
+                    new_entry = replace(new_entry, generation=bump_generation(self.generation_file, name))
+                self._entries[name] = new_entry
+            reloaded.append(name)
+
+        if reloaded:
+            REF_CACHE.clear()
+        return reloaded
+
+    def stats(self) -> dict:
+        """Load time and memory footprint of each loaded annotation."""
+        return {
+            name: {
+                'annotation_file': entry.annotation_file,
+                'fasta': entry.fasta_file,
+                'transcripts': len(entry.annotator.genes),
+                'load_time': round(entry.load_time, 4),
+                'memory_bytes': entry.nbytes,
+                'loaded_at': entry.loaded_at
+            }
+            for name, entry in list(self._entries.items())
+        }
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry() -> AnnotatorRegistry:
+    """The process-wide AnnotatorRegistry, built from annotations.yml on first use."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = AnnotatorRegistry(load_annotations(), shared_generation_file())
+    return _registry
@@ -0,0 +1,116 @@
+import asyncio
+import gzip
+import json
+
+import numpy as np
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+
+from spliceai_api import RESPONSE_FLOAT_DECIMALS, RESPONSE_COMPRESSION, RESPONSE_COMPRESSION_MIN_SIZE
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The fastest level of each encoding: score payloads are compressed on every request, and higher levels take several
+# times as long for bodies at most ~15% smaller (see `python -m benchmarks.micro --only responses`)
+COMPRESSORS = {
+    'zstd': (lambda body: zstandard.ZstdCompressor(level=1).compress(body)) if zstandard else None,
+    'br': (lambda body: brotli.compress(body, quality=1)) if brotli else None,
+    'gzip': lambda body: gzip.compress(body, compresslevel=1, mtime=0),
+}
+
+# Encodings offered for compression, preferred first, that can be produced here
+ENCODINGS = tuple(encoding for encoding in (e.strip() for e in RESPONSE_COMPRESSION.split(','))
+                  if COMPRESSORS.get(encoding) is not None)
+
+def round_floats(content, decimals: int):
+    """`content` with every float (Python, numpy scalar or in a numpy array) rounded to `decimals` decimal places."""
+    # Floats are rounded inline rather than by a call per value: records hold hundreds of thousands of them
+    if isinstance(content, dict):
+        return {key: round(value, decimals) if type(value) is float else round_floats(value, decimals)
+                for key, value in content.items()}
+    if isinstance(content, (list, tuple)):
+        return [round(value, decimals) if type(value) is float else round_floats(value, decimals) for value in content]
+    if isinstance(content, float):
+        return round(content, decimals)
+    if isinstance(content, np.ndarray) and content.dtype.kind == 'f':
+        return np.round(content, decimals)
+    if isinstance(content, np.floating):
+        return round(float(content), decimals)
+    return content
+
+def default(obj):
+    """Numpy values orjson does not serialise natively (e.g. non-contiguous arrays), and all of them for `json`."""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dumps(content, decimals: int = RESPONSE_FLOAT_DECIMALS) -> bytes:
+    """
+    Compact JSON of `content`, which may hold numpy arrays and scalars, with floats rounded to `decimals` decimal
+    places unless it is negative. Uses orjson if installed, otherwise the standard json module.
+    """
+    if decimals >= 0:
+        content = round_floats(content, decimals)
+    if orjson is not None:
+        return orjson.dumps(content, default=default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def negotiate_encoding(accept_encoding: str, encodings: tuple = ENCODINGS) -> str:
+    """
+    The encoding of `encodings` with the highest quality in an Accept-Encoding header (ties go to the first of
+    `encodings`), or None if the client accepts none of them.
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        name, q = name.strip().lower(), 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            qualities[name] = q
+
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = qualities.get(encoding, qualities.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+class ScoreResponse(JSONResponse):
+    """
+    JSON response for score payloads: rendered with orjson (numpy arrays and scalars included), floats rounded to
+    RESPONSE_FLOAT_DECIMALS, and compressed with the best encoding the client accepts once the body is at least
+    RESPONSE_COMPRESSION_MIN_SIZE bytes.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+    async def __call__(self, scope, receive, send):
+        if len(self.body) >= RESPONSE_COMPRESSION_MIN_SIZE and ENCODINGS and 'content-encoding' not in self.headers:
+            self.headers.add_vary_header('Accept-Encoding')
+            encoding = negotiate_encoding(Headers(scope=scope).get('accept-encoding', ''))
+            if encoding is not None:
+                # Large bodies take a while to compress: keep the event loop serving other requests meanwhile
+                self.body = await asyncio.to_thread(COMPRESSORS[encoding], self.body)
+                self.headers['content-encoding'] = encoding
+                self.headers['content-length'] = str(len(self.body))
+        await super().__call__(scope, receive, send)
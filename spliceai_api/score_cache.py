@@ -0,0 +1,291 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+
+from spliceai_api import SCORE_CACHE_PATH, SCORE_CACHE_MB, SCORE_CACHE_IMPORT, PREDICT_PRECISION
+
+logger = logging.getLogger(__name__)
+
+try:
+    MODEL_VERSION = f"spliceai-{version('spliceai')}"
+except PackageNotFoundError:
+    MODEL_VERSION = 'spliceai-unknown'
+# Predictions made in a reduced precision are cached apart from float32 ones
+if PREDICT_PRECISION != 'float32':
+    MODEL_VERSION = f"{MODEL_VERSION}-{PREDICT_PRECISION}"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    annotation TEXT NOT NULL,
+    chrom TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    ref TEXT NOT NULL,
+    alt TEXT NOT NULL,
+    distance INTEGER NOT NULL,
+    model_version TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    arrays BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (annotation, chrom, pos, ref, alt, distance, model_version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scores_last_access ON scores (last_access);
+"""
+
+def cache_chrom(chrom: str) -> str:
+    """Chromosome name without a 'chr' prefix, so that 'chr1' and '1' share cache entries."""
+    return chrom[3:] if chrom.startswith('chr') else chrom
+
+def pack_tasks(tasks: list) -> tuple:
+    """Serialise the predictions of an alt's scored tasks as (JSON metadata, float32 bytes)."""
+    meta = []
+    arrays = []
+    for task in tasks:
+        if task.y_ref is None:
+            continue
+        meta.append({'gene': task.gene, 'strand': task.strand, 'dist_ann': [int(x) for x in task.dist_ann],
+                     'ref_shape': task.y_ref.shape, 'alt_shape': task.y_alt.shape})
+        arrays.extend([np.ascontiguousarray(task.y_ref, dtype=np.float32).tobytes(),
+                       np.ascontiguousarray(task.y_alt, dtype=np.float32).tobytes()])
+    return json.dumps(meta, separators=(',', ':')), b''.join(arrays)
+
+def unpack_tasks(record, alt: str, meta: str, arrays: bytes) -> list:
+    """Rebuild scored DeltaScoreTasks from a cache row."""
+    from spliceai_api.utils import DeltaScoreTask
+    tasks = []
+    buffer = np.frombuffer(arrays, dtype=np.float32)
+    offset = 0
+    for entry in json.loads(meta):
+        ref_size = int(np.prod(entry['ref_shape']))
+        alt_size = int(np.prod(entry['alt_shape']))
+        task = DeltaScoreTask(record=record, alt=alt, gene=entry['gene'], strand=entry['strand'],
+                              dist_ann=tuple(entry['dist_ann']), source='cache')
+        task.y_ref = buffer[offset:offset + ref_size].reshape(entry['ref_shape'])
+        task.y_alt = buffer[offset + ref_size:offset + ref_size + alt_size].reshape(entry['alt_shape'])
+        offset += ref_size + alt_size
+        tasks.append(task)
+    return tasks
+
+class ScoreCache:
+    """
+    Persistent cache of model predictions for scored variants, in a SQLite database.
+
+    Entries are keyed by (annotation, chrom, pos, ref, alt, distance, model version) and hold the reference and
+    alternate predictions of each overlapping gene as float32 arrays, so cached variants can be formatted for any
+    mask and output format without running the models. The mask is applied when formatting and is therefore not
+    part of the key. When the database grows beyond `max_bytes` the least recently used entries are evicted.
+
+    Each thread (or worker process) uses its own connection; the database is in WAL mode so readers do not block
+    the writer.
+    """
+
+    def __init__(self, path: str, max_bytes: int, model_version: str = MODEL_VERSION):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.model_version = model_version
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        db = self._connect()
+        db.executescript(SCHEMA)
+        self.nbytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM scores").fetchone()[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _key(self, annotation: str, record, alt: str, distance: int) -> tuple:
+        return (annotation, cache_chrom(record.chrom), record.pos, record.ref, alt, distance, self.model_version)
+
+    def get(self, annotation: str, record, distance: int) -> list:
+        """
+        Scored tasks of every alt of a record, in the order `prepare_delta_scores` builds them, or None unless
+        all of its alts are cached.
+        """
+        if not isinstance(record.chrom, str) or not isinstance(record.alts, list):
+            return None
+
+        tasks = []
+        keys = []
+        try:
+            db = self._connect()
+            for alt in record.alts:
+                key = self._key(annotation, record, alt, distance)
+                row = db.execute("SELECT meta, arrays FROM scores WHERE annotation=? AND chrom=? AND pos=? AND ref=? "
+                                 "AND alt=? AND distance=? AND model_version=?", key).fetchone()
+                if row is None:
+                    with self._lock:
+                        self.misses += 1
+                    return None
+                tasks.extend(unpack_tasks(record, alt, *row))
+                keys.append(key)
+
+            db.executemany("UPDATE scores SET last_access=? WHERE annotation=? AND chrom=? AND pos=? AND ref=? "
+                           "AND alt=? AND distance=? AND model_version=?", [(time.time(), *key) for key in keys])
+        except sqlite3.Error as e:
+            logger.warning(f"Score cache lookup failed: {str(e)}")
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return tasks
+
+    def put(self, annotation: str, record, distance: int, tasks: list):
+        """
+        Store the scored tasks of a record (as returned by `prepare_delta_scores`), one entry per alt.
+
+        Failing to write to the cache is logged rather than raised, so it never fails a request.
+        """
+        rows = []
+        for alt in record.alts:
+            meta, arrays = pack_tasks([task for task in tasks if task.alt == alt])
+            rows.append((*self._key(annotation, record, alt, distance), meta, arrays,
+                         len(meta) + len(arrays), time.time()))
+
+        try:
+            db = self._connect()
+            db.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            logger.warning(f"Score cache update failed: {str(e)}")
+            return
+
+        with self._lock:
+            self.puts += len(rows)
+            self.nbytes += sum(row[-2] for row in rows)
+            over = self.nbytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is below 90% of max_bytes."""
+        db = self._connect()
+        target = int(self.max_bytes * 0.9)
+        nbytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM scores").fetchone()[0]
+        evicted = 0
+
+        while nbytes > target:
+            rows = db.execute("SELECT annotation, chrom, pos, ref, alt, distance, model_version, size FROM scores "
+                              "ORDER BY last_access LIMIT 256").fetchall()
+            if not rows:
+                break
+            victims = []
+            for row in rows:
+                if nbytes <= target:
+                    break
+                victims.append(row[:-1])
+                nbytes -= row[-1]
+            db.executemany("DELETE FROM scores WHERE annotation=? AND chrom=? AND pos=? AND ref=? AND alt=? "
+                           "AND distance=? AND model_version=?", victims)
+            evicted += len(victims)
+
+        with self._lock:
+            self.nbytes = nbytes
+            self.evictions += evicted
+
+    def clear(self, annotation: str = None):
+        """Delete all entries, or those of one annotation."""
+        db = self._connect()
+        if annotation is None:
+            db.execute("DELETE FROM scores")
+        else:
+            db.execute("DELETE FROM scores WHERE annotation=?", (annotation,))
+        with self._lock:
+            self.nbytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM scores").fetchone()[0]
+
+    def import_db(self, path: str) -> int:
+        """
+        Copy the entries of another score cache database (e.g. one precomputed offline) that are not cached yet.
+
+        Returns:
+            int: Number of entries imported.
+        """
+        db = self._connect()
+        db.execute("ATTACH DATABASE ? AS source", (path,))
+        try:
+            before = db.total_changes
+            db.execute("INSERT OR IGNORE INTO scores SELECT * FROM source.scores")
+            imported = db.total_changes - before
+        finally:
+            db.execute("DETACH DATABASE source")
+
+        logger.info(f"Imported {imported} score cache entries from {path}")
+        with self._lock:
+            self.nbytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM scores").fetchone()[0]
+            over = self.nbytes > self.max_bytes
+        if over:
+            self.evict()
+        return imported
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'path': self.path,
+            'model_version': self.model_version,
+            'bytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'puts': self.puts,
+            'evictions': self.evictions
+        }
+
+class ScopedScoreCache:
+    """A ScoreCache bound to one annotation, as passed to the scoring functions."""
+
+    def __init__(self, cache: ScoreCache, annotation: str):
+        self.cache = cache
+        self.annotation = annotation
+
+    def get(self, record, distance: int) -> list:
+        return self.cache.get(self.annotation, record, distance)
+
+    def put(self, record, distance: int, tasks: list):
+        self.cache.put(self.annotation, record, distance, tasks)
+
+_score_cache = None
+_score_cache_lock = threading.Lock()
+
+def get_score_cache() -> ScoreCache:
+    """The process-wide ScoreCache, or None if SCORE_CACHE_PATH is not set."""
+    global _score_cache
+    if _score_cache is None and SCORE_CACHE_PATH:
+        with _score_cache_lock:
+            if _score_cache is None:
+                cache = ScoreCache(SCORE_CACHE_PATH, int(SCORE_CACHE_MB * 2**20))
+                for path in filter(None, SCORE_CACHE_IMPORT.split(',')):
+                    cache.import_db(path)
+                _score_cache = cache
+    return _score_cache
+
+def scoped_score_cache(annotation: str) -> ScopedScoreCache:
+    cache = get_score_cache()
+    return ScopedScoreCache(cache, annotation) if cache is not None else None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage a SpliceAI API score cache database')
+    parser.add_argument('path', help='Score cache database')
+    parser.add_argument('--import-db', action='append', default=[], help='Score cache database to import entries from')
+    parser.add_argument('--max-mb', type=float, default=SCORE_CACHE_MB, help='Size cap (MiB)')
+    args = parser.parse_args()
+
+    cache = ScoreCache(args.path, int(args.max_mb * 2**20))
+    for path in args.import_db:
+        cache.import_db(os.path.expanduser(path))
+    print(json.dumps(cache.stats(), indent=2))
@@ -0,0 +1,55 @@
+"""
+Run the API with several worker processes:
+
+    python -m spliceai_api.serve --workers 4 --shared-models --port 5001
+
+With `--shared-models` a single inference process loads the models and predicts for every worker (see
+`spliceai_api.inference_server`), so memory does not grow with the number of workers. Otherwise each worker loads
+its own copy, with the cores divided between their TensorFlow thread pools.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the SpliceAI API')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to bind to')
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '5001')), help='Port to bind to')
+    parser.add_argument('--root-path', default='', help='ASGI root path, when served behind a path prefix')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_CONCURRENCY', '1')),
+                        help='Worker processes (default: WEB_CONCURRENCY or 1)')
+    parser.add_argument('--shared-models', action='store_true',
+                        help='Run the models in one inference process shared by the workers')
+    parser.add_argument('--socket', default=None, help='Unix socket of the inference process (default: a temporary file)')
+    args = parser.parse_args()
+
+    # uvicorn runs in its own process, so that its workers (even a single one) import spliceai_api with this
+    # configuration rather than the one this process was started with
+    env = {**os.environ, 'WEB_CONCURRENCY': str(args.workers)}
+    # One annotation generation file for all workers, so that /reload_annotations sent to one reaches the others
+    if not env.get('ANNOTATION_GENERATION_FILE'):
+        env['ANNOTATION_GENERATION_FILE'] = os.path.join(tempfile.mkdtemp(prefix='spliceai-'), 'annotations.json')
+        with open(env['ANNOTATION_GENERATION_FILE'], 'w') as f:
+            f.write('{}')
+    processes = []
+    # Stop the inference process and the workers when this process is stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.shared_models:
+            env['INFERENCE_SOCKET'] = args.socket or os.path.join(tempfile.mkdtemp(prefix='spliceai-'), 'inference.sock')
+            processes.append(subprocess.Popen([sys.executable, '-m', 'spliceai_api.inference_server',
+                                               '--socket', env['INFERENCE_SOCKET']], env=env))
+        web = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'spliceai_api.app:app', '--host', args.host,
+                                '--port', str(args.port), '--workers', str(args.workers),
+                                '--root-path', args.root_path], env=env)
+        processes.append(web)
+        sys.exit(web.wait())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
@@ -1,23 +1,41 @@
+from collections import defaultdict
 from dataclasses import dataclass
 import yaml
-import logging, os
+import logging, os, time
 from importlib.resources import files
 
 from spliceai_api.exceptions import SpliceAIAPIException
-from spliceai_api import ENSEMBL_TIMEOUT
 
-from pyfaidx import Fasta
-import requests
-from keras.models import load_model
 from pkg_resources import resource_filename
-from spliceai.utils import one_hot_encode, normalise_chrom
 import numpy as np
 import pandas as pd
 
-from spliceai_api import MODELS
+from spliceai_api import MODELS, PREDICT_BATCH_SIZE, REF_REGION_WIDTH, CUSTOM_SEQ_TILE_SIZE, CUSTOM_SEQ_TILE_BATCH
+from spliceai_api.annotation_index import load_annotation_tables, nearest_boundaries
+from spliceai_api.encoding import Window, N_CODE, sequence_codes, padded_window, substituted_window
+from spliceai_api.formats import ScoreFormat, DEFAULT_SCORE_FORMAT, format_stats, format_summary, format_top_k
+from spliceai_api.genome import open_reference
+from spliceai_api.inference import predict_windows, plan_ref_regions, RefPredictionCache, REF_CACHE
+from spliceai_api.metrics import span, count_scored, count_skipped
 
 logger = logging.getLogger(__name__)
 
+def normalise_chrom(source, target):
+    """
+    `spliceai.utils.normalise_chrom`: `source` with a 'chr' prefix added or removed to match `target`. Defined here
+    as importing `spliceai.utils` imports Keras and TensorFlow, which worker processes using a shared inference
+    process do not otherwise need.
+    """
+    def has_prefix(x):
+        return x.startswith('chr')
+
+    if has_prefix(source) and not has_prefix(target):
+        return source.strip('chr')
+    elif not has_prefix(source) and has_prefix(target):
+        return 'chr'+source
+
+    return source
+
 @dataclass
 class Record:
     chrom: str = None
@@ -35,50 +53,138 @@ class Annotator:
             annotations = resource_filename(__name__, 'annotations/grch38.txt')
 
         try:
-            df = pd.read_csv(annotations, sep='\t', dtype={'CHROM': object})
-            self.genes = df['#NAME'].to_numpy()
-            self.chroms = df['CHROM'].to_numpy()
-            self.strands = df['STRAND'].to_numpy()
-            self.tx_starts = df['TX_START'].to_numpy()+1
-            self.tx_ends = df['TX_END'].to_numpy()
-            self.exon_starts = [np.asarray([int(i) for i in c.split(',') if i])+1
-                                for c in df['EXON_START'].to_numpy()]
-            self.exon_ends = [np.asarray([int(i) for i in c.split(',') if i])
-                              for c in df['EXON_END'].to_numpy()]
+            tables = load_annotation_tables(annotations)
+            self.genes = tables['genes'].astype(object)
+            self.chroms = tables['chroms'].astype(object)
+            self.strands = tables['strands'].astype(object)
+            self.tx_starts = tables['tx_starts']
+            self.tx_ends = tables['tx_ends']
+            # Exons of transcript i: exon_starts[exon_offsets[i]:exon_offsets[i+1]] and the matching exon_ends
+            self.exon_offsets = tables['exon_offsets']
+            self.exon_starts = tables['exon_starts']
+            self.exon_ends = tables['exon_ends']
+            # Sorted exon boundaries of transcript i: boundaries[boundary_offsets[i]:boundary_offsets[i+1]]
+            self.boundary_offsets = tables['boundary_offsets']
+            self.boundaries = tables['boundaries']
+            self.boundary_keys = tables['boundary_keys']
         except IOError as e:
             logging.error('{}'.format(e))
-            exit()
-        except (KeyError, pd.errors.ParserError) as e:
+            raise SpliceAIAPIException('Gene annotation file could not be read', str(e))
+        except (KeyError, ValueError) as e:
             logging.error('Gene annotation file {} not formatted properly: {}'.format(annotations, e))
-            exit()
+            raise SpliceAIAPIException('Gene annotation file not formatted properly', f"{annotations}: {e}")
 
         try:
-            self.ref_fasta = Fasta(ref_fasta, rebuild=False)
+            self.ref_fasta = open_reference(ref_fasta)
         except IOError as e:
             logging.error('{}'.format(e))
-            exit()
+            raise SpliceAIAPIException('Genomic reference could not be read', str(e))
+
+        self.chrom_prefix = self.chroms[0] if len(self.chroms) else ''
+        self.intervals = self.build_intervals()
+
+    def build_intervals(self) -> dict:
+        """
+        Per-chromosome interval index over transcripts.
+
+        For each chromosome, transcripts are sorted by start. Alongside the sorted starts and matching ends the
+        index keeps the running maximum of the ends, so the transcripts overlapping a position are found with two
+        binary searches: those with start <= pos, minus the prefix whose running maximum end is < pos.
+
+        Returns:
+            dict: chrom -> (transcript indices, sorted starts, ends, running maximum of ends)
+        """
+        intervals = {}
+        for chrom in pd.unique(self.chroms):
+            idxs = np.nonzero(self.chroms == chrom)[0]
+            order = idxs[np.argsort(self.tx_starts[idxs], kind='stable')]
+            ends = self.tx_ends[order]
+            arrays = (order, self.tx_starts[order], ends, np.maximum.accumulate(ends))
+            for array in arrays:
+                array.flags.writeable = False
+            intervals[chrom] = arrays
+        return intervals
+
+    def get_overlapping_idxs(self, chrom, positions) -> list:
+        """
+        Indices of the transcripts overlapping each of an array of positions on one chromosome.
+
+        Args:
+            chrom (str): Chromosome, normalised to the naming of the annotation.
+            positions (array-like): 1-based positions.
+
+        Returns:
+            list: A sorted index array per position.
+        """
+        positions = np.asarray(positions)
+        if chrom not in self.intervals:
+            return [np.empty(0, dtype=np.intp) for _ in positions]
+
+        order, starts, ends, max_ends = self.intervals[chrom]
+        # Candidates for positions[i] are order[lo[i]:hi[i]]: start <= pos and the running maximum end >= pos
+        hi = np.searchsorted(starts, positions, side='right')
+        lo = np.minimum(np.searchsorted(max_ends, positions, side='left'), hi)
+        counts = hi-lo
+
+        owner = np.repeat(np.arange(len(positions)), counts)
+        candidates = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)+np.repeat(lo, counts)
+        hits = ends[candidates] >= positions[owner]
+
+        idxs = np.split(order[candidates[hits]], np.cumsum(np.bincount(owner[hits], minlength=len(positions)))[:-1])
+        return [np.sort(x) for x in idxs]
 
     def get_name_and_strand(self, chrom, pos):
 
-        chrom = normalise_chrom(chrom, list(self.chroms)[0])
-        idxs = np.intersect1d(np.nonzero(self.chroms == chrom)[0],
-                              np.intersect1d(np.nonzero(self.tx_starts <= pos)[0],
-                              np.nonzero(pos <= self.tx_ends)[0]))
+        chrom = normalise_chrom(chrom, self.chrom_prefix)
+        idxs = self.get_overlapping_idxs(chrom, [pos])[0]
 
         if len(idxs) >= 1:
             return self.genes[idxs], self.strands[idxs], idxs
         else:
             return [], [], []
 
+    def get_names_and_strands(self, chrom, positions) -> list:
+        """Vectorised `get_name_and_strand` for an array of positions on one chromosome."""
+
+        chrom = normalise_chrom(chrom, self.chrom_prefix)
+        results = []
+
+        for idxs in self.get_overlapping_idxs(chrom, positions):
+            if len(idxs) >= 1:
+                results.append((self.genes[idxs], self.strands[idxs], idxs))
+            else:
+                results.append(([], [], []))
+
+        return results
+
+    def get_exons(self, idx) -> tuple:
+        """Exon starts and ends of a transcript."""
+        lo, hi = self.exon_offsets[idx], self.exon_offsets[idx+1]
+        return self.exon_starts[lo:hi], self.exon_ends[lo:hi]
+
     def get_pos_data(self, idx, pos):
 
         dist_tx_start = self.tx_starts[idx]-pos
         dist_tx_end = self.tx_ends[idx]-pos
-        dist_exon_bdry = min(np.union1d(self.exon_starts[idx], self.exon_ends[idx])-pos, key=abs)
+        dist_exon_bdry = self.get_exon_distances([idx], [pos])[0]
         dist_ann = (dist_tx_start, dist_tx_end, dist_exon_bdry)
 
         return dist_ann
 
+    def get_pos_data_batch(self, idxs, positions) -> list:
+        """Vectorised `get_pos_data` for arrays of transcript indices and positions."""
+
+        idxs, positions = np.asarray(idxs, dtype=np.intp), np.asarray(positions)
+        dist_tx_starts = self.tx_starts[idxs]-positions
+        dist_tx_ends = self.tx_ends[idxs]-positions
+        dist_exon_bdrys = self.get_exon_distances(idxs, positions)
+
+        return list(zip(dist_tx_starts, dist_tx_ends, dist_exon_bdrys))
+
+    def get_exon_distances(self, idxs, positions) -> np.ndarray:
+        """Distance from each position to the nearest exon boundary of a transcript, for arrays of both."""
+        return nearest_boundaries(self.boundaries, self.boundary_keys, self.boundary_offsets, idxs, positions)
+
 def load_annotations() -> dict:
     logger.debug("Loading annotations")
     annotation_config = files("spliceai_api.annotations").joinpath("annotations.yml")
@@ -96,79 +202,116 @@ def validate_fasta(assemblies: list):
         elif not os.path.exists(os.getenv(assembly)):
             raise SpliceAIAPIException("Genomic reference not found", f"FASTA file for {assembly}: {os.getenv(assembly)} not found")
  
-def score_custom_sequence(sequence: str, models: list) -> dict:
+def score_custom_sequence(sequence: str, models: list, tile_size: int = CUSTOM_SEQ_TILE_SIZE,
+                          tile_batch: int = CUSTOM_SEQ_TILE_BATCH) -> dict:
+    """
+    Acceptor and donor probabilities for every base of a sequence.
+
+    The sequence is scored in tiles of `tile_size` bases, each with the 5000 bases of flanking context (N beyond the
+    ends of the sequence) the models need on either side, `tile_batch` tiles at a time. Memory is bounded by the
+    tile size rather than the sequence length, and the stitched output matches scoring the sequence in one piece.
+    """
     logger.debug(f"Scoring sequence: {sequence}")
     context = 10000
-    x = one_hot_encode('N'*(context//2) + sequence + 'N'*(context//2))[None, :]
-    y = np.mean([models[m].predict(x) for m in range(5)], axis=0)
-
+    tile_size = min(tile_size, len(sequence))
+    padded = np.full(len(sequence)+context+tile_size, N_CODE, dtype=np.uint8)
+    padded[context//2:context//2+len(sequence)] = sequence_codes(sequence)
+
+    y = np.empty((len(sequence), 3), dtype=np.float32)
+    starts = range(0, len(sequence), tile_size)
+
+    for i in range(0, len(starts), tile_batch):
+        group = starts[i:i+tile_batch]
+        # The last tile is N-padded to full width, beyond the context of any position it reports
+        windows = [Window(padded[start:start+tile_size+context]) for start in group]
+        for start, y_tile in zip(group, predict_windows(windows, models, tile_batch)):
+            n = min(tile_size, len(sequence)-start)
+            y[start:start+n] = y_tile[0, :n]
+
+    # Arrays rather than lists, serialised natively by `responses.ScoreResponse` (as float64, so each value is written
+    # with the same digits as the lists were)
     return {
-        'acceptor_prob': y[0, :, 1].tolist(),
-        'donor_prob': y[0, :, 2].tolist()
+        'acceptor_prob': y[:, 1].astype(np.float64),
+        'donor_prob': y[:, 2].astype(np.float64)
     }
 
-def ensembl_get_genomic_coord(variant: str, assembly: str = 'grch38') -> dict:
-    logger.debug(f"Obtaining genomic position for variant: {variant}, assembly: {assembly}")
-    server = 'https://grch37.rest.ensembl.org' if assembly=='grch37' else 'https://rest.ensembl.org'
-    ext = f"/variant_recoder/human/{variant}?fields=None&vcf_string=1"
-    logger.debug(f"Ensembl URL: {server}{ext}")
-
-    resp = requests.get(server+ext, headers={ "Content-Type" : "application/json"}, timeout=float(ENSEMBL_TIMEOUT))
-    if not resp.ok:
-        resp.raise_for_status()
-
-    resp_json = resp.json()
-
-    chrom, pos, ref, alt = resp_json[0][list(resp_json[0].keys())[0]]['vcf_string'][0].split('-')
-
-    return({
-        'chr': chrom,
-        'pos': pos,
-        'ref': ref,
-        'alt': alt
-    })
-
-def get_delta_scores(record, ann, dist_var, mask, models):
-
+@dataclass
+class DeltaScoreTask:
+    """A single (alt, gene) pair of a record together with its model inputs and outputs."""
+    record: Record
+    alt: str
+    gene: str
+    strand: str
+    dist_ann: tuple = None
+    ref_bucket: tuple = None
+    ref_window: tuple = None
+    x_ref: Window = None
+    x_alt: Window = None
+    y_ref: np.ndarray = None
+    y_alt: np.ndarray = None
+    delta_score: str = None
+    summary: dict = None
+    source: str = 'model'
+
+def prepare_delta_scores(record, ann, dist_var, overlaps: tuple = None) -> list:
+    """
+    Validate a record and build the reference and alternate windows for each (alt, gene) pair.
+
+    `overlaps` is the record's `Annotator.get_name_and_strand` result, when it has already been looked up.
+
+    Raises:
+        SpliceAIAPIException: If the record cannot be scored.
+    """
     cov = 2*dist_var+1
     wid = 10000+cov
-    delta_scores = []
-    spliceai_variant_records = []
 
     try:
         record.chrom, record.pos, record.ref, len(record.alts)
     except TypeError:
         logging.error('Skipping record (bad input): {}'.format(record))
+        count_skipped('bad_input')
         raise SpliceAIAPIException('Skipping record (bad input): {}'.format(record))
 
-    (genes, strands, idxs) = ann.get_name_and_strand(record.chrom, record.pos)
+    if overlaps is None:
+        with span('annotation'):
+            overlaps = ann.get_name_and_strand(record.chrom, record.pos)
+    (genes, strands, idxs) = overlaps
     if len(idxs) == 0:
         logging.warning("No gene annotations found for given location")
+        count_skipped('no_gene')
         raise SpliceAIAPIException('No gene annotations found for given location: {}'.format(record))
 
     chrom = normalise_chrom(record.chrom, list(ann.ref_fasta.keys())[0])
     try:
-        seq = ann.ref_fasta[chrom][record.pos-wid//2-1:record.pos+wid//2].seq
+        with span('fasta'):
+            seq = sequence_codes(ann.ref_fasta[chrom][record.pos-wid//2-1:record.pos+wid//2])
     except KeyError as e:
         logging.error(f"Encountered error: {str(e)}")
+        count_skipped('unknown_chromosome')
         raise SpliceAIAPIException('Encountered error: {}'.format(str(e)))
     except (IndexError, ValueError):
         logging.warning('Skipping record (fasta issue): {}'.format(record))
+        count_skipped('fasta_issue')
         raise SpliceAIAPIException('Skipping record (fasta issue): {}'.format(record))
 
-    if seq[wid//2:wid//2+len(record.ref)].upper() != record.ref:
+    if seq[wid//2:wid//2+len(record.ref)].tobytes().decode('latin-1').upper() != record.ref:
         logging.warning('Skipping record (ref issue): {}'.format(record))
+        count_skipped('ref_issue')
         raise SpliceAIAPIException('Skipping record (ref issue): {}'.format(record))
 
     if len(seq) != wid:
         logging.warning('Skipping record (near chromosome end): {}'.format(record))
+        count_skipped('near_chromosome_end')
         raise SpliceAIAPIException('Skipping record (near chromosome end): {}'.format(record))
 
     if len(record.ref) > 2*dist_var:
         logging.warning('Skipping record (ref too long): {}'.format(record))
+        count_skipped('ref_too_long')
         raise SpliceAIAPIException('Skipping record (ref too long): {}'.format(record))
 
-    spliceai_stats = []
+    with span('annotation'):
+        dist_anns = ann.get_pos_data_batch(idxs, np.full(len(idxs), record.pos))
+    tasks = []
 
     for j in range(len(record.alts)):
         for i in range(len(idxs)):
@@ -179,112 +322,455 @@ def get_delta_scores(record, ann, dist_var, mask, models):
             if '<' in record.alts[j] or '>' in record.alts[j]:
                 continue
 
+            task = DeltaScoreTask(record=record, alt=record.alts[j], gene=genes[i], strand=strands[i])
+            tasks.append(task)
+
             if len(record.ref) > 1 and len(record.alts[j]) > 1:
-                delta_scores.append("{}|{}|.|.|.|.|.|.|.|.".format(record.alts[j], genes[i]))
+                task.delta_score = "{}|{}|.|.|.|.|.|.|.|.".format(record.alts[j], genes[i])
                 continue
 
-            dist_ann = ann.get_pos_data(idxs[i], record.pos)
-            pad_size = [max(wid//2+dist_ann[0], 0), max(wid//2-dist_ann[1], 0)]
+            task.dist_ann = dist_anns[i]
+            pad_size = [max(wid//2+task.dist_ann[0], 0), max(wid//2-task.dist_ann[1], 0)]
             ref_len = len(record.ref)
-            alt_len = len(record.alts[j])
-            del_len = max(ref_len-alt_len, 0)
-
-            x_ref = 'N'*pad_size[0]+seq[pad_size[0]:wid-pad_size[1]]+'N'*pad_size[1]
-            x_alt = x_ref[:wid//2]+str(record.alts[j])+x_ref[wid//2+ref_len:]
-
-            x_ref = one_hot_encode(x_ref)[None, :]
-            x_alt = one_hot_encode(x_alt)[None, :]
-
-            if strands[i] == '-':
-                x_ref = x_ref[:, ::-1, ::-1]
-                x_alt = x_alt[:, ::-1, ::-1]
-
-            y_ref = np.mean([models[m].predict(x_ref) for m in range(5)], axis=0)
-            y_alt = np.mean([models[m].predict(x_alt) for m in range(5)], axis=0)
-
-            if strands[i] == '-':
-                y_ref = y_ref[:, ::-1]
-                y_alt = y_alt[:, ::-1]
-
-            if ref_len > 1 and alt_len == 1:
-                y_alt = np.concatenate([
-                    y_alt[:, :cov//2+alt_len],
-                    np.zeros((1, del_len, 3)),
-                    y_alt[:, cov//2+alt_len:]],
-                    axis=1)
-            elif ref_len == 1 and alt_len > 1:
-                y_alt = np.concatenate([
-                    y_alt[:, :cov//2],
-                    np.max(y_alt[:, cov//2:cov//2+alt_len], axis=1)[:, None, :],
-                    y_alt[:, cov//2+alt_len:]],
-                    axis=1)
-
-            y = np.concatenate([y_ref, y_alt])
-
-            idx_pa = (y[1, :, 1]-y[0, :, 1]).argmax()
-            idx_na = (y[0, :, 1]-y[1, :, 1]).argmax()
-            idx_pd = (y[1, :, 2]-y[0, :, 2]).argmax()
-            idx_nd = (y[0, :, 2]-y[1, :, 2]).argmax()
-
-            mask_pa = np.logical_and((idx_pa-cov//2 == dist_ann[2]), mask)
-            mask_na = np.logical_and((idx_na-cov//2 != dist_ann[2]), mask)
-            mask_pd = np.logical_and((idx_pd-cov//2 == dist_ann[2]), mask)
-            mask_nd = np.logical_and((idx_nd-cov//2 != dist_ann[2]), mask)
-
-            delta_scores.append("{}|{}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{}|{}|{}|{}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{:.2f}".format(
-                                record.alts[j],
-                                genes[i],
-                                (y[1, idx_pa, 1]-y[0, idx_pa, 1])*(1-mask_pa),
-                                (y[0, idx_na, 1]-y[1, idx_na, 1])*(1-mask_na),
-                                (y[1, idx_pd, 2]-y[0, idx_pd, 2])*(1-mask_pd),
-                                (y[0, idx_nd, 2]-y[1, idx_nd, 2])*(1-mask_nd),
-                                idx_pa-cov//2,
-                                idx_na-cov//2,
-                                idx_pd-cov//2,
-                                idx_nd-cov//2,
-                                y[0, idx_pa, 1],
-                                y[1, idx_pa, 1],
-                                y[0, idx_na, 1],
-                                y[1, idx_na, 1],
-                                y[0, idx_pd, 2],
-                                y[1, idx_pd, 2],
-                                y[0, idx_nd, 2],
-                                y[1, idx_nd, 2]))
-
-            dist_from_variant = np.arange(-1 * dist_var, 0).tolist()
-            dist_from_variant.extend(np.arange(0, dist_var + 1).tolist())
-
-            donor = (y_alt[0, :, 2] - y_ref[0, :, 2]).tolist()
-            donor_ref = y_ref[0, :, 2].tolist()
-            donor_alt = y_alt[0, :, 2].tolist()
-            acceptor = (y_alt[0, :, 1] - y_ref[0, :, 1]).tolist()
-            acceptor_ref = y_ref[0, :, 1].tolist()
-            acceptor_alt = y_alt[0, :, 1].tolist()
-
-            spliceai_variant_record = {}
-            spliceai_stats = []
-
-            for index in np.arange(0, len(dist_from_variant)):
-                stat_record = {
-                    'dist_from_variant': dist_from_variant[index],
-                    'donor_ref': donor_ref[index],
-                    'donor_alt': donor_alt[index],
-                    'donor': donor[index],
-                    'acceptor_ref': acceptor_ref[index],
-                    'acceptor_alt': acceptor_alt[index],
-                    'acceptor': acceptor[index]
-                }
-
-                spliceai_stats.append(stat_record)
-
-            spliceai_variant_record['gene'] = genes[i]
-            spliceai_variant_record['strand'] = strands[i]
-            spliceai_variant_record['chr'] = record.chrom
-            spliceai_variant_record['pos'] = record.pos
-            spliceai_variant_record['ref'] = record.ref
-            spliceai_variant_record['alt'] = record.alts[j]
-            spliceai_variant_record['stats'] = spliceai_stats
-
-            spliceai_variant_records.append(spliceai_variant_record)
-
-    return spliceai_variant_records
\ No newline at end of file
+
+            win_start, win_end = record.pos-wid//2, record.pos+wid//2
+            task.ref_bucket = (ann.ref_fasta.filename, chrom, strands[i])
+            task.ref_window = (win_start, win_end, win_start+pad_size[0], win_end-pad_size[1])
+
+            with span('encoding'):
+                task.x_ref = padded_window(seq, pad_size[0], pad_size[1], reverse=strands[i] == '-')
+                task.x_alt = substituted_window(task.x_ref, wid//2, ref_len, str(record.alts[j]))
+
+    return tasks
+
+def prefetch_windows(ann, chrom: str, positions: list, dist_var: int):
+    """Read ahead the reference windows of records on one chromosome, if the reference supports it."""
+    if not hasattr(ann.ref_fasta, 'prefetch'):
+        return
+    wid = 10000+2*dist_var+1
+    chrom = normalise_chrom(chrom, list(ann.ref_fasta.keys())[0])
+    if chrom in ann.ref_fasta:
+        ann.ref_fasta.prefetch(chrom, [pos-wid//2-1 for pos in positions], [pos+wid//2 for pos in positions])
+
+def ref_region_window(ann, bucket: tuple, region: tuple) -> np.ndarray:
+    """Reference window for a region, N-padded outside its reference span."""
+    _, chrom, strand = bucket
+    win_start, win_end, real_lo, real_hi = region
+
+    codes = np.full(win_end-win_start+1, N_CODE, dtype=np.uint8)
+    with span('fasta'):
+        codes[real_lo-win_start:real_hi-win_start+1] = sequence_codes(ann.ref_fasta[chrom][real_lo-1:real_hi])
+
+    return Window(codes, reverse=strand == '-')
+
+@dataclass
+class PredictionPlan:
+    """The windows that must be run through the ensemble to score a set of tasks."""
+    tasks: list
+    missing: list
+    regions: list
+    windows: list
+
+def plan_delta_scores(tasks: list, ann, ref_cache: RefPredictionCache = REF_CACHE) -> PredictionPlan:
+    """
+    Work out which windows need predicting for a set of tasks.
+
+    Reference predictions are taken from `ref_cache` where possible. The remaining reference windows are merged
+    into regions (several alts or genes at one site, or nearby variants of one gene), predicted once and sliced.
+    """
+    tasks = [task for task in tasks if task.x_ref is not None]
+
+    missing = []
+    for task in tasks:
+        y = ref_cache.get(task.ref_bucket, task.ref_window) if ref_cache is not None else None
+        if y is None:
+            missing.append(task)
+        else:
+            task.y_ref = (y[::-1] if task.strand == '-' else y)[None, :]
+
+    tx_bounds = [(task.record.pos+task.dist_ann[0], task.record.pos+task.dist_ann[1]) for task in missing]
+    regions = plan_ref_regions([(task.ref_bucket, bounds, task.ref_window) for task, bounds in zip(missing, tx_bounds)],
+                               REF_REGION_WIDTH)
+
+    ref_windows = []
+    for bucket, region, members in regions:
+        if len(members) == 1 and missing[members[0]].ref_window == region:
+            ref_windows.append(missing[members[0]].x_ref)
+        else:
+            ref_windows.append(ref_region_window(ann, bucket, region))
+
+    return PredictionPlan(tasks=tasks, missing=missing, regions=regions,
+                          windows=ref_windows + [task.x_alt for task in tasks])
+
+def apply_predictions(plan: PredictionPlan, predictions: list, ref_cache: RefPredictionCache = REF_CACHE):
+    """Store the predictions for the windows of a plan as y_ref and y_alt on its tasks."""
+    for (bucket, region, members), y in zip(plan.regions, predictions):
+        strand = bucket[2]
+        y = y[0, ::-1] if strand == '-' else y[0]
+        if ref_cache is not None:
+            ref_cache.put(bucket, region, y)
+
+        for i in members:
+            task = plan.missing[i]
+            offset = task.ref_window[0]-region[0]
+            y_ref = y[offset:offset+task.ref_window[1]-task.ref_window[0]+1-10000]
+            task.y_ref = (y_ref[::-1] if strand == '-' else y_ref)[None, :]
+
+    for task, y in zip(plan.tasks, predictions[len(plan.regions):]):
+        task.y_alt = y
+
+def predict_delta_scores(tasks: list, ann, models: list, batch_size: int = PREDICT_BATCH_SIZE,
+                         ref_cache: RefPredictionCache = REF_CACHE):
+    """Run the ensemble over the windows of all tasks at once, storing y_ref and y_alt on each task."""
+    plan = plan_delta_scores(tasks, ann, ref_cache)
+    apply_predictions(plan, predict_windows(plan.windows, models, batch_size), ref_cache)
+
+def format_delta_score(task: DeltaScoreTask, dist_var, mask, score_format: ScoreFormat = DEFAULT_SCORE_FORMAT) -> dict:
+    """Turn the predictions of a task into a delta score record. Returns None for tasks that were not scored."""
+    if task.summary is not None:
+        return {'gene': task.gene, 'strand': task.strand, 'chr': task.record.chrom, 'pos': task.record.pos,
+                'ref': task.record.ref, 'alt': task.alt, 'source': task.source, 'summary': task.summary}
+    if task.y_ref is None:
+        return None
+
+    cov = 2*dist_var+1
+    record = task.record
+    dist_ann = task.dist_ann
+    ref_len = len(record.ref)
+    alt_len = len(task.alt)
+    del_len = max(ref_len-alt_len, 0)
+    y_ref = task.y_ref
+    y_alt = task.y_alt
+
+    if task.strand == '-':
+        y_ref = y_ref[:, ::-1]
+        y_alt = y_alt[:, ::-1]
+
+    if ref_len > 1 and alt_len == 1:
+        y_alt = np.concatenate([
+            y_alt[:, :cov//2+alt_len],
+            np.zeros((1, del_len, 3)),
+            y_alt[:, cov//2+alt_len:]],
+            axis=1)
+    elif ref_len == 1 and alt_len > 1:
+        y_alt = np.concatenate([
+            y_alt[:, :cov//2],
+            np.max(y_alt[:, cov//2:cov//2+alt_len], axis=1)[:, None, :],
+            y_alt[:, cov//2+alt_len:]],
+            axis=1)
+
+    y = np.concatenate([y_ref, y_alt])
+
+    idx_pa = (y[1, :, 1]-y[0, :, 1]).argmax()
+    idx_na = (y[0, :, 1]-y[1, :, 1]).argmax()
+    idx_pd = (y[1, :, 2]-y[0, :, 2]).argmax()
+    idx_nd = (y[0, :, 2]-y[1, :, 2]).argmax()
+
+    mask_pa = np.logical_and((idx_pa-cov//2 == dist_ann[2]), mask)
+    mask_na = np.logical_and((idx_na-cov//2 != dist_ann[2]), mask)
+    mask_pd = np.logical_and((idx_pd-cov//2 == dist_ann[2]), mask)
+    mask_nd = np.logical_and((idx_nd-cov//2 != dist_ann[2]), mask)
+
+    task.delta_score = "{}|{}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{}|{}|{}|{}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{:.2f}".format(
+                        task.alt,
+                        task.gene,
+                        (y[1, idx_pa, 1]-y[0, idx_pa, 1])*(1-mask_pa),
+                        (y[0, idx_na, 1]-y[1, idx_na, 1])*(1-mask_na),
+                        (y[1, idx_pd, 2]-y[0, idx_pd, 2])*(1-mask_pd),
+                        (y[0, idx_nd, 2]-y[1, idx_nd, 2])*(1-mask_nd),
+                        idx_pa-cov//2,
+                        idx_na-cov//2,
+                        idx_pd-cov//2,
+                        idx_nd-cov//2,
+                        y[0, idx_pa, 1],
+                        y[1, idx_pa, 1],
+                        y[0, idx_na, 1],
+                        y[1, idx_na, 1],
+                        y[0, idx_pd, 2],
+                        y[1, idx_pd, 2],
+                        y[0, idx_nd, 2],
+                        y[1, idx_nd, 2])
+
+    spliceai_variant_record = {}
+
+    spliceai_variant_record['gene'] = task.gene
+    spliceai_variant_record['strand'] = task.strand
+    spliceai_variant_record['chr'] = record.chrom
+    spliceai_variant_record['pos'] = record.pos
+    spliceai_variant_record['ref'] = record.ref
+    spliceai_variant_record['alt'] = task.alt
+    spliceai_variant_record['source'] = task.source
+    if score_format.mode == 'summary':
+        spliceai_variant_record['summary'] = format_summary(y_ref[0], y_alt[0], dist_var,
+                                                            (mask_pa, mask_na, mask_pd, mask_nd))
+    else:
+        spliceai_variant_record['stats'] = format_stats(y_ref[0], y_alt[0], dist_var, score_format)
+    if score_format.top_k:
+        spliceai_variant_record['top'] = format_top_k(y_ref[0], y_alt[0], dist_var, score_format.top_k)
+
+    return spliceai_variant_record
+
+def lookup_delta_scores(record, ann, dist_var, mask, score_format: ScoreFormat = DEFAULT_SCORE_FORMAT,
+                        score_cache=None, precomputed=None) -> list:
+    """Tasks of a record served by precomputed scores or the score cache, without the models. None on a miss."""
+    tasks = None
+    with span('cache_lookup'):
+        if precomputed is not None and precomputed.file_for(dist_var, mask, score_format) is not None:
+            tasks = precomputed.get_tasks([record], [ann.get_name_and_strand(record.chrom, record.pos)], dist_var,
+                                          mask, score_format)[0]
+        if tasks is None and score_cache is not None:
+            tasks = score_cache.get(record, dist_var)
+    return tasks
+
+def get_delta_scores(record, ann, dist_var, mask, models, batch_size: int = PREDICT_BATCH_SIZE,
+                     score_format: ScoreFormat = DEFAULT_SCORE_FORMAT, score_cache=None, precomputed=None):
+
+    tasks = lookup_delta_scores(record, ann, dist_var, mask, score_format, score_cache, precomputed)
+    if tasks is None:
+        tasks = prepare_delta_scores(record, ann, dist_var)
+        predict_delta_scores(tasks, ann, models, batch_size)
+        if score_cache is not None:
+            with span('cache_store'):
+                score_cache.put(record, dist_var, tasks)
+
+    with span('postprocess'):
+        spliceai_variant_records = [format_delta_score(task, dist_var, mask, score_format) for task in tasks]
+    count_scored(tasks)
+
+    return [x for x in spliceai_variant_records if x is not None]
+
+def get_bulk_delta_scores(records: list, ann, dist_var, mask, models, batch_size: int = PREDICT_BATCH_SIZE,
+                          score_format: ScoreFormat = DEFAULT_SCORE_FORMAT, score_cache=None, precomputed=None) -> list:
+    """
+    Score many records, running the ensemble over the windows of several records at a time.
+
+    Records are prepared until at least `batch_size` windows are pending, which are then predicted together and
+    formatted, so memory is bounded by the batch size rather than by the number of records. Records served by
+    `precomputed` (a `PrecomputedScores`) or found in `score_cache` (a `ScopedScoreCache`) skip the models.
+
+    Returns:
+        list: For each record, either its list of delta score records or the exception raised while scoring it.
+    """
+    results = [None] * len(records)
+    pending = []
+    pending_windows = 0
+
+    # Resolve overlapping genes for all records of a chromosome in one query
+    overlaps = {}
+    by_chrom = defaultdict(list)
+    for k, record in enumerate(records):
+        if isinstance(record.chrom, str) and isinstance(record.pos, int):
+            by_chrom[record.chrom].append(k)
+    for chrom, ks in by_chrom.items():
+        with span('annotation'):
+            overlaps.update(zip(ks, ann.get_names_and_strands(chrom, [records[k].pos for k in ks])))
+        with span('fasta'):
+            prefetch_windows(ann, chrom, [records[k].pos for k in ks], dist_var)
+
+    served = [None] * len(records)
+    if precomputed is not None:
+        with span('cache_lookup'):
+            served = precomputed.get_tasks(records, [overlaps.get(k) for k in range(len(records))], dist_var, mask,
+                                           score_format)
+
+    def flush():
+        tasks = [task for _, record_tasks in pending for task in record_tasks]
+        try:
+            predict_delta_scores(tasks, ann, models, batch_size)
+        except Exception as e:
+            for k, _ in pending:
+                results[k] = e
+        else:
+            for k, record_tasks in pending:
+                format_record(k, record_tasks)
+                if score_cache is not None and not isinstance(results[k], Exception):
+                    with span('cache_store'):
+                        score_cache.put(records[k], dist_var, record_tasks)
+        pending.clear()
+
+    def format_record(k, record_tasks):
+        try:
+            with span('postprocess'):
+                scores = [format_delta_score(task, dist_var, mask, score_format) for task in record_tasks]
+            results[k] = [x for x in scores if x is not None]
+            count_scored(record_tasks)
+        except Exception as e:
+            results[k] = e
+
+    for k, record in enumerate(records):
+        cached = served[k]
+        if cached is None and score_cache is not None:
+            with span('cache_lookup'):
+                cached = score_cache.get(record, dist_var)
+        if cached is not None:
+            format_record(k, cached)
+            continue
+
+        try:
+            record_tasks = prepare_delta_scores(record, ann, dist_var, overlaps.get(k))
+        except Exception as e:
+            results[k] = e
+            continue
+
+        pending.append((k, record_tasks))
+        pending_windows += 2*len(record_tasks)
+
+        if pending_windows >= batch_size:
+            flush()
+            pending_windows = 0
+
+    if pending:
+        flush()
+
+    return results
+
+SCAN_ALTS = 'ACGT'
+SCAN_ALT_CODES = sequence_codes(SCAN_ALTS)
+
+def scan_region(ann, chrom: str, start: int, end: int, dist_var: int, mask: int, models: list,
+                batch_size: int = PREDICT_BATCH_SIZE, ref_cache: RefPredictionCache = REF_CACHE,
+                deadline: float = None) -> dict:
+    """
+    Delta scores of every SNV of a region (in-silico saturation mutagenesis).
+
+    The reference is read once and the reference predictions of each gene are made once for the whole region
+    (merged as in `plan_delta_scores`). The alternate windows are built together, as one array of bases holding
+    three substituted copies of every position's window, and are shared by genes on the same strand whose windows
+    have the same N padding. They are predicted `batch_size` positions at a time; a scan still running at `deadline`
+    (a `time.time()`) is abandoned between chunks.
+
+    Returns:
+        dict: The region's reference bases and, for each overlapping gene, the positions it covers and its DS_AG,
+            DS_AL, DS_DG and DS_DL as matrices with a row per position and a column per alternate base (A, C, G,
+            T), None for the reference base.
+    """
+    cov = 2*dist_var+1
+    wid = 10000+cov
+    positions = np.arange(start, end+1)
+
+    with span('annotation'):
+        overlaps = ann.get_names_and_strands(chrom, positions)
+    transcripts = defaultdict(list)
+    for k, (genes, strands, idxs) in enumerate(overlaps):
+        for idx in idxs:
+            transcripts[int(idx)].append(k)
+    if not transcripts:
+        count_skipped('no_gene')
+        raise SpliceAIAPIException('No gene annotations found for given region',
+                                   f"{chrom}:{start}-{end} does not overlap any annotated gene")
+
+    fasta_chrom = normalise_chrom(chrom, list(ann.ref_fasta.keys())[0])
+    # Genomic positions of the first and last base read
+    first, last = start-wid//2, end+wid//2
+    try:
+        with span('fasta'):
+            codes = sequence_codes(ann.ref_fasta[fasta_chrom][first-1:last])
+    except KeyError as e:
+        count_skipped('unknown_chromosome')
+        raise SpliceAIAPIException('Encountered error: {}'.format(str(e)))
+    except (IndexError, ValueError):
+        count_skipped('fasta_issue')
+        raise SpliceAIAPIException('Skipping region (fasta issue)', f"{chrom}:{start}-{end}")
+    if len(codes) != last-first+1:
+        count_skipped('near_chromosome_end')
+        raise SpliceAIAPIException('Skipping region (near chromosome end)', f"{chrom}:{start}-{end}")
+    ref = codes[wid//2:wid//2+len(positions)].tobytes().decode('latin-1').upper()
+
+    # Columns of the three alternate bases of each position, None where the reference is not A, C, G or T
+    alt_columns = [[c for c in range(4) if SCAN_ALTS[c] != x] if x in SCAN_ALTS else None for x in ref]
+
+    # Transcripts on one strand whose bounds cover the same part of the bases read have the same windows (the bases
+    # outside a transcript are N, as in `prepare_delta_scores`), which are predicted once for all of them
+    groups = defaultdict(set)
+    group_of = {}
+    for idx, ks in transcripts.items():
+        key = (ann.strands[idx], max(int(ann.tx_starts[idx]), first), min(int(ann.tx_ends[idx]), last))
+        groups[key].update(k for k in ks if alt_columns[k] is not None)
+        group_of[idx] = key
+    groups = {key: np.array(sorted(ks), dtype=np.intp) for key, ks in groups.items() if ks}
+
+    # Reference predictions of every scanned position of each group: cached, or predicted as a few wide regions
+    ref_windows = []
+    for (strand, lo, hi), ks in groups.items():
+        bucket = (ann.ref_fasta.filename, fasta_chrom, strand)
+        for p in positions[ks]:
+            win_start, win_end = int(p)-wid//2, int(p)+wid//2
+            ref_windows.append((bucket, (lo, hi), (win_start, win_end, max(lo, win_start), min(hi, win_end))))
+    regions = plan_ref_regions(ref_windows, REF_REGION_WIDTH)
+    region_ys = [ref_cache.get(bucket, region) if ref_cache is not None else None for bucket, region, _ in regions]
+    to_predict = [k for k, y in enumerate(region_ys) if y is None]
+    windows = [ref_region_window(ann, regions[k][0], regions[k][1]) for k in to_predict]
+    for k, y in zip(to_predict, predict_windows(windows, models, batch_size)):
+        bucket, region, _ = regions[k]
+        region_ys[k] = y[0, ::-1] if bucket[2] == '-' else y[0]
+        if ref_cache is not None:
+            ref_cache.put(bucket, region, region_ys[k])
+    y_refs = [None]*len(ref_windows)
+    for (bucket, region, members), y in zip(regions, region_ys):
+        for i in members:
+            offset = ref_windows[i][2][0]-region[0]
+            y_refs[i] = y[offset:offset+cov]
+
+    # The score matrices of each transcript, filled in as chunks of positions are predicted
+    matrices = {}
+    for idx, key in group_of.items():
+        ks = np.array([k for k in transcripts[idx] if alt_columns[k] is not None], dtype=np.intp)
+        if key in groups and len(ks):
+            matrices[idx] = (ks, ann.get_exon_distances(np.full(len(ks), idx), positions[ks]),
+                             {name: np.full((ks[-1]-ks[0]+1, 4), np.nan) for name in ('AG', 'AL', 'DG', 'DL')})
+
+    # The alternate windows of `batch_size` positions (three windows each) at a time, so that memory is bounded by the
+    # chunk rather than the length of the region
+    offset = 0
+    for (strand, lo, hi), ks in groups.items():
+        masked = codes.copy()
+        masked[:lo-first] = N_CODE
+        masked[hi-first+1:] = N_CODE
+        views = np.lib.stride_tricks.sliding_window_view(masked, wid)
+        members = [idx for idx, key in group_of.items() if key == (strand, lo, hi) and idx in matrices]
+
+        for c in range(0, len(ks), batch_size):
+            if deadline is not None and time.time() > deadline:
+                raise SpliceAIAPIException('Region scan timed out', f"{chrom}:{start}-{end}")
+            chunk = ks[c:c+batch_size]
+            with span('encoding'):
+                alt = np.repeat(views[chunk], 3, axis=0)
+                alt[:, wid//2] = SCAN_ALT_CODES[np.array([alt_columns[k] for k in chunk]).ravel()]
+            predictions = predict_windows([Window(row, reverse=strand == '-') for row in alt], models, batch_size)
+            y_alt = np.stack([y[0] for y in predictions])
+            y_alt = y_alt[:, ::-1] if strand == '-' else y_alt
+            y_ref = np.repeat(np.stack(y_refs[offset+c:offset+c+len(chunk)]), 3, axis=0)
+
+            with span('postprocess'):
+                for idx in members:
+                    tx_ks, tx_dists, tx_matrices = matrices[idx]
+                    # Positions of the chunk the transcript covers, their three rows in the chunk and in its matrices
+                    in_tx = np.isin(chunk, tx_ks)
+                    if not in_tx.any():
+                        continue
+                    rows = (3*np.flatnonzero(in_tx)[:, None]+np.arange(3)).ravel()
+                    dist_exon_bdry = np.repeat(tx_dists[np.searchsorted(tx_ks, chunk[in_tx])], 3)
+                    columns = np.array([alt_columns[k] for k in chunk[in_tx]]).ravel()
+                    matrix_rows = np.repeat(chunk[in_tx]-tx_ks[0], 3)
+
+                    # (name, column, sign of alt - ref, whether the masked change is the one at the annotated boundary)
+                    for name, column, sign, at_boundary in (('AG', 1, 1, True), ('AL', 1, -1, False),
+                                                            ('DG', 2, 1, True), ('DL', 2, -1, False)):
+                        delta = sign*(y_alt[rows, :, column]-y_ref[rows, :, column])
+                        idx_max = delta.argmax(axis=1)
+                        ds = delta[np.arange(len(delta)), idx_max].astype(np.float64)
+                        if mask:
+                            ds[(idx_max-cov//2 == dist_exon_bdry) == at_boundary] = 0.0
+                        tx_matrices[name][matrix_rows, columns] = ds
+        offset += len(ks)
+
+    scores = []
+    for idx, (ks, _, tx_matrices) in matrices.items():
+        gene = {'gene': ann.genes[idx], 'strand': group_of[idx][0], 'start': int(positions[ks[0]]),
+                'end': int(positions[ks[-1]])}
+        for name, matrix in tx_matrices.items():
+            gene[f"DS_{name}"] = [[None if np.isnan(x) else x for x in row] for row in matrix.tolist()]
+        scores.append(gene)
+
+    return {'chrom': chrom, 'start': start, 'end': end, 'distance': dist_var, 'ref': ref, 'alts': list(SCAN_ALTS),
+            'scores': scores}
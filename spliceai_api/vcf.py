@@ -0,0 +1,134 @@
+import asyncio
+import gzip
+import io
+import logging
+
+from spliceai_api.exceptions import SpliceAIAPIException, ScoringUnavailableException
+from spliceai_api.executor import bulk_delta_scores_job, stream_chunks, run_when_free
+from spliceai_api.formats import ScoreFormat
+from spliceai_api.utils import Record
+
+logger = logging.getLogger(__name__)
+
+# Same INFO field as the SpliceAI command line tool, so annotated files work with existing downstream tooling
+SPLICEAI_INFO_HEADER = '##INFO=<ID=SpliceAI,Number=.,Type=String,Description="SpliceAIv1.3 variant annotation. ' \
+                       'These include delta scores (DS) and delta positions (DP) for acceptor gain (AG), acceptor ' \
+                       'loss (AL), donor gain (DG), and donor loss (DL). ' \
+                       'Format: ALLELE|SYMBOL|DS_AG|DS_AL|DS_DG|DS_DL|DP_AG|DP_AL|DP_DG|DP_DL">\n'
+
+SUMMARY_FORMAT = ScoreFormat(mode='summary')
+
+def open_vcf(fh) -> io.TextIOWrapper:
+    """Open a binary file object holding a plain or gzip/bgzip compressed VCF as text."""
+    magic = fh.read(2)
+    fh.seek(0)
+    if magic == b'\x1f\x8b':
+        fh = gzip.GzipFile(fileobj=fh)
+    return io.TextIOWrapper(fh, encoding='utf-8', newline='')
+
+def read_vcf_header(lines) -> list:
+    """
+    Read the header lines of a VCF up to and including the #CHROM line, adding the SpliceAI INFO definition.
+
+    Raises:
+        SpliceAIAPIException: If the file has no #CHROM header line.
+    """
+    header = []
+    for line in lines:
+        if line.startswith('#CHROM'):
+            if not any(x.startswith('##INFO=<ID=SpliceAI,') for x in header):
+                header.append(SPLICEAI_INFO_HEADER)
+            header.append(line)
+            return header
+        if not line.startswith('##'):
+            break
+        header.append(line)
+    raise SpliceAIAPIException('Invalid VCF', 'No #CHROM header line found')
+
+def read_vcf_chunks(lines, chunk_size: int):
+    """Yield lists of up to chunk_size data lines, reading lazily from `lines`."""
+    chunk = []
+    for line in lines:
+        if not line.strip():
+            continue
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def read_vcf_chunks_async(lines, chunk_size: int):
+    """`read_vcf_chunks`, reading (and decompressing) each chunk on a thread rather than the event loop."""
+    chunks = read_vcf_chunks(lines, chunk_size)
+    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+        yield chunk
+
+def parse_vcf_record(line: str) -> Record:
+    """A Record for a VCF data line, with all of its alternate alleles. Fields are None if the line is malformed."""
+    fields = line.rstrip('\r\n').split('\t', 5)
+    try:
+        return Record(chrom=fields[0], pos=int(fields[1]), ref=fields[3].upper(),
+                      alts=[alt.upper() for alt in fields[4].split(',')])
+    except (IndexError, ValueError):
+        logger.warning(f"Skipping malformed VCF line: {line[:100]!r}")
+        return Record()
+
+def format_spliceai_info(scores: list) -> str:
+    """The SpliceAI INFO value for the summary mode delta scores of a record."""
+    return ','.join("{}|{}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{}|{}|{}|{}".format(
+                        score['alt'], score['gene'],
+                        score['summary']['DS_AG'], score['summary']['DS_AL'],
+                        score['summary']['DS_DG'], score['summary']['DS_DL'],
+                        score['summary']['DP_AG'], score['summary']['DP_AL'],
+                        score['summary']['DP_DG'], score['summary']['DP_DL'])
+                    for score in scores)
+
+def annotate_vcf_line(line: str, scores) -> str:
+    """
+    Add a SpliceAI INFO field to a VCF data line, replacing any it already has. Lines without scores (or that
+    failed) are returned as is.
+    """
+    if isinstance(scores, Exception) or not scores:
+        return line
+
+    fields = line.rstrip('\r\n').split('\t')
+    if len(fields) < 8:
+        return line
+
+    info = [x for x in fields[7].split(';') if x not in ('', '.') and x.split('=', 1)[0] != 'SpliceAI']
+    info.append(f"SpliceAI={format_spliceai_info(scores)}")
+    fields[7] = ';'.join(info)
+    return '\t'.join(fields) + '\n'
+
+def annotate_vcf_lines_job(annotation: str, lines: list, distance: int, mask: int) -> str:
+    """Score a chunk of VCF data lines and return them annotated with SpliceAI INFO fields."""
+    records = [parse_vcf_record(line) for line in lines]
+    try:
+        results = bulk_delta_scores_job(annotation, records, distance, mask, SUMMARY_FORMAT)
+    except Exception as e:
+        logger.error(f"Encountered error while scoring VCF chunk: {str(e)}")
+        results = [e] * len(records)
+    return ''.join(annotate_vcf_line(line, scores) for line, scores in zip(lines, results))
+
+async def stream_annotated_vcf(scoring, annotation: str, header: list, lines, distance: int, mask: int,
+                               chunk_size: int):
+    """
+    Stream a VCF back with SpliceAI INFO fields, reading and scoring it chunk by chunk.
+
+    `lines` is the open VCF (see `open_vcf`), positioned after its `header`; it is closed when the stream ends.
+    Chunks rejected because the scoring queue is full are retried after the executor's Retry-After interval (see
+    `run_when_free`); chunks that time out or stay rejected are written without annotations.
+    """
+    async def run_chunk(chunk):
+        try:
+            return await run_when_free(scoring, annotate_vcf_lines_job, annotation, chunk, distance, mask)
+        except ScoringUnavailableException as e:
+            logger.error(f"Writing {len(chunk)} VCF records without annotation: {e.details}")
+            return ''.join(chunk)
+
+    with lines:
+        yield ''.join(header)
+        chunks = ((chunk,) async for chunk in read_vcf_chunks_async(lines, chunk_size))
+        async for annotated in stream_chunks(scoring, chunks, run_chunk):
+            yield annotated
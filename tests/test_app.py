@@ -1,3 +1,5 @@
+import json
+import time
 import pytest
 
 from fastapi.testclient import TestClient
@@ -34,6 +36,14 @@ def test_score_custom_seq(id, input, response_code):
     response = client.post(f"/score_custom_seq/", json=input)
     assert response.status_code == response_code
 
+@pytest.mark.parametrize("accept_encoding,encoding", [('gzip', 'gzip'), ('identity', None), ('gzip;q=0', None)])
+def test_score_custom_seq_compression(accept_encoding, encoding):
+    response = client.post('/score_custom_seq/', json=data[0][1], headers={'Accept-Encoding': accept_encoding})
+    assert response.status_code == 200
+    assert response.headers.get('content-encoding') == encoding
+    assert 'Accept-Encoding' in response.headers['vary']
+    assert len(response.json()['acceptor_prob']) == len(data[0][1]['seq'])
+
 @pytest.mark.parametrize("id,input,assembly,response_code,genomic", variants, ids=idfn(variants))
 def test_get_genomic_coord(id, input, assembly, response_code, genomic):
     response = client.get(f"/get_genomic_coord/{assembly}/{input}")
@@ -80,4 +90,350 @@ def test_get_bulk_delta_scores():
     response = client.post('/get_bulk_delta_scores/', json=data)
     assert response.status_code == 200
     if response.status_code == 200:
-        assert len(response.json()) == 2
\ No newline at end of file
+        assert len(response.json()) == 2
+
+def test_get_annotator_stats():
+    response = client.get('/get_annotator_stats')
+    assert response.status_code == 200
+    assert 'grch38_custom' in response.json()
+    assert response.json()['grch38_custom']['memory_bytes'] > 0
+
+def test_reload_annotations_unchanged(monkeypatch):
+    from spliceai_api import app as app_module
+    from spliceai_api.app import annotators
+    ann = annotators.get('grch38_custom')
+    params = {'annotation': 'grch38_custom'}
+    assert client.post('/reload_annotations', params=params).status_code == 403
+    monkeypatch.setattr(app_module, 'RELOAD_ANNOTATIONS_TOKEN', 'secret')
+    assert client.post('/reload_annotations', params=params).status_code == 401
+    assert client.post('/reload_annotations', params=params, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.post('/reload_annotations', params=params, headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.json()['reloaded'] == []
+    assert annotators.get('grch38_custom') is ann
+
+def test_scoring_saturated_returns_503(monkeypatch):
+    from spliceai_api import app as app_module
+    monkeypatch.setattr(app_module.scoring, 'in_flight', app_module.scoring.capacity)
+    response = client.post('/score_custom_seq/', json=data[0][1])
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) > 0
+    assert client.get('/health/alive').status_code == 200
+
+@pytest.mark.parametrize("params,headers", [({'stream': True}, {}), ({'order': 'completion'}, {'Accept': 'application/x-ndjson'})])
+def test_get_bulk_delta_scores_stream(params, headers):
+    data = {
+                "annotation": "grch38_custom",
+                "distance": 50,
+                "variants": [
+                    {"chrom": "21", "pos": 32657714, "ref": "A", "alt": "G"},
+                    {"chrom": "1", "pos": 26840275, "ref": "G", "alt": "A"},
+                    {"chrom": "21", "pos": 32695049, "ref": "A", "alt": "G"}
+                ]
+            }
+    response = client.post('/get_bulk_delta_scores/', json=data, params=params, headers=headers)
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line['index'] for line in lines) == [0, 1, 2]
+    for line in lines:
+        variant = data['variants'][line['index']]
+        assert line['input'] == f"{variant['chrom']}-{variant['pos']}-{variant['ref']}-{variant['alt']}"
+        assert (line['error'] is None) == (variant['chrom'] == '21')
+
+def test_get_bulk_delta_scores_stream_retries_when_busy(monkeypatch):
+    from spliceai_api import app as app_module
+    from spliceai_api.exceptions import ScoringUnavailableException
+
+    # The first chunk finds the pool busy, then gets in after Retry-After
+    run = app_module.scoring.run
+    rejected = []
+    async def busy_once(*args, **kwargs):
+        if not rejected:
+            rejected.append(True)
+            raise ScoringUnavailableException(503, 'Server busy', 'retry later', retry_after=1)
+        return await run(*args, **kwargs)
+    monkeypatch.setattr(app_module.scoring, 'run', busy_once)
+
+    data = {'annotation': 'grch38_custom', 'distance': 50, 'variants': [{'chrom': '21', 'pos': 32657714, 'ref': 'A', 'alt': 'G'}]}
+    response = client.post('/get_bulk_delta_scores/', json=data, params={'stream': True})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert rejected and len(lines) == 1 and lines[0]['error'] is None
+
+def test_streams_give_up_when_busy_past_timeout(monkeypatch):
+    from spliceai_api import app as app_module
+    from spliceai_api.exceptions import ScoringUnavailableException
+
+    async def busy(*args, **kwargs):
+        raise ScoringUnavailableException(503, 'Server busy', 'retry later', retry_after=1)
+    monkeypatch.setattr(app_module.scoring, 'run', busy)
+    monkeypatch.setattr(app_module.scoring, 'timeout', 2)
+
+    variants = [{'chrom': '21', 'pos': 32657714, 'ref': 'A', 'alt': 'G'}, {'chrom': '21', 'pos': 26840275, 'ref': 'C', 'alt': 'A'}]
+    data = {'annotation': 'grch38_custom', 'distance': 50, 'variants': variants}
+    response = client.post('/get_bulk_delta_scores/', json=data, params={'stream': True})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [x['index'] for x in lines] == [0, 1] and all('Server busy' in x['error'] for x in lines)
+
+    vcf = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n21\t26840275\t.\tC\tA\t.\t.\tDP=10\n'
+    response = client.post('/score_vcf/?annotation=grch38_custom&distance=50', content=vcf.encode())
+    assert response.status_code == 200
+    assert response.text.splitlines()[-1] == '21\t26840275\t.\tC\tA\t.\t.\tDP=10'
+
+@pytest.mark.parametrize("stats_format", ["columnar", "base64"])
+def test_get_delta_scores_columnar_stats(stats_format):
+    import base64
+    import numpy as np
+
+    data = {'chrom': '21', 'pos': 26840275, 'ref': 'C', 'alt': 'A', 'annotation': 'grch38_custom', 'distance': 50, 'mask': 0}
+    records = client.post('/get_delta_scores/', json=data).json()
+    response = client.post('/get_delta_scores/', json={**data, 'stats_format': stats_format, 'precision': 'float32'})
+    assert response.status_code == 200
+
+    for expected, score in zip(records, response.json()):
+        stats = score['stats']
+        assert stats['dist_from_variant'] == {'start': -50, 'stop': 50}
+        assert stats['dtype'] == 'float32'
+        for column in ('donor_ref', 'donor_alt', 'donor', 'acceptor_ref', 'acceptor_alt', 'acceptor'):
+            values = stats[column]
+            if stats_format == 'base64':
+                values = np.frombuffer(base64.b64decode(values), dtype='<f4')
+            np.testing.assert_allclose(values, [x[column] for x in expected['stats']], rtol=1e-6, atol=1e-7)
+        assert {k: v for k, v in score.items() if k != 'stats'} == {k: v for k, v in expected.items() if k != 'stats'}
+
+def test_get_delta_scores_summary_mode():
+    data = {'chrom': '21', 'pos': 26840275, 'ref': 'C', 'alt': 'A', 'annotation': 'grch38_custom', 'distance': 50, 'mask': 0}
+    full = client.post('/get_delta_scores/', json=data).json()
+    response = client.post('/get_delta_scores/', json={**data, 'mode': 'summary', 'top_k': 3})
+    assert response.status_code == 200
+    assert all('summary' not in score and 'top' not in score for score in full)
+
+    for expected, score in zip(full, response.json()):
+        assert 'stats' not in score
+        acceptor = sorted(expected['stats'], key=lambda x: -x['acceptor'])
+        donor_loss = sorted(expected['stats'], key=lambda x: x['donor'])
+        assert score['summary']['DS_AG'] == pytest.approx(acceptor[0]['acceptor'])
+        assert score['summary']['DP_AG'] == acceptor[0]['dist_from_variant']
+        assert score['summary']['DS_DL'] == pytest.approx(-donor_loss[0]['donor'])
+        assert score['top']['AG']['delta'] == pytest.approx([x['acceptor'] for x in acceptor[:3]])
+        assert score['top']['DL']['dist_from_variant'] == [x['dist_from_variant'] for x in donor_loss[:3]]
+
+def test_scan_region_matches_delta_scores(monkeypatch):
+    from spliceai_api import app as app_module, MODELS
+    from spliceai_api.utils import scan_region
+
+    # Two positions per chunk, so that the three positions are scored in two chunks
+    def scan_in_chunks(annotation, chrom, start, end, distance, mask, deadline=None):
+        return scan_region(app_module.annotators.get(annotation), chrom, start, end, distance, mask, models=MODELS,
+                           batch_size=2, deadline=deadline)
+    monkeypatch.setattr(app_module, 'scan_region_job', scan_in_chunks)
+
+    # GABPA (+) starts at the second position, inside ATP5J (-)
+    data = {'annotation': 'grch38_custom', 'chrom': '21', 'start': 25734569, 'end': 25734571, 'distance': 50, 'mask': 1}
+    response = client.post('/scan_region/', json=data)
+    assert response.status_code == 200
+    result = response.json()
+    assert result['alts'] == ['A', 'C', 'G', 'T']
+    genes = {gene['gene']: gene for gene in result['scores']}
+    assert genes['ATP5J']['strand'] == '-' and genes['GABPA']['strand'] == '+'
+    assert (genes['ATP5J']['start'], genes['GABPA']['start']) == (25734569, 25734570)
+
+    for pos, ref in zip(range(data['start'], data['end'] + 1), result['ref']):
+        for alt in 'ACGT'.replace(ref, ''):
+            variant = {'chrom': '21', 'pos': pos, 'ref': ref, 'alt': alt, 'annotation': 'grch38_custom',
+                       'distance': 50, 'mask': 1, 'mode': 'summary'}
+            expected = {x['gene']: x['summary'] for x in client.post('/get_delta_scores/', json=variant).json()}
+            assert set(expected) == {name for name, gene in genes.items() if gene['start'] <= pos <= gene['end']}
+            for name, summary in expected.items():
+                row = pos - genes[name]['start']
+                for channel in ('AG', 'AL', 'DG', 'DL'):
+                    assert genes[name][f"DS_{channel}"][row]['ACGT'.index(ref)] is None
+                    assert genes[name][f"DS_{channel}"][row]['ACGT'.index(alt)] == summary[f"DS_{channel}"]
+
+    assert client.post('/scan_region/', json={**data, 'end': data['start'] - 1}).status_code == 400
+    assert client.post('/scan_region/', json={**data, 'chrom': '1'}).status_code == 400
+
+@pytest.mark.parametrize("compressed", [False, True], ids=["plain", "bgzip"])
+def test_score_vcf(compressed):
+    import gzip
+
+    vcf = ''.join([
+        '##fileformat=VCFv4.2\n',
+        '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n',
+        '21\t26840275\t.\tC\tA,T\t.\t.\t.\n',
+        '1\t26840275\tno_gene\tG\tA\t.\t.\tDP=10\n',
+        # Annotated before: the old SpliceAI entry is replaced
+        '21\t32657714\t.\tA\tG\t.\t.\tDP=10;SpliceAI=G|OLD|0.00|0.00|0.00|0.00|0|0|0|0\n'
+    ])
+    body = gzip.compress(vcf.encode()) if compressed else vcf.encode()
+
+    response = client.post('/score_vcf/?annotation=grch38_custom&distance=50', content=body)
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+
+    assert lines[0] == '##fileformat=VCFv4.2'
+    assert lines[1].startswith('##INFO=<ID=SpliceAI,')
+    assert lines[2].startswith('#CHROM')
+    assert lines[4] == '1\t26840275\tno_gene\tG\tA\t.\t.\tDP=10'
+
+    expected = client.post('/get_delta_scores/', json={'chrom': '21', 'pos': 32657714, 'ref': 'A', 'alt': 'G',
+                                                       'annotation': 'grch38_custom', 'mode': 'summary'}).json()
+    info = lines[5].split('\t')[7]
+    assert info.startswith('DP=10;SpliceAI=') and info.count('SpliceAI=') == 1
+    assert info.split('SpliceAI=')[1].split(',')[0] == 'G|{}|{:.2f}|{:.2f}|{:.2f}|{:.2f}|{}|{}|{}|{}'.format(
+        expected[0]['gene'], *(expected[0]['summary'][k] for k in ('DS_AG', 'DS_AL', 'DS_DG', 'DS_DL')),
+        *(expected[0]['summary'][k] for k in ('DP_AG', 'DP_AL', 'DP_DG', 'DP_DL')))
+    alleles = [x.split('|')[0] for x in lines[3].split('\t')[7][len('SpliceAI='):].split(',')]
+    assert set(alleles) == {'A', 'T'}
+
+def test_score_vcf_invalid(monkeypatch):
+    from spliceai_api import app as app_module
+
+    response = client.post('/score_vcf/?annotation=grch38_custom', content=b'not a vcf\n')
+    assert response.status_code == 400
+
+    monkeypatch.setattr(app_module, 'VCF_MAX_UPLOAD_MB', 1 / 1024)
+    response = client.post('/score_vcf/?annotation=grch38_custom', content=b'#' * 2048)
+    assert response.status_code == 413
+    # Without a Content-Length, the limit is enforced while the upload is read
+    response = client.post('/score_vcf/?annotation=grch38_custom', content=iter([b'#' * 1000] * 3))
+    assert response.status_code == 413
+
+def test_instrumented_route_server_timing(monkeypatch):
+    from fastapi import FastAPI
+    from spliceai_api import metrics
+
+    monkeypatch.setattr(metrics, 'DEBUG_TIMING_HEADER', True)
+    instrumented = FastAPI()
+    instrumented.router.route_class = metrics.InstrumentedRoute
+
+    @instrumented.post('/stages/')
+    def stages(payload: dict) -> dict:
+        with metrics.span('predict'):
+            pass
+        return payload
+
+    instrumented_client = TestClient(instrumented)
+    response = instrumented_client.post('/stages/', json={'a': 1}, headers={'X-Debug-Timing': 'true'})
+    assert response.status_code == 200
+    assert response.json() == {'a': 1}
+    stages_timed = [entry.split(';')[0] for entry in response.headers['Server-Timing'].split(', ')]
+    assert stages_timed == ['predict', 'parse', 'serialization', 'total']
+
+    response = instrumented_client.post('/stages/', json={'a': 1})
+    assert 'Server-Timing' not in response.headers
+
+def test_metrics_rendering():
+    from spliceai_api.metrics import Counter, Histogram
+
+    counter = Counter('test_total', 'A counter', ('reason',))
+    counter.inc('a')
+    counter.inc('a', amount=2)
+    assert counter.render()[-1] == 'test_total{reason="a"} 3'
+
+    histogram = Histogram('test_seconds', 'A histogram', (), (0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert histogram.render()[2:] == ['test_seconds_bucket{le="0.1"} 1', 'test_seconds_bucket{le="1"} 2',
+                                      'test_seconds_bucket{le="+Inf"} 3', 'test_seconds_sum 5.55',
+                                      'test_seconds_count 3']
+    histogram.observe(1)
+    assert histogram.to_dict() == {'buckets': {'0.1': 1, '1': 3, '+Inf': 4}, 'sum': 6.55, 'count': 4}
+
+def test_health_ready_after_warm_up(monkeypatch):
+    import threading
+    from spliceai_api import app as app_module
+    monkeypatch.setattr(app_module, 'ready', threading.Event())
+    response = client.get('/health/ready')
+    assert response.status_code == 503
+    assert response.json()['status'] == 'starting'
+
+    app_module.warm_up()
+    response = client.get('/health/ready')
+    assert response.status_code == 200
+    assert response.json()['status'] == 'ready'
+    assert response.json()['models']['warm']
+
+def test_bad_annotation_file_fails_warm_up_and_reload(monkeypatch, tmp_path):
+    import threading
+    from spliceai_api import app as app_module, registry
+    from spliceai_api.utils import load_annotations
+    ann = app_module.annotators.get('grch38_custom')
+    bad = tmp_path / 'bad.txt'
+    bad.write_text('#NAME\tCHROM\nA\t21\n')
+    monkeypatch.setattr(registry, 'resolve_annotation_file', lambda annotation: str(bad))
+
+    monkeypatch.setattr(app_module, 'RELOAD_ANNOTATIONS_TOKEN', 'secret')
+    response = client.post('/reload_annotations', params={'annotation': 'grch38_custom', 'force': True},
+                           headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 400
+    assert response.json()['error'] == 'Gene annotation file not formatted properly'
+    assert app_module.annotators.get('grch38_custom') is ann
+
+    monkeypatch.setattr(app_module, 'ready', threading.Event())
+    monkeypatch.setattr(app_module, 'warm_up_error', None)
+    monkeypatch.setattr(app_module, 'annotators', registry.AnnotatorRegistry(load_annotations()))
+    app_module.warm_up()
+    response = client.get('/health/ready')
+    assert response.status_code == 503
+    assert response.json()['status'] == 'failed'
+
+def test_jobs_resume_from_checkpoint(monkeypatch, tmp_path):
+    import asyncio
+    from spliceai_api import app as app_module
+    from spliceai_api.jobs import JobStore, JobRunner
+
+    store = JobStore(str(tmp_path / 'jobs.db'), lease_seconds=1)
+    runner = JobRunner(store, app_module.scoring, chunk_size=2)
+    monkeypatch.setattr(app_module, 'job_store', store)
+    monkeypatch.setattr(app_module, 'job_runner', runner)
+
+    variants = [{'chrom': '21', 'pos': 26840275, 'ref': 'C', 'alt': 'A'},
+                {'chrom': '1', 'pos': 26840275, 'ref': 'G', 'alt': 'A'},
+                {'chrom': '21', 'pos': 26840275, 'ref': 'C', 'alt': 'T'}]
+    request = {'annotation': 'grch38_custom', 'distance': 50, 'mask': 0, 'mode': 'summary', 'variants': variants}
+    response = client.post('/jobs/', json=request)
+    assert response.status_code == 202
+    job_id = response.json()['id']
+    assert response.json()['status'] == 'queued' and response.json()['total'] == 3
+
+    # The server stops after the first chunk; on restart the job resumes from the checkpoint
+    checkpoint = store.checkpoint
+    def checkpoint_then_stop(job, offset, *args):
+        checkpoint(job, offset, *args)
+        raise asyncio.CancelledError()
+    monkeypatch.setattr(store, 'checkpoint', checkpoint_then_stop)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(runner.run_job(store.next_job(runner.owner)))
+    monkeypatch.setattr(store, 'checkpoint', checkpoint)
+    assert client.get(f'/jobs/{job_id}').json()['done'] == 2
+
+    # Another worker's runner leaves the job alone while its lease lasts, then takes it over
+    other = JobRunner(store, app_module.scoring, chunk_size=2)
+    assert store.next_job(other.owner) is None
+    time.sleep(store.lease_seconds)
+    job = store.next_job(other.owner)
+    assert job['done'] == 2
+    assert not store.renew(job_id, runner.owner)
+    asyncio.run(other.run_job(job))
+
+    status = client.get(f'/jobs/{job_id}').json()
+    assert status['status'] == 'done' and status['done'] == 3 and status['errors'] == 1
+
+    page = client.get(f'/jobs/{job_id}/results', params={'limit': 2}).json()
+    assert [x['index'] for x in page['results']] == [0, 1] and page['next_offset'] == 2
+    results = page['results'] + client.get(f'/jobs/{job_id}/results', params={'offset': 2}).json()['results']
+    bulk = client.post('/get_bulk_delta_scores/', json=request).json()
+    assert [{k: v for k, v in x.items() if k != 'index'} for x in results] == bulk
+
+    # Paging through a job cancelled before it finished ends at its last result
+    cancelled = client.post('/jobs/', json=request).json()['id']
+    assert client.post(f'/jobs/{cancelled}/cancel').json()['status'] == 'cancelled'
+    page = client.get(f'/jobs/{cancelled}/results').json()
+    assert page['results'] == [] and page['next_offset'] is None
+
+    assert client.delete(f'/jobs/{job_id}').status_code == 200
+    assert client.get(f'/jobs/{job_id}').status_code == 404
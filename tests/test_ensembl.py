@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import httpx
+
+from spliceai_api.ensembl import EnsemblClient, EnsemblError
+
+recoded = {
+    'NM_005502:c.66+5G>C': '9-104903609-C-G',
+    'NM_000088.4:c.589G>T': '17-50198002-C-A'
+}
+
+def stub_transport(calls: list) -> httpx.MockTransport:
+    """Stub of Ensembl's variant_recoder GET and POST endpoints."""
+
+    def recode(variant):
+        return {'G': {'input': variant, 'vcf_string': [recoded[variant]]}}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        await asyncio.sleep(0.01)
+        if request.method == 'POST':
+            ids = json.loads(request.content)['ids']
+            return httpx.Response(200, json=[recode(variant) for variant in ids if variant in recoded])
+        variant = request.url.path.split('/variant_recoder/human/')[1]
+        if variant not in recoded:
+            return httpx.Response(400, json={'error': f"Could not parse {variant}"})
+        return httpx.Response(200, json=[recode(variant)])
+
+    return httpx.MockTransport(handler)
+
+def test_ensembl_client_caches_and_coalesces():
+    calls = []
+    client = EnsemblClient(servers={'grch38': 'http://stub'}, transport=stub_transport(calls))
+
+    async def run():
+        coords = await asyncio.gather(*[client.get_genomic_coord('NM_005502:c.66+5G>C') for _ in range(5)])
+        assert coords == [{'chr': '9', 'pos': '104903609', 'ref': 'C', 'alt': 'G'}] * 5
+        assert len(calls) == 1
+
+        await client.get_genomic_coord('NM_005502:c.66+5G>C')
+        assert len(calls) == 1
+
+        try:
+            await client.get_genomic_coord('NM_005502:c.+5G>C')
+            assert False
+        except EnsemblError as e:
+            assert e.status_code == 400 and 'Could not parse' in e.details
+        await client.aclose()
+
+    asyncio.run(run())
+    assert client.stats()['hits'] == 1 and client.stats()['coalesced'] == 4
+
+def test_ensembl_client_translates_batches():
+    calls = []
+    client = EnsemblClient(servers={'grch38': 'http://stub'}, transport=stub_transport(calls), batch_size=2)
+    variants = ['NM_005502:c.66+5G>C', 'NM_000088.4:c.589G>T', 'invalid', 'NM_005502:c.66+5G>C']
+
+    results = asyncio.run(client.translate(variants))
+
+    assert [call.method for call in calls] == ['POST', 'POST']
+    assert results[0] == results[3] == {'chr': '9', 'pos': '104903609', 'ref': 'C', 'alt': 'G'}
+    assert results[1] == {'chr': '17', 'pos': '50198002', 'ref': 'C', 'alt': 'A'}
+    assert isinstance(results[2], EnsemblError)
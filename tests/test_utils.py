@@ -0,0 +1,413 @@
+import json
+import pytest
+import numpy as np
+
+from spliceai_api import MODELS
+from spliceai_api.app import annotators
+from spliceai_api.formats import DEFAULT_SCORE_FORMAT
+from spliceai_api.inference import RefPredictionCache, REF_CACHE
+from spliceai_api.utils import Record, get_delta_scores, get_bulk_delta_scores, score_custom_sequence
+
+bulk_records = [
+    ('snv', Record(chrom='21', pos=32657714, ref='A', alts=['G'])),
+    ('multiallelic', Record(chrom='21', pos=26840275, ref='C', alts=['A', 'T'])),
+    ('no_gene', Record(chrom='1', pos=26840275, ref='G', alts=['A'])),
+    ('snv', Record(chrom='21', pos=32695049, ref='A', alts=['G']))
+]
+
+def reference_delta_scores(record, ann, dist_var, mask) -> list:
+    """Delta scores with every window predicted on its own by the five models, averaged, as SpliceAI does."""
+    from spliceai_api.utils import prepare_delta_scores, format_delta_score
+
+    tasks = prepare_delta_scores(record, ann, dist_var)
+    for task in tasks:
+        if task.x_ref is not None:
+            task.y_ref, task.y_alt = (np.mean([MODELS[m].predict(x.encode()[None, :], verbose=0) for m in range(5)],
+                                              axis=0) for x in (task.x_ref, task.x_alt))
+    scores = [format_delta_score(task, dist_var, mask, DEFAULT_SCORE_FORMAT) for task in tasks]
+    return [x for x in scores if x is not None]
+
+def assert_same_scores(result: list, expected: list):
+    """Delta score records equal but for float round-off between batched and per-window predictions."""
+    assert [{k: v for k, v in x.items() if k != 'stats'} for x in result] == \
+           [{k: v for k, v in x.items() if k != 'stats'} for x in expected]
+    for x, y in zip(result, expected):
+        assert [stats['dist_from_variant'] for stats in x['stats']] == \
+               [stats['dist_from_variant'] for stats in y['stats']]
+        for column in ('donor_ref', 'donor_alt', 'donor', 'acceptor_ref', 'acceptor_alt', 'acceptor'):
+            np.testing.assert_allclose([stats[column] for stats in x['stats']],
+                                       [stats[column] for stats in y['stats']], rtol=1e-5, atol=1e-7)
+
+def test_bulk_delta_scores_match_single():
+    ann = annotators.get('grch38_custom')
+    records = [record for _, record in bulk_records]
+
+    # Neither path may reuse reference predictions cached by the other (or by earlier tests)
+    REF_CACHE.clear()
+    results = get_bulk_delta_scores(records, ann, 50, 0, models=MODELS, batch_size=3)
+
+    assert len(results) == len(records)
+    for record, result in zip(records, results):
+        if record.chrom == '1':
+            assert isinstance(result, Exception)
+        else:
+            expected = reference_delta_scores(record, ann, 50, 0)
+            assert_same_scores(result, expected)
+            REF_CACHE.clear()
+            assert_same_scores(get_delta_scores(record, ann, 50, 0, models=MODELS), expected)
+
+def test_ref_prediction_cache_slices_wider_regions():
+    cache = RefPredictionCache(max_bytes=2**20)
+    assert cache.stats()['hit_rate'] == 0.0
+    bucket = ('ref.fa', 'chr21', '+')
+    # Region covering output positions 5101..5300 with N padding before position 5050 (gene start)
+    region = (101, 10300, 5050, 10300)
+    y = np.arange(200*3, dtype=np.float32).reshape(200, 3)
+    cache.put(bucket, region, y)
+
+    window = (151, 10251, 5050, 10251)
+    np.testing.assert_array_equal(cache.get(bucket, window), y[50:151])
+    # Same span but different gene boundary padding
+    assert cache.get(bucket, (151, 10251, 5060, 10251)) is None
+    assert cache.get(('ref.fa', 'chr21', '-'), window) is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+def test_ref_prediction_cache_evicts_least_recently_used():
+    y = np.zeros((101, 3), dtype=np.float32)
+    cache = RefPredictionCache(max_bytes=2*y.nbytes)
+    bucket = ('ref.fa', 'chr21', '+')
+    windows = [(start, start+10100, start, start+10100) for start in (1000, 2000, 3000)]
+
+    cache.put(bucket, windows[0], y)
+    cache.put(bucket, windows[1], y)
+    assert cache.get(bucket, windows[0]) is not None
+    cache.put(bucket, windows[2], y)
+
+    assert cache.get(bucket, windows[1]) is None
+    assert cache.get(bucket, windows[0]) is not None
+    assert cache.nbytes == 2*y.nbytes
+
+def test_get_names_and_strands_matches_single_lookups():
+    ann = annotators.get('grch38_custom')
+    positions = np.concatenate([ann.tx_starts[:50], ann.tx_ends[:50], ann.tx_ends[:50]+1, [1, 26840275, 32657714]])
+    chrom = ann.chroms[0]
+
+    for pos, (genes, strands, idxs) in zip(positions, ann.get_names_and_strands(chrom, positions)):
+        expected = np.nonzero((ann.chroms == chrom) & (ann.tx_starts <= pos) & (pos <= ann.tx_ends))[0]
+        np.testing.assert_array_equal(idxs, expected)
+        assert list(genes) == list(ann.genes[expected])
+        assert list(strands) == list(ann.strands[expected])
+        np.testing.assert_array_equal(ann.get_name_and_strand(chrom, int(pos))[2], expected)
+
+def test_scoring_executor_deadline():
+    import asyncio
+    import time
+    from spliceai_api.exceptions import ScoringUnavailableException
+    from spliceai_api.executor import ScoringExecutor
+
+    executor = ScoringExecutor(kind='thread', workers=1, queue_size=0, timeout=0.1)
+
+    async def run():
+        with pytest.raises(ScoringUnavailableException) as e:
+            await executor.run(time.sleep, 0.5)
+        assert e.value.status_code == 504
+        # The timed out job still holds the only slot until it finishes
+        with pytest.raises(ScoringUnavailableException) as e:
+            await executor.run(time.sleep, 0)
+        assert e.value.status_code == 503
+        await asyncio.sleep(0.5)
+
+        # The steps of one admitted request share its slot and deadline
+        async with executor.admit() as admission:
+            await admission.run(time.sleep, 0)
+            assert executor.in_flight == 1
+            with pytest.raises(ScoringUnavailableException) as e:
+                await admission.wait(asyncio.sleep(0.5))
+            assert e.value.status_code == 504
+        assert executor.in_flight == 0
+
+        # A request admitted elsewhere (by the micro-batcher) takes a slot only while its jobs run, even past a full
+        # pool
+        async with executor.admit():
+            async with executor.admit(hold_slot=False) as admission:
+                assert await admission.run(sum, [1, 2]) == 3
+                assert executor.in_flight == 1
+        assert executor.in_flight == 0
+
+    asyncio.run(run())
+    executor.shutdown()
+
+def test_micro_batcher_combines_concurrent_requests():
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    from spliceai_api.exceptions import ScoringUnavailableException
+    from spliceai_api.batching import MicroBatcher
+
+    calls = []
+    def model(x, training=False):
+        calls.append(len(x))
+        return x[:, 5000:-5000, :3]
+
+    batcher = MicroBatcher([model] * 5, max_wait=0.2, max_batch=8, max_queue=16)
+    requests = [[np.full((10101, 4), i, dtype=np.float32)] * 2 for i in range(4)]
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda windows: batcher.submit(windows).result(), requests))
+    # A request that gave up waiting is skipped without stopping the batcher
+    batcher.submit(requests[0]).cancel()
+    assert len(batcher.submit(requests[1]).result()) == 2
+    batcher.shutdown()
+
+    for i, predictions in enumerate(results):
+        assert len(predictions) == 2
+        assert all(np.all(y == i) and y.shape == (1, 101, 3) for y in predictions)
+    assert len(calls) < 4 * 5
+    assert batcher.stats()['batch_size']['count'] == len(calls) // 5
+    assert batcher.stats()['queue_depth'] == 0
+
+    async def admit():
+        async with batcher.admit():
+            assert batcher.admitted == 1
+    asyncio.run(admit())
+    batcher.admitted = batcher.max_queue
+    with pytest.raises(ScoringUnavailableException) as e:
+        asyncio.run(admit())
+    assert e.value.status_code == 503
+
+def test_score_custom_sequence_tiles_match_full_sequence():
+    sequence = ''.join(np.random.default_rng(0).choice(list('ACGT'), 1234))
+
+    full = score_custom_sequence(sequence, models=MODELS, tile_size=len(sequence))
+    tiled = score_custom_sequence(sequence, models=MODELS, tile_size=500, tile_batch=2)
+
+    assert len(tiled['acceptor_prob']) == len(sequence)
+    for name in ('acceptor_prob', 'donor_prob'):
+        np.testing.assert_array_equal(tiled[name], full[name])
+
+def test_score_cache_round_trip(tmp_path):
+    from spliceai_api.score_cache import ScoreCache, ScopedScoreCache
+    ann = annotators.get('grch38_custom')
+    cache = ScoreCache(str(tmp_path / 'scores.db'), max_bytes=2**30)
+    scoped = ScopedScoreCache(cache, 'grch38_custom')
+    record = Record(chrom='21', pos=26840275, ref='C', alts=['A', 'T'])
+
+    scores = get_delta_scores(record, ann, 50, 0, models=MODELS, score_cache=scoped)
+    assert cache.stats()['misses'] == 1 and cache.stats()['puts'] == 2
+
+    # Cached predictions are formatted for any mask without running the models
+    for mask in (0, 1):
+        expected = scores if mask == 0 else get_delta_scores(record, ann, 50, mask, models=MODELS)
+        assert get_delta_scores(record, ann, 50, mask, models=None, score_cache=scoped) == \
+            [{**score, 'source': 'cache'} for score in expected]
+    chr_record = Record(chrom='chr21', pos=26840275, ref='C', alts=['T', 'A'])
+    assert get_bulk_delta_scores([chr_record], ann, 50, 0, models=None, score_cache=scoped)[0] == \
+        [{**score, 'source': 'cache'} for score in get_delta_scores(chr_record, ann, 50, 0, models=MODELS)]
+    assert cache.stats()['hits'] == 3
+    assert scoped.get(Record(chrom='21', pos=26840275, ref='C', alts=['G']), 50) is None
+
+    # Entries can be imported into another cache, which evicts the least recently used beyond its size cap
+    other = ScoreCache(str(tmp_path / 'other.db'), max_bytes=cache.nbytes * 3 // 4)
+    assert other.import_db(str(tmp_path / 'scores.db')) == 2
+    assert other.stats()['evictions'] == 1 and other.nbytes <= other.max_bytes
+
+def test_precomputed_scores_serve_snvs(tmp_path):
+    import pysam
+    from spliceai_api.formats import ScoreFormat
+    from spliceai_api.precomputed import PrecomputedScores, PrecomputedFile
+
+    ann = annotators.get('grch38_custom')
+    summary = ScoreFormat(mode='summary')
+    snv = Record(chrom='21', pos=26840275, ref='C', alts=['A', 'T'])
+    scores = get_delta_scores(snv, ann, 50, 0, models=MODELS, score_format=summary)
+
+    # Score file in the format of the published precomputed scores, with only some of the alts
+    vcf = tmp_path / 'scores.vcf'
+    with open(vcf, 'w') as f:
+        f.write('##fileformat=VCFv4.0\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for score in scores:
+            info = '|'.join([score['alt'], score['gene']] + [f"{score['summary'][k]:.2f}" for k in ('DS_AG', 'DS_AL', 'DS_DG', 'DS_DL')] +
+                            [str(score['summary'][k]) for k in ('DP_AG', 'DP_AL', 'DP_DG', 'DP_DL')])
+            f.write(f"21\t26840275\t.\tC\t{score['alt']}\t.\t.\tSpliceAI={info}\n")
+    path = pysam.tabix_index(str(vcf), preset='vcf', force=True)
+    precomputed = PrecomputedScores([PrecomputedFile(path=path, masked=False, distance=50)])
+
+    results = get_bulk_delta_scores([snv, Record(chrom='21', pos=26840275, ref='C', alts=['G']),
+                                     Record(chrom='21', pos=26840275, ref='C', alts=['CA'])],
+                                    ann, 50, 0, models=MODELS, score_format=summary, precomputed=precomputed)
+
+    assert [score['source'] for score in results[0]] == ['precomputed'] * len(scores)
+    for score, expected in zip(results[0], scores):
+        assert score['summary'] == pytest.approx(expected['summary'], abs=0.005)
+    # Alts missing from the file and indels fall back to the model
+    assert all(score['source'] == 'model' for result in results[1:] for score in result)
+    # Full stats and other masks or distances are not served by the summary score files
+    assert get_delta_scores(snv, ann, 50, 1, models=MODELS, score_format=summary, precomputed=precomputed)[0]['source'] == 'model'
+    assert get_delta_scores(snv, ann, 50, 0, models=MODELS, precomputed=precomputed)[0]['source'] == 'model'
+    assert precomputed.stats()['hits'] == 1
+
+def test_compiled_annotation_matches_tsv(tmp_path):
+    import os
+    from spliceai_api.annotation_index import compiled_path, load_annotation_tables, nearest_boundaries
+
+    tsv = tmp_path / 'ann.txt'
+    tsv.write_text('#NAME\tCHROM\tSTRAND\tTX_START\tTX_END\tEXON_START\tEXON_END\n'
+                   'A\t21\t+\t99\t400\t99,199,\t150,400,\n'
+                   'B\t21\t-\t299\t330\t299\t330\n')
+    tables = load_annotation_tables(str(tsv), cache_dir='')
+    assert os.path.exists(compiled_path(str(tsv), ''))
+    np.testing.assert_array_equal(tables['exon_starts'], [100, 200, 300])
+    np.testing.assert_array_equal(tables['boundaries'], [100, 150, 200, 400, 300, 330])
+    # Cached, and recompiled once the TSV changes
+    assert load_annotation_tables(str(tsv), cache_dir='')['genes'].tolist() == ['A', 'B']
+    tsv.write_text(tsv.read_text().replace('\nB\t', '\nBB\t'))
+    tables = load_annotation_tables(str(tsv), cache_dir='')
+    assert tables['genes'].tolist() == ['A', 'BB']
+
+    # Nearest boundaries match np.union1d, the upstream boundary winning ties
+    args = (tables['boundaries'], tables['boundary_keys'], tables['boundary_offsets'])
+    np.testing.assert_array_equal(nearest_boundaries(*args, [0, 0, 0, 0, 1], [90, 175, 150, 500, 315]),
+                                  [10, -25, 0, -100, -15])
+    tsv.write_text(tsv.read_text().replace('\nBB\t', '\nC\t21\t+\t99\t400\t\t\nBB\t'))
+    tables = load_annotation_tables(str(tsv), cache_dir='')
+    args = (tables['boundaries'], tables['boundary_keys'], tables['boundary_offsets'])
+    np.testing.assert_array_equal(nearest_boundaries(*args, [0, 2], [175, 315]), [-25, -15])
+    with pytest.raises(ValueError):
+        nearest_boundaries(*args, [0, 1], [175, 175])
+
+    ann = annotators.get('grch38_custom')
+    idxs = np.repeat(np.arange(0, len(ann.genes), 97), 4)
+    positions = ann.tx_starts[idxs] + np.tile([-10, 0, 1000, 25000], len(idxs) // 4)
+    expected = [min(np.union1d(*ann.get_exons(i)) - pos, key=abs) for i, pos in zip(idxs, positions)]
+    np.testing.assert_array_equal(ann.get_exon_distances(idxs, positions), expected)
+    assert [ann.get_pos_data(i, pos) for i, pos in zip(idxs, positions)] == ann.get_pos_data_batch(idxs, positions)
+
+def test_packed_genome_matches_pyfaidx(tmp_path):
+    from pyfaidx import Fasta, FetchError
+    from spliceai_api.genome import PackedGenome, pack_fasta
+
+    fasta = tmp_path / 'ref.fa'
+    fasta.write_text('>chr1\nACGTNacgtnACGTA\nCCGG\n>chr2\nTTTTGGGGCCCCAAAA\n')
+    pack_fasta(str(fasta), str(tmp_path / 'ref.fa.packed'))
+    expected = Fasta(str(fasta), rebuild=False)
+    packed = PackedGenome(str(tmp_path / 'ref.fa.packed'))
+
+    assert list(packed.keys()) == ['chr1', 'chr2']
+    for name in ('chr1', 'chr2'):
+        for start, stop in [(0, 5), (3, 12), (10, 100), (7, 3), (5, 5), (None, None), (-4, None), (2, -2)]:
+            assert packed[name][start:stop].seq == expected[name][start:stop].seq
+    with pytest.raises(FetchError):
+        packed['chr1'][-100:5]
+    assert [x.seq for x in packed.fetch_windows('chr2', [8, 0, 30], [20, 4, 40])] == ['CCCCAAAA', 'TTTT', '']
+
+def test_window_encoding_matches_one_hot_encode():
+    from spliceai.utils import one_hot_encode
+    from spliceai_api.encoding import Window, encode_batch, padded_window, sequence_codes, substituted_window
+
+    seq = ''.join(np.random.default_rng(0).choice(list('ACGTNacgtnRY'), 101))
+    expected = one_hot_encode(seq)
+    assert (Window(sequence_codes(seq)).encode() == expected).all()
+    assert (Window(sequence_codes(seq), reverse=True).encode() == expected[::-1, ::-1]).all()
+
+    x_ref = padded_window(sequence_codes(seq), 10, 20)
+    ref = 'N'*10 + seq[10:81] + 'N'*20
+    batch = encode_batch([x_ref, substituted_window(x_ref, 50, 1, 'G'),
+                          substituted_window(Window(x_ref.codes, reverse=True), 50, 2, 'TC')])
+    assert batch.dtype == np.float32
+    assert (batch[0] == one_hot_encode(ref)).all()
+    assert (batch[1] == one_hot_encode(ref[:50] + 'G' + ref[51:])).all()
+    assert (batch[2] == one_hot_encode(ref[:50] + 'TC' + ref[52:])[::-1, ::-1]).all()
+    assert len(substituted_window(x_ref, 50, 1, 'GAT').codes) == 103
+
+def test_fused_ensemble_matches_models():
+    from spliceai_api.inference import predict_windows
+    from spliceai_api.models import ModelSet
+    from spliceai_api.utils import prepare_delta_scores
+
+    ann = annotators.get('grch38_custom')
+    tasks = prepare_delta_scores(Record(chrom='21', pos=26840275, ref='C', alts=['A', 'TC']), ann, 50)
+    windows = [x for task in tasks for x in (task.x_ref, task.x_alt)]
+
+    expected = predict_windows(windows, list(MODELS))
+    assert all((y == x).all() for y, x in zip(predict_windows(windows, MODELS), expected))
+
+    bucketed = predict_windows(windows, MODELS, bucket=256)
+    assert all(y.shape == x.shape and np.allclose(y, x, atol=1e-6) for y, x in zip(bucketed, expected))
+
+    # Largest error measured against float32 over sampled chr21 variants was 4e-3
+    bfloat16 = predict_windows(windows, ModelSet(precision='bfloat16'))
+    assert all(np.allclose(y, x, atol=1e-2) for y, x in zip(bfloat16, expected))
+
+def test_remote_models_match_local(tmp_path):
+    import asyncio
+    import threading
+    from spliceai_api.batching import MicroBatcher
+    from spliceai_api.inference import predict_windows
+    from spliceai_api.inference_server import InferenceServer
+    from spliceai_api.models import RemoteModels
+    from spliceai_api.utils import prepare_delta_scores
+
+    ann = annotators.get('grch38_custom')
+    tasks = prepare_delta_scores(Record(chrom='21', pos=26840275, ref='C', alts=['A', 'TC']), ann, 50)
+    windows = [x for task in tasks for x in (task.x_ref, task.x_alt)]
+    windows.append(windows[0].encode())
+
+    path = str(tmp_path / 'inference.sock')
+    batcher = MicroBatcher(MODELS)
+    loop = asyncio.new_event_loop()
+    serving = loop.create_task(InferenceServer(path, batcher).serve())
+    server = threading.Thread(target=loop.run_until_complete, args=(asyncio.wait([serving]),), daemon=True)
+    server.start()
+    try:
+        remote = RemoteModels(path, connect_timeout=30).load()
+        assert all((y == x).all() for y, x in zip(predict_windows(windows, remote), predict_windows(windows, MODELS)))
+    finally:
+        loop.call_soon_threadsafe(serving.cancel)
+        server.join()
+        batcher.shutdown()
+
+def test_response_rendering():
+    from spliceai_api.responses import dumps, negotiate_encoding
+    content = {'a': np.array([0.123456, 1.0]), 'b': [np.float32(0.5), 0.987654], 'c': np.arange(6).reshape(2, 3)[:, 1]}
+
+    assert json.loads(dumps(content)) == {'a': [0.123456, 1.0], 'b': [0.5, 0.987654], 'c': [1, 4]}
+    assert json.loads(dumps(content, decimals=2)) == {'a': [0.12, 1.0], 'b': [0.5, 0.99], 'c': [1, 4]}
+    assert negotiate_encoding('gzip, br;q=0.5', ('zstd', 'br', 'gzip')) == 'gzip'
+    assert negotiate_encoding('*', ('zstd', 'gzip')) == 'zstd'
+    assert negotiate_encoding('identity', ('gzip',)) is None
+
+def test_annotation_reload_reaches_other_processes(tmp_path):
+    from spliceai_api.registry import AnnotatorRegistry
+    from spliceai_api.utils import load_annotations
+
+    path = tmp_path / 'annotations.json'
+    path.write_text('{}')
+    a, b = (AnnotatorRegistry(load_annotations(), str(path)) for _ in range(2))
+    ann = b.get('grch38_custom')
+    assert b.get('grch38_custom') is ann
+
+    assert a.reload('grch38_custom', force=True) == ['grch38_custom']
+    reloaded = b.get('grch38_custom')
+    assert reloaded is not ann
+    assert b.get('grch38_custom') is reloaded
+    assert a.get('grch38_custom') is not ann
+
+def test_process_pool_warm_up_waits_for_workers(monkeypatch):
+    import asyncio
+    import os
+    from spliceai_api.executor import ScoringExecutor
+
+    executor = ScoringExecutor(kind='process', workers=1)
+    try:
+        executor.warm_up()
+        assert asyncio.run(executor.run(os.getpid)) != os.getpid()
+    finally:
+        executor.shutdown()
+
+    # A worker that cannot load its annotations fails the warm-up rather than leaving it waiting
+    monkeypatch.setenv('GRCH38_FASTA', '/nonexistent.fa')
+    executor = ScoringExecutor(kind='process', workers=1)
+    try:
+        with pytest.raises(RuntimeError, match='failed to start'):
+            executor.warm_up()
+    finally:
+        executor.shutdown()